@@ -27,5 +27,29 @@ DTYPE_FILLNOFLAT = np.float64
 # Datatype for flowdirection
 DTYPE_FLOWDIR = np.uint8
 
-# Datatype for accumulated flow
-DTYPE_ACCUM = np.float64
+# Datatype for accumulated flow. It is a count of cells
+DTYPE_ACCUM = np.uint32
+
+# Datatype for masks
+DTYPE_MASK = np.uint8
+
+# Candidate datatypes for labels from smallest to largest. Labels are stored in the smallest which can hold them
+DTYPES_LABEL = (np.uint8, np.uint16, np.uint32, np.int64)
+
+
+def label_dtype(max_label):
+    """Smallest label datatype which can hold labels [0;max_label]
+
+    Parameters
+    ----------
+    max_label : int
+        Largest label
+
+    Returns
+    -------
+    numpy dtype
+    """
+    for dtype in DTYPES_LABEL:
+        if max_label <= np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    raise ValueError("No label datatype can hold {} labels".format(max_label))
@@ -13,7 +13,13 @@
 # -------------------------------------------------------------------------------------------------
 from __future__ import (absolute_import, division, print_function) #, unicode_literals)  # See issue #3
 from builtins import *
+import tempfile
+import threading
 import numpy as np
+from .dtypes import DTYPE_MASK, label_dtype
+
+# Aggregates supported by label_aggregate
+AGGREGATES = ('min', 'max', 'sum', 'count', 'argmin', 'argmax')
 
 
 def connected_components(data):
@@ -40,6 +46,128 @@ def connected_components(data):
     return labelled, nlabels
 
 
+def connected_components_tiled(read_strip, shape, write_strip=None, strip_rows=1024, statistics=None,
+                               keep_function=None):
+    """Label connected components strip by strip.
+
+    Each strip of rows is labelled independently. Labels touching across the seams between strips are merged using the
+    connected components of the graph of seam pairs. Labels are numbered like connected_components numbers them for
+    the whole raster. The local labels of each strip are kept in a temporary file, so the data is only read once, and
+    written using a lookup table to the global labels. Only one strip and the first and last row of each strip are held
+    in memory at a time.
+
+    Parameters
+    ----------
+    read_strip : callable
+        Called as read_strip(row_off, rows) and returns the data of the strip as an ndarray. Any non-zero values are
+        counted as features
+    shape : tuple of int
+        Shape of the whole raster
+    write_strip : callable, optional
+        Called as write_strip(labelled, row_off) for each strip from the top. If not given the labelled raster is
+        returned
+    strip_rows : int, optional
+        Number of rows in each strip
+    statistics : sequence of str, optional
+        Aggregates of the data to calculate for each label. Names from AGGREGATES
+    keep_function : callable, optional
+        Called with the aggregates and returns a list-like object where label n is kept if element n is True. Labels
+        which are not kept become background and the rest are compacted like compact_labels. Requires statistics
+
+    Returns
+    -------
+    label : ndarray or None
+        The labelled raster. None if write_strip is given
+    nlabels : int
+        How many objects were found
+    aggregates : ndarray or None
+        Aggregates of each label if statistics is given
+    """
+    import scipy.ndimage
+    connectivity = [[1, 1, 1],
+                    [1, 1, 1],
+                    [1, 1, 1]]
+    rows, cols = shape
+    row_offs = list(range(0, rows, strip_rows))
+    statistics = tuple(statistics or ())
+
+    def first_pass(row_off, spill):
+        data = read_strip(row_off, min(strip_rows, rows - row_off))
+        labelled, nlabels = scipy.ndimage.label(data, structure=connectivity)
+        labelled.astype(label_dtype(nlabels)).tofile(spill)
+        aggregates = None
+        if statistics:
+            aggregates, = label_aggregate(labelled, [(data, statistics)], nlabels)
+            for arg in ('argmin', 'argmax'):
+                if arg in statistics:
+                    aggregates[arg] = np.where(aggregates[arg] >= 0, aggregates[arg] + row_off * cols, -1)
+        return labelled[0].copy(), labelled[-1].copy(), nlabels, aggregates
+
+    with tempfile.TemporaryFile() as spill:
+        strips = [first_pass(r, spill) for r in row_offs]
+        return _resolve_strips(strips, spill, shape, strip_rows, write_strip, statistics, keep_function)
+
+
+def _resolve_strips(strips, spill, shape, strip_rows, write_strip, statistics, keep_function):
+    """Merge the strips labelled by connected_components_tiled and write the global labels"""
+    import scipy.sparse
+    import scipy.sparse.csgraph
+    rows, cols = shape
+    row_offs = list(range(0, rows, strip_rows))
+
+    # Provisional label of local label l in strip i is offsets[i] + l. 0 is background
+    counts = np.array([s[2] for s in strips], dtype=np.int64)
+    offsets = np.concatenate(([0], np.cumsum(counts)[:-1])) if len(counts) else counts
+    nprovisional = int(np.sum(counts)) + 1
+
+    # Pairs of provisional labels touching across the seams. Cell (r, c) touches (r + 1, c + dc)
+    pairs = [np.zeros((0,), dtype=np.int64), np.zeros((0,), dtype=np.int64)]
+    for i in range(len(strips) - 1):
+        above, below = strips[i][1], strips[i + 1][0]
+        for a, b in [(above, below), (above[1:], below[:-1]), (above[:-1], below[1:])]:
+            touching = (a > 0) & (b > 0)
+            pairs[0] = np.concatenate((pairs[0], a[touching] + offsets[i]))
+            pairs[1] = np.concatenate((pairs[1], b[touching] + offsets[i + 1]))
+    graph = scipy.sparse.coo_matrix((np.ones(len(pairs[0]), dtype=np.int8), (pairs[0], pairs[1])),
+                                    shape=(nprovisional, nprovisional))
+    _, component = scipy.sparse.csgraph.connected_components(graph, directed=False)
+
+    # Number components by their first provisional label as it comes first in the raster
+    lut = np.zeros((nprovisional,), dtype=np.int64)
+    unique_components, first = np.unique(component[1:], return_index=True)
+    rank = np.zeros((len(unique_components),), dtype=np.int64)
+    rank[np.argsort(first)] = np.arange(1, len(unique_components) + 1)
+    lut[1:] = rank[np.searchsorted(unique_components, component[1:])]
+    nlabels = len(unique_components)
+
+    aggregates = None
+    if statistics:
+        # Local background of each strip is background
+        groups = np.concatenate([np.concatenate(([0], lut[np.arange(1, s[2] + 1) + offset]))
+                                 for s, offset in zip(strips, offsets)])
+        aggregates = reduce_aggregates(np.concatenate([s[3] for s in strips]), groups, nlabels + 1)
+        if keep_function is not None:
+            keep = keep_function(aggregates)
+            keep_lut, nlabels = relabel_lut(keep)
+            aggregates = compact_aggregates(aggregates, keep)
+            lut = keep_lut[lut]
+    lut = lut.astype(label_dtype(nlabels))
+
+    labelled = None
+    if write_strip is None:
+        labelled = np.zeros(shape, dtype=lut.dtype)
+
+        def write_strip(strip, row_off):
+            labelled[row_off:row_off + len(strip)] = strip
+
+    spill.seek(0)
+    for row_off, count, offset in zip(row_offs, counts, offsets):
+        strip_shape = (min(strip_rows, rows - row_off), cols)
+        local = np.fromfile(spill, dtype=label_dtype(count), count=strip_shape[0] * cols).reshape(strip_shape)
+        write_strip(lut[np.where(local > 0, local.astype(np.int64) + offset, 0)], row_off)
+    return labelled, nlabels, aggregates
+
+
 def label_stats(data, labelled, nlabels=None):
     """Calculate data stats for each label.
 
@@ -89,15 +217,130 @@ def keep_labels(labelled, keep_label, background=0):
     Returns
     -------
     new_components : ndarray
-        A boolean array of same dimensions as labelled where True indicates a kept label
+        A mask of same dimensions as labelled where 1 indicates a kept label
     """
     # Make sure background label is NOT kept
     keep_label[background] = False
 
-    keep_array = np.array(keep_label).astype(bool)
+    keep_array = np.array(keep_label).astype(bool).astype(DTYPE_MASK)
     return keep_array[labelled]
 
 
+def relabel_lut(keep_label, background=0):
+    """Lookup table which compacts kept labels.
+
+    Kept labels are numbered [1;n] in their original order. As filtering removes whole components this gives the same
+    labels as running connected_components on the kept components.
+
+    Parameters
+    ----------
+    keep_label : list-like
+        List-like object of same length as number of labels. label n is kept if keep_label[n] == True
+    background : int
+        Label of background. Never kept
+
+    Returns
+    -------
+    lut : ndarray
+        lut[lbl] is the new label of lbl. Labels which are not kept get 0
+    nlabels : int
+        Number of kept labels
+    """
+    keep = np.array(keep_label, dtype=bool)
+    keep[background] = False
+    new_labels = np.cumsum(keep)
+    lut = np.where(keep, new_labels, 0)
+    return lut, int(new_labels[-1]) if len(new_labels) else 0
+
+
+def compact_labels(labelled, keep_label, background=0):
+    """Remove labels and renumber the remaining in a single vectorized pass.
+
+    Replaces keep_labels followed by connected_components when whole labels are removed.
+
+    Parameters
+    ----------
+    labelled : ndarray
+        Labelled array
+    keep_label : list-like
+        List-like object of same length as number of labels. label n is kept if keep_label[n] == True
+    background : int
+        Label of background
+
+    Returns
+    -------
+    label : ndarray
+        Array of same shape as labelled where kept labels are numbered [1;nlabels] and the rest is 0. The datatype is the
+        smallest which can hold nlabels
+    nlabels : int
+        Number of kept labels
+    """
+    lut, nlabels = relabel_lut(keep_label, background)
+    return lut.astype(label_dtype(nlabels))[labelled], nlabels
+
+
+def compact_aggregates(aggregates, keep_label, background=0):
+    """Aggregates of compacted labels derived from the aggregates of the original labels.
+
+    Parameters
+    ----------
+    aggregates : ndarray
+        Structured array with fields from AGGREGATES as returned by label_stats or label_aggregate
+    keep_label : list-like
+        List-like object of same length as number of labels. label n is kept if keep_label[n] == True
+    background : int
+        Label of background
+
+    Returns
+    -------
+    ndarray
+        Aggregates matching compact_labels. Label 0 gets the merged aggregates of all labels which are not kept
+    """
+    lut, nlabels = relabel_lut(keep_label, background)
+    return reduce_aggregates(aggregates, lut, nlabels + 1)
+
+
+def reduce_aggregates(aggregates, groups, ngroups):
+    """Merge aggregates of labels into aggregates of groups of labels.
+
+    Parameters
+    ----------
+    aggregates : ndarray
+        Structured array with fields from AGGREGATES as returned by label_stats or label_aggregate
+    groups : array_like
+        Group [0;ngroups[ of each row in aggregates
+    ngroups : int
+        Number of groups
+
+    Returns
+    -------
+    ndarray
+        Structured array with the same fields as aggregates and a row for each group. argmin and argmax are the
+        smallest index holding the extreme value
+    """
+    groups = np.asarray(groups, dtype=np.int64)
+    names = aggregates.dtype.names
+    result = np.zeros((ngroups,), dtype=aggregates.dtype)
+    for name in ('sum', 'count'):
+        if name in names:
+            result[name] = np.bincount(groups, weights=aggregates[name], minlength=ngroups)
+    for name, ufunc, initial in [('min', np.fmin, float('inf')), ('max', np.fmax, float('-inf'))]:
+        arg = 'arg' + name
+        if arg in names and name not in names:
+            raise ValueError("Reducing {} requires {}".format(arg, name))
+        if name in names:
+            values = np.full((ngroups,), initial)
+            ufunc.at(values, groups, aggregates[name])
+            result[name] = values
+        if arg in names:
+            # First cell holding the extreme value
+            hit = (aggregates[name] == result[name][groups]) & (aggregates[arg] >= 0)
+            first = np.full((ngroups,), np.iinfo(np.int64).max, dtype=np.int64)
+            np.minimum.at(first, groups[hit], aggregates[arg][hit])
+            result[arg] = np.where(first == np.iinfo(np.int64).max, -1, first)
+    return result
+
+
 def label_min_index(data, labelled, nlabels=None):
     """Calculate min data value and index for each label.
 
@@ -145,25 +388,8 @@ def label_max_index(data, labelled, nlabels=None):
     -------
 
     """
-    # TODO: Use labeled_comprehension from scipy instead?
-    if not nlabels:
-        nlabels = np.max(labelled)
-
-    dtype = [('value', float), ('row', int), ('col', int)]
-    lmax = np.zeros((nlabels + 1,), dtype=dtype)
-    lmax[:]['value'] = float('-inf')
-    lmax[:]['row'] = -1
-    lmax[:]['col'] = -1
-    for r in range(0, data.shape[0]):
-        for c in range(0, data.shape[1]):
-            val = data[r, c]
-            lbl = labelled[r, c]
-            record = lmax[lbl]
-            if val > record['value']:
-                record['value'] = val
-                record['row'] = r
-                record['col'] = c
-    return lmax
+    result, = label_aggregate(labelled, [(data, ('argmax',))], nlabels)
+    return index_records(data, result['argmax'], float('-inf'))
 
 
 def label_count(labelled):
@@ -178,3 +404,294 @@ def label_count(labelled):
         List-like object of same length as number of labels where result[lbl] holds the number of cells for label = lbl
     """
     return np.bincount(labelled.ravel())
+
+
+def label_sum(data, labelled, nlabels=None):
+    """Sum data values of each label in a single pass.
+
+    Parameters
+    ----------
+    data : ndarray
+        Values to sum
+    labelled : ndarray
+        Labelled array of same shape as data
+    nlabels : int, optional
+        Minimum length of the result
+
+    Returns
+    -------
+        Array where result[lbl] holds the sum of data values for label = lbl
+    """
+    return np.bincount(labelled.ravel(), weights=data.ravel(), minlength=nlabels or 0)
+
+
+def label_aggregate(labelled, rasters, nlabels=None, threads=None, block_rows=64):
+    """Calculate any set of per label aggregates of one or more rasters in a single pass.
+
+    The rasters are processed in blocks of rows. Each block of labels is read once for all rasters. By default the
+    blocks are processed serially. With more than one thread the rows are split into one chunk for each thread and the
+    partial results are merged. The chunks only run concurrently with the Cython kernel which releases the GIL.
+
+    Parameters
+    ----------
+    labelled : ndarray
+        Labelled array
+    rasters : sequence of (ndarray, sequence of str)
+        Value rasters of same shape as labelled each with the aggregates to calculate. Aggregates are names from
+        AGGREGATES. argmin and argmax are the flat index of the first cell holding the min or max value
+    nlabels : int, optional
+        Largest label. Calculated if not given
+    threads : int, optional
+        Number of threads to use. Default 1
+    block_rows : int, optional
+        Number of rows in each block
+
+    Returns
+    -------
+    list of ndarray
+        A structured array for each raster with a field for each requested aggregate. result[lbl] holds the aggregates
+        of label = lbl. argmin and argmax are -1 for labels without cells
+    """
+    rasters = [(data, tuple(statistics)) for data, statistics in rasters]
+    for data, statistics in rasters:
+        if data.shape != labelled.shape:
+            raise ValueError("Value rasters must have the same shape as the labelled raster")
+        unknown = set(statistics) - set(AGGREGATES)
+        if unknown:
+            raise ValueError("Unknown aggregates: {}".format(', '.join(sorted(unknown))))
+    if not nlabels:
+        nlabels = int(np.max(labelled)) if labelled.size else 0
+    # The aggregate kernels index the results by label without bounds checks
+    if labelled.size and (np.min(labelled) < 0 or np.max(labelled) > nlabels):
+        raise ValueError("Labels must be in [0;{}]. Got labels in [{};{}]".format(
+            nlabels, np.min(labelled), np.max(labelled)))
+
+    rows = labelled.shape[0]
+    threads = max(1, min(threads or 1, rows))
+    bounds = np.linspace(0, rows, threads + 1).astype(np.int64)
+    parts = [[_empty_aggregates(nlabels) for _ in rasters] for _ in range(threads)]
+
+    def run(part, row_start, row_stop):
+        flags = [_aggregate_flags(statistics) for _, statistics in rasters]
+        for r in range(row_start, row_stop, block_rows):
+            for (data, _), acc, f in zip(rasters, part, flags):
+                _aggregate_rows(data, labelled, r, min(r + block_rows, row_stop), acc, f)
+
+    if threads == 1:
+        run(parts[0], 0, rows)
+    else:
+        workers = [threading.Thread(target=run, args=(part, bounds[i], bounds[i + 1])) for i, part in enumerate(parts)]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+
+    results = []
+    for i, (_, statistics) in enumerate(rasters):
+        acc = _merge_aggregates([part[i] for part in parts])
+        dtype = [(name, acc.dtype[name]) for name in AGGREGATES if name in statistics]
+        result = np.zeros((nlabels + 1,), dtype=dtype)
+        for name, _ in dtype:
+            result[name] = acc[name]
+        results.append(result)
+    return results
+
+
+def index_records(data, index, empty_value=float('nan')):
+    """Turn flat cell indexes into records of value, row and col like those returned by label_min_index
+
+    Parameters
+    ----------
+    data : ndarray
+        Values
+    index : array_like
+        Flat cell index into data for each label. -1 for no cell
+    empty_value : float, optional
+        Value of records without a cell
+
+    Returns
+    -------
+    ndarray
+        Structured array with the fields value, row and col. row and col are -1 for records without a cell
+    """
+    index = np.asarray(index, dtype=np.int64)
+    has_cell = index >= 0
+    dtype = [('value', float), ('row', int), ('col', int)]
+    records = np.zeros((len(index),), dtype=dtype)
+    records['value'] = empty_value
+    records['row'] = -1
+    records['col'] = -1
+    records['value'][has_cell] = data.ravel()[index[has_cell]]
+    rows, cols = np.unravel_index(index[has_cell], data.shape)
+    records['row'][has_cell] = rows
+    records['col'][has_cell] = cols
+    return records
+
+
+def _aggregate_flags(statistics):
+    """Bit flags of the aggregates to calculate. Bit i is set for AGGREGATES[i]"""
+    return sum(1 << i for i, name in enumerate(AGGREGATES) if name in statistics)
+
+
+def _empty_aggregates(nlabels):
+    """Accumulator for _aggregate_rows"""
+    dtype = [('min', np.float64), ('max', np.float64), ('sum', np.float64), ('count', np.int64),
+             ('argmin', np.int64), ('argmax', np.int64)]
+    acc = np.zeros((nlabels + 1,), dtype=dtype)
+    acc['min'] = float('inf')
+    acc['max'] = float('-inf')
+    acc['argmin'] = -1
+    acc['argmax'] = -1
+    return acc
+
+
+def _merge_aggregates(parts):
+    """Merge accumulators of consecutive row chunks. Ties are resolved in favour of the first chunk"""
+    acc = parts[0]
+    for part in parts[1:]:
+        acc['sum'] += part['sum']
+        acc['count'] += part['count']
+        better = part['min'] < acc['min']
+        acc['min'][better] = part['min'][better]
+        acc['argmin'][better] = part['argmin'][better]
+        better = part['max'] > acc['max']
+        acc['max'][better] = part['max'][better]
+        acc['argmax'][better] = part['argmax'][better]
+    return acc
+
+
+def _aggregate_rows(data, labelled, row_start, row_stop, acc, flags):
+    """Update the accumulator acc with the cells in rows [row_start;row_stop[. See label_aggregate"""
+    lbls = labelled[row_start:row_stop].ravel()
+    values = data[row_start:row_stop].ravel().astype(np.float64)
+    nlabels = len(acc)
+    if flags & 8:
+        acc['count'] += np.bincount(lbls, minlength=nlabels)
+    if flags & 4:
+        acc['sum'] += np.bincount(lbls, weights=values, minlength=nlabels)
+    offset = row_start * labelled.shape[1]
+    for name, ufunc, initial, flag, arg_flag in [('min', np.fmin, float('inf'), 1, 16),
+                                                 ('max', np.fmax, float('-inf'), 2, 32)]:
+        if not flags & (flag | arg_flag):
+            continue
+        block = np.full((nlabels,), initial)
+        # fmin and fmax ignore NaN like the comparisons in the cell loops do
+        ufunc.at(block, lbls, values)
+        if flags & arg_flag:
+            # First cell in the block holding the extreme value
+            hit = np.flatnonzero(values == block[lbls])
+            first = np.full((nlabels,), np.iinfo(np.int64).max, dtype=np.int64)
+            np.minimum.at(first, lbls[hit], hit + offset)
+            better = ufunc(block, acc[name]) != acc[name]
+            acc['arg' + name][better] = first[better]
+        acc[name] = ufunc(acc[name], block)
+
+
+def label_stage_storage(data, labelled, maxdepth, nbins=10):
+    """Calculate stage-storage curves for each label in a single pass.
+
+    The water level of a label is measured from the bottom of the deepest cell. A cell with depth d is flooded when the
+    water level exceeds maxdepth - d. The curves are sampled at nbins + 1 water levels evenly spaced from 0 to
+    maxdepth. Cells are counted in bins of maxdepth - d using one bincount over label and bin. Flooded cell counts
+    and volumes are exact at the sampled levels.
+
+    Parameters
+    ----------
+    data : ndarray
+        Depths
+    labelled : ndarray
+        Labelled array of same shape as data
+    maxdepth : array_like
+        Max depth of each label. For instance label_stats(data, labelled)['max']
+    nbins : int, optional
+        Number of bins between water level 0 and maxdepth
+
+    Returns
+    -------
+    stage : ndarray
+        Water levels of shape (nlabels, nbins + 1)
+    count : ndarray
+        Number of flooded cells at each water level
+    volume : ndarray
+        Water volume in depth units times cells at each water level
+    """
+    maxdepth = np.maximum(np.asarray(maxdepth, dtype=np.float64), 0)
+    nlabels = len(maxdepth)
+    labels = labelled.ravel()
+    # Height of the bottom of each cell above the bottom of the deepest cell
+    label_max = maxdepth[labels]
+    bottom = label_max - data.ravel()
+    with np.errstate(divide='ignore', invalid='ignore'):
+        bins = np.where(label_max > 0, bottom / label_max * nbins, 0)
+    bins = np.clip(bins.astype(np.int64), 0, nbins - 1)
+    flat_ix = labels.astype(np.int64) * nbins + bins
+    counts = np.bincount(flat_ix, minlength=nlabels * nbins).reshape(nlabels, nbins)
+    sums = np.bincount(flat_ix, weights=bottom, minlength=nlabels * nbins).reshape(nlabels, nbins)
+
+    # Cells below level k are exactly the cells in bins < k
+    count = np.zeros((nlabels, nbins + 1), dtype=np.int64)
+    np.cumsum(counts, axis=1, out=count[:, 1:])
+    bottom_sum = np.zeros((nlabels, nbins + 1), dtype=np.float64)
+    np.cumsum(sums, axis=1, out=bottom_sum[:, 1:])
+    stage = maxdepth[:, np.newaxis] * (np.arange(nbins + 1) / float(nbins))
+    volume = np.maximum(stage * count - bottom_sum, 0)
+    return stage, count, volume
+
+
+def label_quantiles(data, labelled, quantiles, nlabels=None, nodata=None):
+    """Calculate quantiles of data values of each label using a single sort.
+
+    The cells are sorted once by label and value. Each label is then a contiguous run of sorted values and all
+    quantiles of all labels are picked from the runs at once. Quantiles interpolate linearly between the two nearest
+    values like numpy.percentile.
+
+    Parameters
+    ----------
+    data : ndarray
+        Data values. For instance depths, DEM or accumulated flow
+    labelled : ndarray
+        Labelled array of same shape as data
+    quantiles : sequence of float
+        Quantiles in [0;1]. For instance (0.5, 0.9) for median and 90th percentile
+    nlabels : int, optional
+        Number of labels. The result has nlabels + 1 rows
+    nodata : number, optional
+        Cells with this value are ignored. NaN cells are always ignored
+
+    Returns
+    -------
+    ndarray
+        float64 array of shape (nlabels + 1, len(quantiles)) where result[lbl, i] is quantile i of label lbl. NaN for
+        labels without cells
+    """
+    quantiles = np.asarray(quantiles, dtype=np.float64)
+    if np.any((quantiles < 0) | (quantiles > 1)):
+        raise ValueError("Quantiles must be in [0;1]")
+    values = data.ravel()
+    labels = labelled.ravel()
+    if nlabels is None:
+        nlabels = int(np.max(labels)) if labels.size else 0
+    valid = ~np.isnan(values) if values.dtype.kind == 'f' else np.ones(values.shape, dtype=bool)
+    if nodata is not None:
+        valid &= values != nodata
+    if not np.all(valid):
+        values, labels = values[valid], labels[valid]
+
+    order = np.lexsort((values, labels))
+    sorted_values = values[order].astype(np.float64)
+    del order
+    counts = np.bincount(labels, minlength=nlabels + 1)
+    starts = np.cumsum(counts) - counts
+
+    # Fractional position of each quantile within the run of each label
+    position = (counts[:, np.newaxis] - 1) * quantiles[np.newaxis, :]
+    lower = np.floor(position).astype(np.int64)
+    upper = np.minimum(lower + 1, np.maximum(counts - 1, 0)[:, np.newaxis])
+    fraction = position - lower
+    result = np.full(position.shape, np.nan, dtype=np.float64)
+    has_cells = counts > 0
+    base = starts[has_cells, np.newaxis]
+    low_values = sorted_values[base + lower[has_cells]]
+    high_values = sorted_values[base + upper[has_cells]]
+    result[has_cells] = low_values + fraction[has_cells] * (high_values - low_values)
+    return result
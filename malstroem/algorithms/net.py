@@ -15,7 +15,8 @@ from __future__ import (absolute_import, division, print_function, unicode_liter
 from builtins import *
 import numpy as np
 from collections import defaultdict
-from .flow import trace_downstream
+from .flow import trace_downstream, direction_to_delta
+from ._raster_utils import cell_in_raster
 
 
 def _pourpoint_enumerator(pour_points):
@@ -40,6 +41,207 @@ def _pourpoint_enumerator(pour_points):
         yield pid, pp
 
 
+class PathTree(object):
+    """Downstream flow paths stored once in a shared tree of linear cell indexes.
+
+    D8 flow is deterministic, so two paths which meet in a cell share every cell downstream of it. Each traced cell is
+    stored once along with the tree index of its downstream cell. A path is then fully described by the tree index of
+    its first cell and its length.
+
+    Parameters
+    ----------
+    shape : pair of ints
+        Shape of raster (num_rows, num_cols)
+
+    Attributes
+    ----------
+    shape : pair of ints
+        Shape of raster (num_rows, num_cols)
+    size : int
+        Number of cells stored in the tree
+    """
+
+    def __init__(self, shape):
+        self.shape = tuple(shape)
+        ncells = self.shape[0] * self.shape[1]
+        self.dtype = np.int32 if ncells < np.iinfo(np.int32).max else np.int64
+        self.size = 0
+        self._cells = np.empty((1024,), dtype=self.dtype)
+        self._downstream = np.empty((1024,), dtype=self.dtype)
+        # Tree index of each traced cell keyed by linear cell index. Only cells on paths are stored
+        self._element = {}
+
+    @property
+    def cells(self):
+        """Linear cell index of each element in the tree"""
+        return self._cells[:self.size]
+
+    @property
+    def downstream(self):
+        """Tree index of the downstream element of each element. -1 if not traced (yet)"""
+        return self._downstream[:self.size]
+
+    def element(self, linear_index):
+        """Return tree index of the cell with the given linear index. The cell is added if not already present."""
+        linear_index = int(linear_index)
+        ix = self._element.get(linear_index, -1)
+        if ix < 0:
+            ix = self.size
+            if ix == len(self._cells):
+                self._cells = np.concatenate((self._cells, np.empty_like(self._cells)))
+                self._downstream = np.concatenate((self._downstream, np.empty_like(self._downstream)))
+            self._cells[ix] = linear_index
+            self._downstream[ix] = -1
+            self._element[linear_index] = ix
+            self.size += 1
+        return int(ix)
+
+    def path_elements(self, starts, lengths):
+        """Return tree indexes of the elements of a number of paths.
+
+        Parameters
+        ----------
+        starts : sequence of ints
+            Tree index of the first element of each path
+        lengths : sequence of ints
+            Number of elements in each path
+
+        Returns
+        -------
+        elements : 1D array
+            Tree indexes of all paths concatenated
+        offsets : 1D array
+            Path i is elements[offsets[i]:offsets[i+1]]
+        """
+        starts = np.asarray(starts, dtype=np.int64)
+        lengths = np.asarray(lengths, dtype=np.int64)
+        offsets = np.zeros((len(lengths) + 1,), dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        elements = np.empty((offsets[-1],), dtype=self.dtype)
+        downstream = self.downstream
+        # Walk all paths one step at a time
+        paths = np.arange(len(starts))
+        current = starts
+        for step in range(int(lengths.max()) if len(lengths) else 0):
+            active = lengths[paths] > step
+            paths = paths[active]
+            current = current[active]
+            elements[offsets[paths] + step] = current
+            current = downstream[current]
+        return elements, offsets
+
+    def path_cells(self, starts, lengths):
+        """Return (row, col) cell indexes of the cells of a number of paths.
+
+        Parameters
+        ----------
+        starts : sequence of ints
+            Tree index of the first element of each path
+        lengths : sequence of ints
+            Number of elements in each path
+
+        Returns
+        -------
+        cells : 2D array
+            (N, 2) array of row, col of all paths concatenated
+        offsets : 1D array
+            Path i is cells[offsets[i]:offsets[i+1]]
+        """
+        elements, offsets = self.path_elements(starts, lengths)
+        rows, cols = np.divmod(self._cells[elements], self.shape[1])
+        return np.column_stack((rows, cols)), offsets
+
+
+class StreamPath(object):
+    """A path of cells stored in a PathTree.
+
+    Behaves like a read only sequence of (row, col) tuples.
+
+    Parameters
+    ----------
+    tree : PathTree
+        Tree holding the path
+    start : int
+        Tree index of the first cell in the path
+    length : int
+        Number of cells in the path
+    """
+
+    def __init__(self, tree, start, length):
+        self.tree = tree
+        self.start = start
+        self.length = length
+        self._elements = None
+
+    def elements(self):
+        """Tree indexes of the cells in the path"""
+        if self._elements is None:
+            self._elements, _ = self.tree.path_elements([self.start], [self.length])
+        return self._elements
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, ix):
+        linear_index = self.tree.cells[self.elements()[ix]]
+        return tuple(int(v) for v in divmod(linear_index, self.tree.shape[1]))
+
+    def __iter__(self):
+        for ix in range(self.length):
+            yield self[ix]
+
+    def head(self, length):
+        """Return path of the first 'length' cells of this path"""
+        return StreamPath(self.tree, self.start, length)
+
+    def tail(self, from_ix):
+        """Return path of the cells from index 'from_ix' to the end of this path"""
+        return StreamPath(self.tree, int(self.elements()[from_ix]), self.length - from_ix)
+
+
+def _trace_path(flowdir, labeled, cell, tree, background_label=None):
+    """Trace path from cell to next label and store it in tree.
+
+    Parameters
+    ----------
+    flowdir
+    labeled : 2D array
+        Labeled bluespots
+    cell : pair of ints
+    tree : PathTree
+    background_label : int
+        Value of background (non-labeled) cells
+
+    Returns
+    -------
+    label : int or None
+        Next label downstream. None if flow leaves the raster
+    path : StreamPath
+        Path from cell to (and including) the first cell of the next label
+    """
+    rows, cols = flowdir.shape
+    cells = labeled.ravel()
+    src_label = labeled[cell[0], cell[1]]
+    start = ix = tree.element(cell[0] * cols + cell[1])
+    length = 0
+    while True:
+        length += 1
+        lbl = cells[tree._cells[ix]]
+        if not lbl == src_label:
+            if background_label is None or not lbl == background_label:
+                return int(lbl), StreamPath(tree, start, length)
+        next_ix = tree._downstream[ix]
+        if next_ix < 0:
+            # Not traced from here yet. Take one step along the flow
+            r, c = divmod(int(tree._cells[ix]), cols)
+            delta = direction_to_delta(flowdir[r, c])
+            if not delta or not cell_in_raster((rows, cols), (r + delta[0], c + delta[1])):
+                return None, StreamPath(tree, start, length)
+            next_ix = tree.element((r + delta[0]) * cols + c + delta[1])
+            tree._downstream[ix] = next_ix
+        ix = next_ix
+
+
 def _split_into_common_flow_groups(nodes, min_common_cells=2):
     """Return list of lists where all nodes in each sublist have common flow for at least 'min_common_cells'
     at the end."""
@@ -80,33 +282,26 @@ def _prune_common_flow(nodes, new_label_id):
     """
     # print("Pruning: {}".format(nodes))
     downstream_id = nodes[0]['downstream_id']
-    # Easy access to copy of geoms
-    geoms = [list(n['geometry']) for n in nodes]
+    paths = [n['geometry'] for n in nodes]
     # All nodes must flow to the same downstream node
     assert all([downstream_id == n['downstream_id'] for n in nodes]), "ERROR: diff downstream ids: {}".format(nodes)
     # All flows must share at least the two last coordinates
-    assert all([geoms[0][-2] == g[-2] for g in geoms])
-
-    new_node = dict(id=new_label_id, downstream_id=downstream_id, nodetype='junction', pix=None, geometry=None)
-    shared_path = []
-
-    # As long as the last coordinate is shared between all geoms
-    while all([geoms[0][-1] == g[-1] for g in geoms]):
-        # Add to shared path
-        shared_path.append(geoms[0][-1])
-        # Remove from all geoms
-        for g in geoms:
-            del g[-1]
-
-    # Reverse path to make it flow correctly
-    shared_path.reverse()
-    new_node['geometry'] = shared_path
-    new_node['pix'] = tuple(shared_path[0])
-
-    # Copy edited geom to nodes and set new downstream node
-    for i, n in enumerate(nodes):
+    assert all([paths[0][-2] == p[-2] for p in paths])
+
+    # Paths which meet share their tree elements from there on. Count shared cells from the end.
+    shortest = min([len(p) for p in paths])
+    ends = np.array([p.elements()[-shortest:][::-1] for p in paths])
+    shared = np.all(ends == ends[0], axis=0)
+    num_shared = shortest if np.all(shared) else int(np.argmin(shared))
+
+    shared_path = paths[0].tail(len(paths[0]) - num_shared)
+    new_node = dict(id=new_label_id, downstream_id=downstream_id, nodetype='junction', pix=shared_path[0],
+                    geometry=shared_path)
+
+    # Cut shared path from nodes (keeping the junction cell) and set new downstream node
+    for n, p in zip(nodes, paths):
         n['downstream_id'] = new_node['id']
-        n['geometry'] = geoms[i] + [new_node['pix']]
+        n['geometry'] = p.head(len(p) - num_shared + 1)
 
     # print("New node with id {}".format(new_node['id']))
     # print("New node with id {} inserted at {}: {}".format(new_node['id'], new_node['pix'], new_node))
@@ -206,19 +401,92 @@ def geometric_pourpoint_network(flowdir, labeled_bluespots, pour_points, backgro
 
     Returns
     -------
+    nodes : list of dict
+        Nodes of the network. The 'geometry' of each node is a StreamPath. All paths are stored in one shared PathTree
 
     """
+    tree = PathTree(flowdir.shape)
     upstream_nodes = defaultdict(list)
     for pid, pp in _pourpoint_enumerator(pour_points):
-        down_lbl, geom = next_downstream_label(flowdir, labeled_bluespots, pp, background_label, geometry=True)
-        node = dict(id=pid, downstream_id=down_lbl, nodetype='pourpoint', pix=tuple(pp), geometry=geom)
+        down_lbl, path = _trace_path(flowdir, labeled_bluespots, pp, tree, background_label)
+        node = dict(id=pid, downstream_id=down_lbl, nodetype='pourpoint', pix=tuple(pp), geometry=path)
         upstream_nodes[down_lbl].append(node)
 
     # Untangle upstream nodes of each pp seperately
-    next_available_label = int(np.max(labeled_bluespots) + 1)
+    next_available_label = int(np.max(labeled_bluespots)) + 1
     final_nodes = []
     for lbl, upstream in upstream_nodes.items():
         for untangled_node, next_available_label in _untangle(upstream, next_available_label):
             # print("Next label {}".format(next_available_label))
             final_nodes.append(untangled_node)
     return final_nodes
+
+
+def burn_pourpoint_streams(flowdir, labeled, pour_points, background_label=None, nodata=-1):
+    """Burn the flow paths from pour points to the next label into a raster.
+
+    Flow is traced downstream from each pour point in a single pass. Each cell on a path gets the id of the pour point
+    whose path reached it first. A trace stops when it reaches a cell which is already burned, as everything
+    downstream of that cell is already burned too. The first cell of the next label is not burned.
+
+    Parameters
+    ----------
+    flowdir
+    labeled : 2D array
+        2D array of labeled bluespots
+    pour_points : list-like
+        List-like structure where pour_point[n] is the pour_point of blue spot with label n
+    background_label : int
+        Value of background (non-labeled) cells
+    nodata : int
+        Value of cells not on any path
+
+    Returns
+    -------
+    streams : 2D array
+        int32 array holding pour point ids
+    """
+    streams = np.full(flowdir.shape, nodata, dtype=np.int32)
+    for pid, pp in _pourpoint_enumerator(pour_points):
+        src_label = labeled[pp[0], pp[1]]
+        for c in trace_downstream(flowdir, pp):
+            lbl = labeled[c[0], c[1]]
+            if not lbl == src_label:
+                if background_label is None or not lbl == background_label:
+                    break
+            if not streams[c[0], c[1]] == nodata:
+                break
+            streams[c[0], c[1]] = pid
+    return streams
+
+
+def burn_stream_segments(nodes, shape, nodata=-1):
+    """Burn the stream segment of each node of a geometric pour point network into a raster.
+
+    Each cell gets the id of the node owning the stream segment through the cell. The last cell of a stream flowing to
+    another node belongs to that node (junction) or its bluespot, and is not burned by the upstream node.
+
+    Parameters
+    ----------
+    nodes : list of dict
+        Nodes as returned by geometric_pourpoint_network
+    shape : pair of ints
+        Shape of raster (num_rows, num_cols)
+    nodata : int
+        Value of cells not on any stream
+
+    Returns
+    -------
+    streams : 2D array
+        int32 array holding node ids
+    """
+    streams = np.full(shape, nodata, dtype=np.int32)
+    stream_nodes = [n for n in nodes if n['geometry']]
+    if not stream_nodes:
+        return streams
+    tree = stream_nodes[0]['geometry'].tree
+    lengths = np.array([len(n['geometry']) - (n['downstream_id'] is not None) for n in stream_nodes], dtype=np.int64)
+    elements, offsets = tree.path_elements([n['geometry'].start for n in stream_nodes], lengths)
+    ids = np.repeat(np.array([n['id'] for n in stream_nodes], dtype=np.int32), lengths)
+    streams.ravel()[tree.cells[elements]] = ids
+    return streams
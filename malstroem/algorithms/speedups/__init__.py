@@ -73,6 +73,9 @@ def enable():
     _orig['label.label_min_index'] = label.label_min_index
     label.label_min_index = _label.label_min_index
 
+    _orig['label._aggregate_rows'] = label._aggregate_rows
+    label._aggregate_rows = _label._aggregate_rows
+
     global enabled
     enabled = True
 
@@ -92,6 +95,7 @@ def disable():
 
     label.label_stats = _orig['label.label_stats']
     label.label_min_index = _orig['label.label_min_index']
+    label._aggregate_rows = _orig['label._aggregate_rows']
 
     _orig.clear()
 
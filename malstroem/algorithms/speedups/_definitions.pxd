@@ -22,4 +22,11 @@ ctypedef np.float64_t DTYPE_t_FILLNOFLAT
 
 ctypedef np.uint8_t   DTYPE_t_FLOWDIR
 
-ctypedef np.float64_t DTYPE_t_ACCUM
\ No newline at end of file
+ctypedef np.uint32_t  DTYPE_t_ACCUM
+
+ctypedef fused DTYPE_t_LABEL:
+    np.uint8_t
+    np.uint16_t
+    np.uint32_t
+    np.int32_t
+    np.int64_t
@@ -14,21 +14,17 @@
 from __future__ import (absolute_import, division, print_function, unicode_literals)
 import cython
 import numpy as np
-from ..dtypes import DTYPE_FLOWDIR
+from ..dtypes import DTYPE_FLOWDIR, DTYPE_ACCUM
 
 # cimports
 cimport numpy as np
-from ._definitions cimport DTYPE_t_FLOWDIR, DTYPE_t_ACCUM, DTYPE_t_FILL, DTYPE_t_DTM, DTYPE_t_FILLNOFLAT
+from ._definitions cimport DTYPE_t_FLOWDIR, DTYPE_t_ACCUM, DTYPE_t_FILL, DTYPE_t_DTM, DTYPE_t_FILLNOFLAT, DTYPE_t_LABEL
 # from libc.math cimport M_PI, atan2, sin, cos, sqrt # See https://github.com/cython/cython/blob/master/Cython/Includes/libc/math.pxd
 
 
 cdef packed struct cell_struct:
     np.int_t r, c
 
-cdef packed struct cell_label32_struct:
-    np.int_t r, c
-    np.int32_t label
-
 cdef packed struct cell_label64_struct:
     np.int_t r, c
     np.int64_t label
@@ -257,7 +253,7 @@ def trace_accumulated_flow(DTYPE_t_FLOWDIR[:,:] flowdir, DTYPE_t_ACCUM[:,:] accu
 def accumulated_flow(DTYPE_t_FLOWDIR[:,:] flowdir not None):
     cdef unsigned int rows, cols, r, c
     rows, cols = flowdir.shape[0], flowdir.shape[1]
-    cdef np.ndarray[DTYPE_t_ACCUM, ndim=2] npaccum = np.zeros((rows, cols))
+    cdef np.ndarray[DTYPE_t_ACCUM, ndim=2] npaccum = np.zeros((rows, cols), dtype=DTYPE_ACCUM)
     cdef cell_struct cell
     cdef DTYPE_t_ACCUM[:,:] accum = npaccum
     # accum = np.zeros(flowdir.shape)
@@ -274,47 +270,7 @@ def accumulated_flow(DTYPE_t_FLOWDIR[:,:] flowdir not None):
 
 
 @cython.boundscheck(False)
-cdef assign_watersheds_upstream_32_cython(DTYPE_t_FLOWDIR[:,:] flowdir, np.int32_t[:,:] labelled, cell, unassigned):
-    cdef cell_struct neighbor_cell, current_cell
-    cdef np.int32_t lbl, background
-    cdef cell_label32_struct current_cell_label, neighbor_cell_label
-    cdef list stack
-    cdef int rows, cols
-
-    rows, cols = flowdir.shape[0], flowdir.shape[1]
-    background = unassigned
-
-    current_cell_label.r = cell[0]
-    current_cell_label.c = cell[1]
-    current_cell_label.label = background
-
-    # Stack holds cell coord and downstream label
-    stack = list()
-    stack.append(current_cell_label)
-
-    while stack:
-        current_cell_label = stack.pop()
-        lbl = labelled[current_cell_label.r, current_cell_label.c]
-        if lbl == background:
-            # unassigned cell. Assign to downstream label
-            labelled[current_cell_label.r, current_cell_label.c] = current_cell_label.label
-            lbl = current_cell_label.label
-        else:
-            # Either a new label met, or a cell with same label as downstream.
-            pass
-        # Loop over neighbor cells
-        for direction in range(8):
-            current_cell.r = current_cell_label.r
-            current_cell.c = current_cell_label.c
-            neighbor_cell = cell_in_direction_cython(current_cell, direction)
-            if is_in_raster_cython(rows, cols, neighbor_cell) and is_upstream_cython(flowdir, current_cell, direction, neighbor_cell):
-                neighbor_cell_label.r = neighbor_cell.r
-                neighbor_cell_label.c = neighbor_cell.c
-                neighbor_cell_label.label = lbl
-                stack.append(neighbor_cell_label)
-
-@cython.boundscheck(False)
-cdef assign_watersheds_upstream_64_cython(DTYPE_t_FLOWDIR[:,:] flowdir, np.int64_t[:,:] labelled, cell, unassigned):
+def assign_watersheds_upstream_typed_cython(DTYPE_t_FLOWDIR[:,:] flowdir, DTYPE_t_LABEL[:,:] labelled, cell, unassigned):
     cdef cell_struct neighbor_cell, current_cell
     cdef np.int64_t lbl, background
     cdef cell_label64_struct current_cell_label, neighbor_cell_label
@@ -337,7 +293,7 @@ cdef assign_watersheds_upstream_64_cython(DTYPE_t_FLOWDIR[:,:] flowdir, np.int64
         lbl = labelled[current_cell_label.r, current_cell_label.c]
         if lbl == background:
             # unassigned cell. Assign to downstream label
-            labelled[current_cell_label.r, current_cell_label.c] = current_cell_label.label
+            labelled[current_cell_label.r, current_cell_label.c] = <DTYPE_t_LABEL> current_cell_label.label
             lbl = current_cell_label.label
         else:
             # Either a new label met, or a cell with same label as downstream.
@@ -395,9 +351,7 @@ cdef assign_watersheds_upstream_fallback_cython(DTYPE_t_FLOWDIR[:,:] flowdir, la
                 stack.append(neighbor_cell_label)
 
 def assign_watersheds_upstream(flowdir, labelled, cell, unassigned):
-    if labelled.dtype == np.int32:
-        assign_watersheds_upstream_32_cython(flowdir, labelled, cell, unassigned)
-    elif labelled.dtype == np.int64:
-        assign_watersheds_upstream_64_cython(flowdir, labelled, cell, unassigned)
+    if labelled.dtype in (np.uint8, np.uint16, np.uint32, np.int32, np.int64):
+        assign_watersheds_upstream_typed_cython(flowdir, labelled, cell, unassigned)
     else:
         assign_watersheds_upstream_fallback_cython(flowdir, labelled, cell, unassigned)
@@ -17,6 +17,7 @@ import numpy as np
 
 # cimports
 cimport numpy as np
+from ._definitions cimport DTYPE_t_LABEL
 
 
 cdef packed struct stat_record:
@@ -162,3 +163,49 @@ def label_min_index(data, labelled, nlabels=None):
     if data.dtype == np.float64 and labelled.dtype == np.int32:
         return label_min_index_float64_int32_cython(data, labelled, nlabels)
     return label_min_index_fallback_cython(data, labelled, nlabels)
+
+
+ctypedef fused value_t:
+    np.float32_t
+    np.float64_t
+    np.uint32_t
+
+
+def _aggregate_rows(data, labelled, Py_ssize_t row_start, Py_ssize_t row_stop, acc, int flags):
+    """Update the accumulator acc with the cells in rows [row_start;row_stop[. Releases the GIL"""
+    data = data[row_start:row_stop]
+    labelled = labelled[row_start:row_stop]
+    if data.dtype not in (np.float32, np.float64, np.uint32):
+        data = data.astype(np.float64)
+    if labelled.dtype not in (np.uint8, np.uint16, np.uint32, np.int32, np.int64):
+        labelled = labelled.astype(np.int64)
+    _aggregate_rows_cython(data, labelled, row_start * labelled.shape[1], acc['min'], acc['max'], acc['sum'],
+                           acc['count'], acc['argmin'], acc['argmax'], flags)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def _aggregate_rows_cython(value_t[:, :] data, DTYPE_t_LABEL[:, :] labelled, np.int64_t offset,
+                           np.float64_t[:] lmin, np.float64_t[:] lmax, np.float64_t[:] lsum, np.int64_t[:] lcount,
+                           np.int64_t[:] largmin, np.int64_t[:] largmax, int flags):
+    cdef Py_ssize_t r, c
+    cdef Py_ssize_t rows = data.shape[0], cols = data.shape[1]
+    cdef np.float64_t val
+    cdef DTYPE_t_LABEL lbl
+    cdef bint do_min = flags & (1 | 16), do_max = flags & (2 | 32), do_sum = flags & 4, do_count = flags & 8
+
+    with nogil:
+        for r in range(rows):
+            for c in range(cols):
+                lbl = labelled[r, c]
+                val = data[r, c]
+                if do_count:
+                    lcount[lbl] += 1
+                if do_sum:
+                    lsum[lbl] += val
+                if do_min and val < lmin[lbl]:
+                    lmin[lbl] = val
+                    largmin[lbl] = offset + r * cols + c
+                if do_max and val > lmax[lbl]:
+                    lmax[lbl] = val
+                    largmax[lbl] = offset + r * cols + c
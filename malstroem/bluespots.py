@@ -14,11 +14,16 @@
 from __future__ import (absolute_import, division, print_function, unicode_literals)
 from builtins import *
 
-from .vector import transform_cell_to_world, vectorize_labels_file
+from .vector import transform_cells_to_world, vectorize_labels_file, simplify_geojson_features
 from .algorithms import label, flow, fill, speedups
 import numpy as np
 import logging
 
+# Stage-storage curves are written as strings in fields of this width (the maximum of a shapefile text field)
+CURVE_FIELD_WIDTH = 254
+# Most bins whose curves fit the field. A non-negative value formats to at most 11 characters plus a separator
+MAX_STAGE_BINS = (CURVE_FIELD_WIDTH + 1) // 12 - 1
+
 
 def filterbluespots(filterfunction, cell_area, raw_bluespot_stats):
     """Apply filter function to bluespots
@@ -26,7 +31,8 @@ def filterbluespots(filterfunction, cell_area, raw_bluespot_stats):
     Parameters
     ----------
     filterfunction : function
-        Filter function applied to each raw_bluespot_stat. Returns true if bluespot passes the filter.
+        Filter function applied to each raw_bluespot_stat. Returns true if bluespot passes the filter. If the function
+        has a true attribute `vectorized` it is called once with arrays of the stats of all bluespots instead.
     cell_area : number
         Area of the cell in sqaure meters
     raw_bluespot_stats : sequence of bluespot_stats
@@ -34,19 +40,101 @@ def filterbluespots(filterfunction, cell_area, raw_bluespot_stats):
 
     Returns
     -------
-    list of bool
+    ndarray of bool
         i'th element indicates if bluespot with id=i should be used.
     """
+    if getattr(filterfunction, 'vectorized', False):
+        stats = np.asarray(raw_bluespot_stats)
+        s_w_units = dict(min=stats['min'], max=stats['max'], sum=stats['sum'], count=stats['count'])
+        s_w_units['volume'] = stats['sum'] * cell_area
+        s_w_units['area'] = stats['count'] * cell_area
+        keepers = filterfunction(s_w_units)
+        return np.broadcast_to(np.asarray(keepers, dtype=bool), stats.shape).copy()
     keepers = []
     for s in raw_bluespot_stats:
         s_w_units = dict(min=s['min'], max=s['max'], sum=s['sum'], count=s['count'])
         s_w_units['volume'] = s['sum'] * cell_area
         s_w_units['area'] = s['count'] * cell_area
         keepers.append(filterfunction(s_w_units))
-    return keepers
+    return np.array(keepers, dtype=bool)
+
+
+def format_curve(values):
+    """Format a curve as a compact string of space separated numbers
+
+    Parameters
+    ----------
+    values : sequence of numbers
+        Curve values
+
+    Returns
+    -------
+    str
+        At most CURVE_FIELD_WIDTH characters
+    """
+    text = ' '.join('{:.6g}'.format(v) for v in values)
+    if len(text) > CURVE_FIELD_WIDTH:
+        raise ValueError("Curve of {} values does not fit in {} characters".format(len(values), CURVE_FIELD_WIDTH))
+    return text
+
+
+def check_stage_bins(bins):
+    """Check that stage-storage curves with this number of bins fit the vector fields
+
+    Parameters
+    ----------
+    bins : int
+        Number of water level steps. 0 or None for no curves
+
+    Raises
+    ------
+    ValueError
+        If bins is negative or larger than MAX_STAGE_BINS
+    """
+    if bins and not 0 < bins <= MAX_STAGE_BINS:
+        raise ValueError("Number of stage bins must be between 0 and {}. Got {}".format(MAX_STAGE_BINS, bins))
+
+
+def parse_curve(text):
+    """Parse a curve formatted by format_curve
+
+    Parameters
+    ----------
+    text : str
+        Space separated numbers
+
+    Returns
+    -------
+    ndarray
+        Curve values. Empty if text is None or empty
+    """
+    if not text:
+        return np.zeros(0, dtype=np.float64)
+    return np.array([float(v) for v in text.split()], dtype=np.float64)
+
+
+def stage_storage_curves(features):
+    """Read stage-storage curves from pour point or node features
+
+    Parameters
+    ----------
+    features : sequence of dict
+        Feature properties with the properties bspot_id, stage_h, stage_v and stage_a
+
+    Returns
+    -------
+    dict
+        Maps bspot_id to a tuple of arrays (stage, volume, area). Features without a curve are left out
+    """
+    curves = dict()
+    for f in features:
+        if f.get('bspot_id') is None or not f.get('stage_h'):
+            continue
+        curves[int(f['bspot_id'])] = (parse_curve(f['stage_h']), parse_curve(f['stage_v']), parse_curve(f['stage_a']))
+    return curves
 
 
-def assemble_pourpoints(transform, pp_pix, bluespot_stats, watershed_stats):
+def assemble_pourpoints(transform, pp_pix, bluespot_stats, watershed_stats, stage_storage=None):
     """Turn data info a list of pour point objects
 
     Parameters
@@ -60,6 +148,9 @@ def assemble_pourpoints(transform, pp_pix, bluespot_stats, watershed_stats):
         i'th element is a dict like objekt with stats for bluespot with id=i
     watershed_stats : list of watershed stats
         i'th element is a dict like objekt with stats for the watershed belonging to bluespot with id=i
+    stage_storage : tuple of ndarray, optional
+        Stage-storage curves (stage, count, volume) as returned by label.label_stage_storage. Row i belongs to
+        bluespot with id=i. Added to the pour points as the properties stage_h, stage_v and stage_a
 
     Returns
     -------
@@ -70,6 +161,8 @@ def assemble_pourpoints(transform, pp_pix, bluespot_stats, watershed_stats):
     cell_height = abs(transform[5])
     cell_area = cell_width * cell_height
 
+    coords = transform_cells_to_world(np.column_stack((pp_pix['row'], pp_pix['col'])), transform).tolist()
+
     pour_points = []
     for ix, stats in enumerate(zip(pp_pix, bluespot_stats, watershed_stats)):
         p = dict(bspot_id=ix, type="Feature")
@@ -80,9 +173,13 @@ def assemble_pourpoints(transform, pp_pix, bluespot_stats, watershed_stats):
         p['bspot_vol'] = stats[1]['sum'] * cell_area  # Bluespot volume
         p['wshed_area'] = stats[2] * cell_area  # Local bluespot watershed area
         p['bspot_fumm'] = 1000 * p['bspot_vol'] / p['wshed_area']  # mm rain to fill bluespot with water from local wshed
+        if stage_storage is not None:
+            stage, count, volume = (a[ix] for a in stage_storage)
+            p['stage_h'] = format_curve(stage)  # Water level above bluespot bottom
+            p['stage_v'] = format_curve(volume * cell_area)  # Stored volume at water level
+            p['stage_a'] = format_curve(count * cell_area)  # Flooded area at water level
 
-        coord = transform_cell_to_world((stats[0]['row'], stats[0]['col']), transform)
-        geom = dict(type='Point', coordinates=list(coord))
+        geom = dict(type='Point', coordinates=coords[ix])
         geojson = dict(id=ix, geometry=geom, properties=p)
         pour_points.append(geojson)
     return pour_points
@@ -97,8 +194,10 @@ class BluespotTool(object):
         Bluespot depths
     input_flowdir : rasterreader
         Flow directions encoded like Up=0, UpRight=1, ..., UpLeft=7, NoDirection=8
-    input_bluespot_filter_function : function
-        Filter function applied to each raw_bluespot_stat. Returns true if bluespot passes the filter.
+    input_bluespot_filter_function : function or list of functions
+        Filter function applied to each raw_bluespot_stat. Returns true if bluespot passes the filter. If a list of
+        filter functions is given, the unfiltered bluespots are calculated once and one set of outputs is written per
+        filter. The outputs must then be lists of writers of same length
     output_labeled_raster : rasterwriter
         Writes the resulting bluespot labels
     output_pourpoints : vectorwriter
@@ -113,12 +212,20 @@ class BluespotTool(object):
         Writes the vectorized bluespots
     output_watersheds_vector : vectorwriter, optional
         Writes the vectorized watersheds
+    simplify_tolerance : float, optional
+        Simplify vectorized bluespots and watersheds using this tolerance (in cells)
+    stage_storage_bins : int, optional
+        Number of water level steps in the stage-storage curves written with the pour points. 0 or None disables.
+        At most MAX_STAGE_BINS
+    threads : int, optional
+        Number of threads used for the pour point stats
     """
 
     def __init__(self, input_depths, input_flowdir, input_bluespot_filter_function,
                  output_labeled_raster, output_pourpoints, output_watersheds_raster,
                  input_accum=None, input_dem=None,
-                 output_labeled_vector=None, output_watersheds_vector=None):
+                 output_labeled_vector=None, output_watersheds_vector=None, simplify_tolerance=None,
+                 stage_storage_bins=None, threads=None):
         self.input_depths = input_depths
         self.input_flowdir = input_flowdir
         self.input_bluespot_filter_function = input_bluespot_filter_function
@@ -131,7 +238,12 @@ class BluespotTool(object):
         self.output_watersheds_raster = output_watersheds_raster
         self.output_watersheds_vector = output_watersheds_vector
 
+        self.simplify_tolerance = simplify_tolerance
+        self.stage_storage_bins = stage_storage_bins
+        self.threads = threads
+
         assert self.input_accum or self.input_dem, "Either input_dem or input_accum must be specified"
+        check_stage_bins(self.stage_storage_bins)
 
         self.logger = logging.getLogger(__name__)
 
@@ -155,62 +267,119 @@ class BluespotTool(object):
             self.logger.warning('Warning: Speedups are not available. If you have more than toy data you want them to be!')
 
         self.logger.info("Calculating unfiltered bluespots")
-        depths = self.input_depths.read()
-        raw_labeled, raw_nlabels = label.connected_components(depths)
-        raw_bluespot_stats = label.label_stats(depths, raw_labeled)
+        raw_labeled, raw_nlabels, raw_bluespot_stats, depths = self._label_depths()
+        if self.input_accum:
+            self.logger.info("Calculating pour points at max accumulated flow")
+            pour_data, pour_stats = self.input_accum.read(), ('max', 'argmax')
+        elif self.input_dem:
+            self.logger.info("Calculating pour points at min filled")
+            dem = self.input_dem.read()
+            short, diag = fill.minimum_safe_short_and_diag(dem)
+            pour_data, pour_stats = fill.fill_terrain_no_flats(dem, short, diag), ('min', 'argmin')
+            del dem
+        else:
+            raise Exception("Either accumulated flow or DEM must be present")
+        # Pour points of the unfiltered bluespots
+        raw_pour_stats, = label.label_aggregate(raw_labeled, [(pour_data, pour_stats)], raw_nlabels, self.threads)
         self.logger.info("Number of bluespots found before filtering: {}".format(raw_nlabels))
 
+        if isinstance(self.input_bluespot_filter_function, (list, tuple)):
+            filter_functions = self.input_bluespot_filter_function
+            outputs = [self.output_labeled_raster, self.output_labeled_vector, self.output_pourpoints,
+                       self.output_watersheds_raster, self.output_watersheds_vector]
+            outputs = [o if o is not None else [None] * len(filter_functions) for o in outputs]
+            assert all(len(o) == len(filter_functions) for o in outputs), "One output per filter function is needed"
+            output_sets = list(zip(*outputs))
+        else:
+            filter_functions = [self.input_bluespot_filter_function]
+            output_sets = [(self.output_labeled_raster, self.output_labeled_vector, self.output_pourpoints,
+                            self.output_watersheds_raster, self.output_watersheds_vector)]
+
+        flowdir = self.input_flowdir.read()
+        for filter_function, output_set in zip(filter_functions, output_sets):
+            self._process_filtered(filter_function, output_set, raw_labeled, raw_bluespot_stats, raw_pour_stats,
+                                   pour_data, pour_stats, depths, flowdir)
+
+        self.logger.info("Done")
+
+    def _label_depths(self):
+        """Label the unfiltered bluespots and calculate their stats reading the depths strip by strip
+
+        Returns
+        -------
+        raw_labeled : ndarray
+            Unfiltered bluespot labels
+        raw_nlabels : int
+            Number of unfiltered bluespots
+        raw_bluespot_stats : ndarray
+            Depth stats ('min', 'max', 'sum', 'count') of each unfiltered bluespot
+        depths : ndarray or None
+            Depths. Only kept when stage-storage curves are calculated
+        """
+        rows, cols = self.input_depths.shape
+        kept = {}
+
+        def read_strip(row_off, strip_rows):
+            data = self.input_depths.read_block(row_off, 0, strip_rows, cols)
+            if self.stage_storage_bins:
+                if 'depths' not in kept:
+                    kept['depths'] = np.empty((rows, cols), dtype=data.dtype)
+                kept['depths'][row_off:row_off + strip_rows] = data
+            return data
+
+        raw_labeled, raw_nlabels, raw_bluespot_stats = label.connected_components_tiled(
+            read_strip, (rows, cols), statistics=('min', 'max', 'sum', 'count'))
+        return raw_labeled, raw_nlabels, raw_bluespot_stats, kept.get('depths')
+
+    def _process_filtered(self, filter_function, outputs, raw_labeled, raw_bluespot_stats, raw_pour_stats,
+                          pour_data, pour_stats, depths, flowdir):
+        """Filter the unfiltered bluespots and write bluespots, watersheds and pour points for the kept ones"""
+        (output_labeled_raster, output_labeled_vector, output_pourpoints,
+         output_watersheds_raster, output_watersheds_vector) = outputs
+        transform = self.input_depths.transform
+        cell_width = abs(transform[1])
+        cell_area = cell_width * abs(transform[5])
+
         self.logger.info("Calculating filtered bluespots")
         # Run filter function and get list of bools indicating which labels to keep
-        keepers = filterbluespots(self.input_bluespot_filter_function, cell_area, raw_bluespot_stats)
-
-        new_components = label.keep_labels(raw_labeled, keepers)
-        del raw_labeled
-        # Filtered bluespots
-        labeled, nlabels = label.connected_components(new_components)
-        # Recalculate stats on filtered bluespots
-        bluespot_stats = label.label_stats(depths, labeled)
-        del depths
+        keepers = filterbluespots(filter_function, cell_area, raw_bluespot_stats)
+
+        # Filtering removes whole bluespots. So filtered bluespots and their stats are derived from the unfiltered
+        labeled, nlabels = label.compact_labels(raw_labeled, keepers)
+        bluespot_stats = label.compact_aggregates(raw_bluespot_stats, keepers)
+        pp_pix = label.index_records(pour_data, label.compact_aggregates(raw_pour_stats, keepers)[pour_stats[1]])
+        stage_storage = None
+        if self.stage_storage_bins:
+            self.logger.info("Calculating stage-storage curves")
+            stage_storage = label.label_stage_storage(depths, labeled, bluespot_stats['max'], self.stage_storage_bins)
         self.logger.info("Number of bluespots left after filtering: {}".format(nlabels))
-        self.output_labeled_raster.write(labeled)
+        output_labeled_raster.write(labeled)
 
-        if self.output_labeled_vector:
+        if output_labeled_vector:
             self.logger.info("Vectorizing bluespots")
-            result = vectorize_labels_file(self.output_labeled_raster.filepath)
-            self.output_labeled_vector.write_geojson_features(result)
+            result = vectorize_labels_file(output_labeled_raster.filepath)
+            if self.simplify_tolerance is not None:
+                result = simplify_geojson_features(result, self.simplify_tolerance * cell_width)
+            output_labeled_vector.write_geojson_features(result)
 
         self.logger.info("Calculating watersheds")
-        watersheds = np.copy(labeled)
-        flowdir = self.input_flowdir.read()
+        # Watersheds grow from the bluespots which are not needed anymore
+        watersheds = labeled
+        del labeled
         flow.watersheds_from_labels(flowdir, watersheds, unassigned=0)
         watershed_stats = label.label_count(watersheds)
-        if self.output_watersheds_raster:
-            self.output_watersheds_raster.write(watersheds)
+        if output_watersheds_raster:
+            output_watersheds_raster.write(watersheds)
             del watersheds
-        if self.output_watersheds_vector:
+        if output_watersheds_vector:
             self.logger.info("Vectorizing watersheds")
-            result = vectorize_labels_file(self.output_watersheds_raster.filepath)
-            self.output_watersheds_vector.write_geojson_features(result)
-
-        if self.input_accum:
-            self.logger.info("Calculating pour points at max accumulated flow")
-            accum = self.input_accum.read()
-            pp_pix = label.label_max_index(accum, labeled, nlabels)
-            del accum
-        elif self.input_dem:
-            self.logger.info("Calculating pour points at min filled")
-            dem = self.input_dem.read()
-            short, diag = fill.minimum_safe_short_and_diag(dem)
-            filled_no_flats = fill.fill_terrain_no_flats(dem, short, diag)
-            pp_pix = label.label_min_index(filled_no_flats, labeled, nlabels)
-            del filled_no_flats
-        else:
-            raise Exception("Either accumulated flow or DEM must be present")
+            result = vectorize_labels_file(output_watersheds_raster.filepath)
+            if self.simplify_tolerance is not None:
+                result = simplify_geojson_features(result, self.simplify_tolerance * cell_width)
+            output_watersheds_vector.write_geojson_features(result)
 
         self.logger.info("Writing {} pour points".format(len(pp_pix)))
         # Put together info about pourpoints
-        pour_points = assemble_pourpoints(transform, pp_pix, bluespot_stats, watershed_stats)
+        pour_points = assemble_pourpoints(transform, pp_pix, bluespot_stats, watershed_stats, stage_storage)
         feature_collection = dict(type="FeatureCollection", features=pour_points)
-        self.output_pourpoints.write_geojson_features(feature_collection)
-
-        self.logger.info("Done")
+        output_pourpoints.write_geojson_features(feature_collection)
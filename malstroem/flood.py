@@ -0,0 +1,133 @@
+# coding=utf-8
+# -------------------------------------------------------------------------------------------------
+# Copyright (c) 2016
+# Developed by Septima.dk and Thomas Balstrøm (University of Copenhagen) for the Danish Agency for
+# Data Supply and Efficiency. This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the Free Software Foundation,
+# either version 2 of the License, or (at you option) any later version.
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PORPOSE. See the GNU Gene-
+# ral Public License for more details.
+# You should have received a copy of the GNU General Public License along with this program. If not,
+# see http://www.gnu.org/licenses/.
+# -------------------------------------------------------------------------------------------------
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+from builtins import *
+
+import numpy as np
+
+
+def stage_storage_table(curves, nlabels):
+    """Collect stage-storage curves in arrays indexed by bluespot id
+
+    Parameters
+    ----------
+    curves : dict
+        Maps bspot_id to a tuple of arrays (stage, volume, area) as returned by bluespots.stage_storage_curves
+    nlabels : int
+        Number of rows in the output. Must be larger than the largest bspot_id
+
+    Returns
+    -------
+    stage : ndarray
+        Water levels of shape (nlabels, n). Curves shorter than n are padded with their last value
+    volume : ndarray
+        Stored volume at each water level
+    area : ndarray
+        Flooded area at each water level
+    has_curve : ndarray
+        True for the rows which have a curve
+
+    Raises
+    ------
+    ValueError
+        If the stage, volume and area of a curve differ in length
+    """
+    npoints = max([len(c[0]) for c in curves.values()] or [1])
+    table = np.zeros((3, nlabels, npoints), dtype=np.float64)
+    has_curve = np.zeros((nlabels,), dtype=bool)
+    for bspot_id, curve in curves.items():
+        if len(set(len(values) for values in curve)) > 1:
+            raise ValueError("Stage-storage curve of bluespot {} has stage, volume and area of different lengths: {}"
+                             .format(bspot_id, [len(values) for values in curve]))
+        if len(curve[0]) == 0 or bspot_id >= nlabels:
+            continue
+        for values, row in zip(curve, table[:, bspot_id]):
+            row[:len(values)] = values
+            row[len(values):] = values[-1]
+        has_curve[bspot_id] = True
+    return table[0], table[1], table[2], has_curve
+
+
+def water_levels(stage, volume, area, v):
+    """Invert stage-storage curves to get the water level of each bluespot from its stored volume
+
+    Between two sampled water levels the flooded area is assumed to grow linearly, so the volume is a quadratic in the
+    water level which matches the sampled volumes at both ends. A stored volume exceeding the capacity gives the top
+    water level.
+
+    Parameters
+    ----------
+    stage : ndarray
+        Water levels of shape (n, k) with one increasing curve per row
+    volume : ndarray
+        Stored volume at each water level. Same shape as stage
+    area : ndarray
+        Flooded area at each water level. Same shape as stage
+    v : array_like
+        Stored volume for each row
+
+    Returns
+    -------
+    ndarray
+        Water level above the bluespot bottom for each row
+    """
+    v = np.asarray(v, dtype=np.float64)
+    rows = np.arange(len(v))
+    npoints = stage.shape[1]
+    if npoints < 2:
+        return np.zeros(len(v), dtype=np.float64)
+    # Index of first sampled volume not below v. Curves are sorted so counting the smaller ones gives it
+    upper = np.clip(np.sum(volume < v[:, np.newaxis], axis=1), 1, npoints - 1)
+    lower = upper - 1
+    v0, v1 = volume[rows, lower], volume[rows, upper]
+    h0, h1 = stage[rows, lower], stage[rows, upper]
+    a0 = area[rows, lower]
+    dh = h1 - h0
+    dv = np.clip(v - v0, 0, v1 - v0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # v0 + a0 * t + c * t**2 passes through (h0, v0) and (h1, v1)
+        c = np.maximum((v1 - v0 - a0 * dh) / dh ** 2, 0)
+        denom = a0 + np.sqrt(a0 ** 2 + 4 * c * dv)
+        t = np.where(denom > 0, 2 * dv / denom, np.where(v1 > v0, dv / (v1 - v0) * dh, dh))
+    levels = h0 + np.minimum(np.nan_to_num(t), dh)
+    return np.where(v > 0, levels, 0.0)
+
+
+def flood_depths(labels, depths, levels, maxdepth, valid, nodata):
+    """Water depth of each cell for given bluespot water levels
+
+    A cell is flooded when the water level of its bluespot exceeds the height of the cell above the bluespot bottom.
+
+    Parameters
+    ----------
+    labels : ndarray
+        Bluespot ids. Must be valid indexes into levels, maxdepth and valid
+    depths : ndarray
+        Bluespot depths of same shape as labels
+    levels : ndarray
+        Water level above bottom for each bluespot id
+    maxdepth : ndarray
+        Max depth for each bluespot id
+    valid : ndarray
+        True for the bluespot ids which get a water depth. Cells of other ids get nodata
+    nodata : number
+        Value for cells outside valid bluespots
+
+    Returns
+    -------
+    ndarray
+        float32 water depths of same shape as labels
+    """
+    water = np.maximum(levels[labels] - (maxdepth[labels] - depths), 0)
+    return np.where(valid[labels], water, nodata).astype(np.float32)
@@ -16,6 +16,9 @@ from builtins import *
 from osgeo import gdal, ogr, osr
 import numpy as np
 import json
+import csv
+
+from .network import save_network, load_network
 
 
 class RasterReader(object):
@@ -47,6 +50,8 @@ class RasterReader(object):
         Raster dataset nodata value
     nodatasubst : float or None
         Value used to replace nodata values in the raster dataset
+    shape : tuple
+        Number of rows and columns in the raster
     """
 
     def __init__(self, filepath, nodatasubst=None):
@@ -57,6 +62,7 @@ class RasterReader(object):
         self.crs = self._ds.GetProjection()
         self.nodata = self._bnd.GetNoDataValue()
         self.nodatasubst = nodatasubst
+        self.shape = (self._ds.RasterYSize, self._ds.RasterXSize)
 
     def read(self):
         """Read raster into 2D numpy array
@@ -65,7 +71,42 @@ class RasterReader(object):
         -------
         ndarray
         """
-        data = self._bnd.ReadAsArray()
+        return self._substitute_nodata(self._bnd.ReadAsArray())
+
+    def read_block(self, row_off, col_off, rows, cols):
+        """Read a block of the raster into 2D numpy array
+
+        Parameters
+        ----------
+        row_off, col_off : int
+            Row and column of the upper left cell of the block
+        rows, cols : int
+            Size of the block
+
+        Returns
+        -------
+        ndarray
+        """
+        return self._substitute_nodata(self._bnd.ReadAsArray(col_off, row_off, cols, rows))
+
+    def iter_blocks(self, block_rows=256):
+        """Read the raster as blocks of full rows
+
+        Parameters
+        ----------
+        block_rows : int, optional
+            Number of rows in each block
+
+        Returns
+        -------
+        generator
+            (row_off, data) for each block from the top of the raster
+        """
+        rows, cols = self.shape
+        for row_off in range(0, rows, block_rows):
+            yield row_off, self.read_block(row_off, 0, min(block_rows, rows - row_off), cols)
+
+    def _substitute_nodata(self, data):
         if self.nodata and self.nodatasubst is not None:
             mask = np.isnan(data) if np.isnan(self.nodata) else np.isclose(data, self.nodata)
             data[mask] = self.nodatasubst
@@ -112,6 +153,8 @@ class RasterWriter(object):
         self.options = dict(tiled='yes', compress='deflate', bigtiff='if_safer')
         self.datatype = None
         self.nodata = nodata
+        self._ds = None
+        self._bnd = None
 
     def write(self, data):
         """Write numpy data to file
@@ -124,25 +167,48 @@ class RasterWriter(object):
         -------
         None
 
+        """
+        self.create(data.shape, data.dtype)
+        self.write_block(data, 0, 0)
+        self.close()
+
+    def create(self, shape, dtype):
+        """Create the output file for writing block by block using write_block
+
+        Parameters
+        ----------
+        shape : tuple
+            Number of rows and columns
+        dtype : numpy dtype
+            Datatype of the data to be written
+
+        Returns
+        -------
+        None
         """
         if not self.datatype:
-            if data.dtype == np.float64:
-                self.datatype = gdal.GDT_Float64
-            elif data.dtype == np.float32:
-                self.datatype = gdal.GDT_Float32
-                self.options['predictor'] = 2
-            elif data.dtype == np.int32:
-                self.datatype = gdal.GDT_Int32
-                self.options['predictor'] = 2
-            elif data.dtype == np.uint8:
-                self.datatype = gdal.GDT_Byte
+            dtype = np.dtype(dtype)
+            gdal_types = {
+                np.dtype(np.float64): gdal.GDT_Float64,
+                np.dtype(np.float32): gdal.GDT_Float32,
+                np.dtype(np.int32): gdal.GDT_Int32,
+                np.dtype(np.uint32): gdal.GDT_UInt32,
+                np.dtype(np.int16): gdal.GDT_Int16,
+                np.dtype(np.uint16): gdal.GDT_UInt16,
+                np.dtype(np.uint8): gdal.GDT_Byte,
+            }
+            if hasattr(gdal, 'GDT_Int64'):
+                # GDAL >= 3.5
+                gdal_types[np.dtype(np.int64)] = gdal.GDT_Int64
+            if dtype not in gdal_types:
+                raise NotImplementedError("Cannot determine GDAL datatype for numpy datatype {}".format(dtype))
+            self.datatype = gdal_types[dtype]
+            if dtype != np.float64:
                 self.options['predictor'] = 2
-            else:
-                raise NotImplementedError("Cannot determine GDAL datatype for numpy datatype {}".format(data.dtype))
 
         drv = gdal.GetDriverByName(self.driver)
         opts = ["{}={}".format(k, v) for k, v in self.options.items()]
-        outds = drv.Create(self.filepath, data.shape[1], data.shape[0], 1, self.datatype, opts)
+        outds = drv.Create(self.filepath, shape[1], shape[0], 1, self.datatype, opts)
 
         assert outds is not None, "Could not create output dataset {}".format(self.filepath)
 
@@ -154,9 +220,31 @@ class RasterWriter(object):
         outbnd = outds.GetRasterBand(1)
         if self.nodata is not None:
             outbnd.SetNoDataValue(self.nodata)
-        outbnd.WriteArray(data, 0, 0)
-        outds.FlushCache()
-        outds = None
+        self._ds = outds
+        self._bnd = outbnd
+
+    def write_block(self, data, row_off, col_off=0):
+        """Write a block of numpy data to the file created by create
+
+        Parameters
+        ----------
+        data : 2D numpy array
+            Block data
+        row_off, col_off : int
+            Row and column of the upper left cell of the block
+
+        Returns
+        -------
+        None
+        """
+        self._bnd.WriteArray(data, col_off, row_off)
+
+    def close(self):
+        """Flush and close the file created by create"""
+        if self._ds is not None:
+            self._ds.FlushCache()
+        self._bnd = None
+        self._ds = None
 
 
 class VectorWriter(object):
@@ -247,6 +335,10 @@ class VectorWriter(object):
         featuredefn = ogrfeature.GetDefnRef()
         for ix in range(featuredefn.GetFieldCount()):
             fielddefn = featuredefn.GetFieldDefn(ix)
+            if fielddefn.GetType() == ogr.OFTString and fielddefn.GetWidth() == 0:
+                # Some drivers (like shapefile) truncate strings of unspecified width to 80 characters
+                fielddefn = ogr.FieldDefn(fielddefn.GetName(), ogr.OFTString)
+                fielddefn.SetWidth(254)
             self.fields.append(fielddefn)
         for f in self.fields:
             self._lyr.CreateField(f)
@@ -363,3 +455,194 @@ class VectorReader(object):
         while f:
             yield f
             f = self._lyr.GetNextFeature()
+
+
+class NetworkWriter(object):
+    """Write nodes and their stream network to a binary network file (.npz)
+
+    Parameters
+    ----------
+    filepath : str
+        Path to the network file
+    crs : str
+        Well Known Text (WKT) representation of the coordinate reference system
+
+    Attributes
+    ----------
+    filepath : str
+        Path to the network file
+    crs : str
+        Well Known Text (WKT) representation of the coordinate reference system
+    """
+
+    def __init__(self, filepath, crs):
+        self.filepath = filepath
+        self.crs = crs
+
+    def write_geojson_features(self, geojsonfeatures):
+        """Write nodes
+
+        Parameters
+        ----------
+        geojsonfeatures : sequence
+            Geojson formatted point features of the nodes
+
+        Returns
+        -------
+        None
+        """
+        save_network(self.filepath, geojsonfeatures, self.crs)
+
+
+class NetworkReader(object):
+    """Read nodes and their stream network from a binary network file (.npz)
+
+    Parameters
+    ----------
+    filepath : str
+        Path to the network file
+
+    Attributes
+    ----------
+    filepath : str
+        Path to the network file
+    crs : str
+        Well Known Text (WKT) representation of the coordinate reference system
+    """
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self._network, self._features, self.crs = load_network(filepath)
+
+    def read_network(self):
+        """Read the stream network
+
+        Returns
+        -------
+        NetworkArrays
+            Network with precomputed topological order. Nodes are in the order of read_geojson_features
+        """
+        return self._network
+
+    def read_geojson_features(self):
+        """Read all nodes formatted as geojson
+
+        Feature dicts are built when they are accessed. Property columns are available from `column` and `records`.
+
+        Returns
+        -------
+        features : NodeFeatures
+            Sequence of geojson formatted features
+        """
+        return self._features
+
+
+class EventTableWriter(object):
+    """Write rain event data in long format to a CSV file. One row per node and event
+
+    Rows are formatted and written in blocks of nodes, so memory use does not grow with the size of the table.
+
+    Parameters
+    ----------
+    filepath : str
+        Path to the CSV file
+    float_format : str, optional
+        Format of float values
+    block_nodes : int, optional
+        Number of nodes formatted and written at a time
+
+    Attributes
+    ----------
+    filepath : str
+        Path to the CSV file
+    """
+
+    def __init__(self, filepath, float_format='%.10g', block_nodes=10000):
+        self.filepath = filepath
+        self.float_format = float_format
+        self.block_nodes = block_nodes
+
+    def write_events(self, nodeids, events, event_columns, node_columns=None):
+        """Write event data
+
+        Parameters
+        ----------
+        nodeids : 1D array
+            Node ids
+        events : list of str
+            Event names
+        event_columns : dict
+            Maps a column name to an array of shape (n_nodes, n_events). NaN is written as an empty value
+        node_columns : dict, optional
+            Maps a column name to an array of shape (n_nodes,) which is repeated for each event
+
+        Returns
+        -------
+        None
+        """
+        nodeids = np.asarray(nodeids)
+        events = [str(e) for e in events]
+        num_events = len(events)
+        event_columns = [(name, np.asarray(values, dtype=np.float64)) for name, values in event_columns.items()]
+        node_columns = [(name, np.asarray(values, dtype=np.float64)) for name, values in (node_columns or {}).items()]
+        names = ['nodeid', 'event'] + [name for name, _ in event_columns] + [name for name, _ in node_columns]
+        with open(self.filepath, 'w', newline='') as f:
+            writer = csv.writer(f, lineterminator='\n')
+            writer.writerow(names)
+            for start in range(0, len(nodeids), self.block_nodes):
+                block = slice(start, start + self.block_nodes)
+                num_nodes = len(nodeids[block])
+                columns = [np.repeat(nodeids[block], num_events).tolist(), events * num_nodes]
+                columns.extend(self._format(values[block].ravel()) for _, values in event_columns)
+                columns.extend([v for v in self._format(values[block]) for _ in range(num_events)]
+                               for _, values in node_columns)
+                writer.writerows(zip(*columns))
+
+    def _format(self, values):
+        float_format = self.float_format
+        return ['' if v != v else float_format % v for v in values.tolist()]
+
+
+class EventArrayWriter(object):
+    """Write rain event data as dense arrays to a binary .npz file
+
+    The file holds nodeid (n_nodes), event (n_events), an array of shape (n_nodes, n_events) for each event column and
+    an array of shape (n_nodes,) for each node column.
+
+    Parameters
+    ----------
+    filepath : str
+        Path to the .npz file
+
+    Attributes
+    ----------
+    filepath : str
+        Path to the .npz file
+    """
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+
+    def write_events(self, nodeids, events, event_columns, node_columns=None):
+        """Write event data
+
+        Parameters
+        ----------
+        nodeids : 1D array
+            Node ids
+        events : list of str
+            Event names
+        event_columns : dict
+            Maps a column name to an array of shape (n_nodes, n_events)
+        node_columns : dict, optional
+            Maps a column name to an array of shape (n_nodes,)
+
+        Returns
+        -------
+        None
+        """
+        data = dict(event_columns)
+        data.update(node_columns or {})
+        data['nodeid'] = np.asarray(nodeids)
+        data['event'] = np.array([str(e) for e in events])
+        np.savez(self.filepath, **data)
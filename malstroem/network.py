@@ -14,7 +14,771 @@
 from __future__ import (absolute_import, division, print_function, unicode_literals)
 from builtins import *
 
-from collections import defaultdict, deque
+from collections import defaultdict
+import heapq
+import multiprocessing
+
+import numpy as np
+
+from .algorithms.dtypes import label_dtype
+
+# Largest number of percent filled histogram bins per node in ensemble statistics from the command line
+MAX_ENSEMBLE_BINS = 100
+
+
+class NetworkArrays(object):
+    """Compact array representation of a stream network.
+
+    Nodes are identified by their index in the arrays. The network is evaluated one level at a time from the leaves
+    towards the roots using NumPy operations on all nodes of a level at once.
+
+    Parameters
+    ----------
+    nodeids : array_like
+        Id of each node
+    downstream : array_like
+        Index of the downstream node of each node. -1 if the node does not have a downstream node
+    wshed_area : array_like
+        Area of the local watershed of each node in square meters
+    bspot_vol : array_like
+        Bluespot capacity of each node in cubic meters
+
+    Attributes
+    ----------
+    nodeids : 1D array
+        Id of each node
+    downstream : 1D array
+        Index of the downstream node of each node. -1 for root nodes
+    wshed_area : 1D array
+        Area of the local watershed of each node in square meters
+    bspot_vol : 1D array
+        Bluespot capacity of each node in cubic meters
+    upstream_ptr : 1D array
+        Nodes one step upstream of node i are upstream[upstream_ptr[i]:upstream_ptr[i+1]]
+    upstream : 1D array
+        Indexes of upstream nodes ordered by downstream node
+    order : 1D array
+        Node indexes ordered from leaves to roots
+    level_ptr : 1D array
+        Nodes order[level_ptr[l]:level_ptr[l+1]] only have upstream nodes in levels before l
+    """
+
+    def __init__(self, nodeids, downstream, wshed_area, bspot_vol):
+        self.nodeids = np.asarray(nodeids, dtype=np.int64)
+        self.downstream = np.asarray(downstream, dtype=np.int64)
+        self.wshed_area = np.asarray(wshed_area, dtype=np.float64)
+        self.bspot_vol = np.asarray(bspot_vol, dtype=np.float64)
+
+        # CSR index of upstream nodes
+        num_nodes = len(self.nodeids)
+        has_downstream = np.nonzero(self.downstream >= 0)[0]
+        self.upstream = has_downstream[np.argsort(self.downstream[has_downstream], kind='mergesort')]
+        self.upstream_ptr = np.zeros((num_nodes + 1,), dtype=np.int64)
+        np.cumsum(np.bincount(self.downstream[has_downstream], minlength=num_nodes), out=self.upstream_ptr[1:])
+
+        self.order, self.level_ptr = self._leaves_to_roots()
+        self._level_routing = None
+
+    @classmethod
+    def from_nodes(cls, nodes):
+        """Create from a sequence of nodes
+
+        Parameters
+        ----------
+        nodes : sequence of dict
+            Nodes with the properties nodeid, dstrnodeid, wshed_area and bspot_vol
+
+        Returns
+        -------
+        NetworkArrays
+        """
+        nodeids = np.array([n['nodeid'] for n in nodes], dtype=np.int64)
+        downstream_ids = np.array([-1 if n['dstrnodeid'] is None else n['dstrnodeid'] for n in nodes], dtype=np.int64)
+        wshed_area = np.array([n['wshed_area'] for n in nodes], dtype=np.float64)
+        bspot_vol = np.array([n['bspot_vol'] for n in nodes], dtype=np.float64)
+        return cls(nodeids, cls._ids_to_indexes(nodeids, downstream_ids), wshed_area, bspot_vol)
+
+    @staticmethod
+    def _ids_to_indexes(nodeids, ids):
+        """Index of each id in nodeids. -1 if not found."""
+        if len(np.unique(nodeids)) < len(nodeids):
+            raise Exception("Node ids must be unique")
+        if not len(nodeids):
+            return np.full(np.shape(ids), -1, dtype=np.int64)
+        sorter = np.argsort(nodeids)
+        pos = np.searchsorted(nodeids, ids, sorter=sorter)
+        indexes = sorter[np.minimum(pos, len(nodeids) - 1)]
+        return np.where(nodeids[indexes] == ids, indexes, -1)
+
+    def __len__(self):
+        return len(self.nodeids)
+
+    def index(self, nodeids):
+        """Return index of each of the specified node ids. -1 if the node id is unknown"""
+        return self._ids_to_indexes(self.nodeids, np.asarray(nodeids, dtype=np.int64))
+
+    def _leaves_to_roots(self):
+        num_nodes = len(self.nodeids)
+        remaining = np.diff(self.upstream_ptr)
+        levels = []
+        level = np.nonzero(remaining == 0)[0]
+        while len(level):
+            levels.append(level)
+            down = self.downstream[level]
+            down, counts = np.unique(down[down >= 0], return_counts=True)
+            remaining[down] -= counts
+            level = down[remaining[down] == 0]
+        order = np.concatenate(levels) if levels else np.zeros((0,), dtype=np.int64)
+        if len(order) < num_nodes:
+            raise Exception("Stream network contains cycles")
+        level_ptr = np.cumsum([0] + [len(l) for l in levels])
+        return order, level_ptr
+
+    def rain_event(self, mmrain):
+        """Calculate one or more rain events evenly distributed across the entire area
+
+        All events are evaluated in a single traversal of the network.
+
+        Parameters
+        ----------
+        mmrain : float or sequence of float
+            Amount of rain in mm. A sequence for multiple events
+
+        Returns
+        -------
+        event : dict of arrays
+            nodeid, rainv (water vol from local catchment), spillv (water vol spilled from pourpoint), v (water vol in
+            bluespot) and pctv (percent filled. NaN if bluespot has no capacity). Values have shape (n_nodes,) for a
+            single event and (n_nodes, n_events) for a sequence of events
+        """
+        mmrain = np.asarray(mmrain, dtype=np.float64)
+        if mmrain.ndim > 1:
+            raise ValueError("Rain must be a scalar or a 1D sequence")
+        rainv = np.multiply.outer(self.wshed_area, mmrain * 0.001)
+        return self.route(rainv)
+
+    def rain_response(self):
+        """Calculate piecewise-linear rain response curves for all nodes
+
+        The curves are calculated one level of the network at a time from the leaves to the roots. The breakpoints of a
+        node are the rain depths at which an upstream node starts to spill plus the breakpoints of the upstream nodes
+        above that depth. The slope of a curve changes only at its breakpoints, so the curves of all nodes in a level
+        are found by sorting the slope changes contributed by their upstream nodes and integrating.
+
+        Returns
+        -------
+        RainResponse
+        """
+        num_nodes = len(self)
+        rain_to_vol = self.wshed_area * 0.001
+        capacity = self.bspot_vol
+        spill_mm = np.full((num_nodes,), np.inf)
+        # Curves are appended level by level. Curve of node i is start[i]:start[i] + length[i]
+        start = np.zeros((num_nodes,), dtype=np.int64)
+        length = np.zeros((num_nodes,), dtype=np.int64)
+        buffers = [np.zeros((max(num_nodes, 1),)) for _ in range(3)]
+        size = 0
+        num_upstream = np.diff(self.upstream_ptr)
+        for l in range(len(self.level_ptr) - 1):
+            nodes = self.order[self.level_ptr[l]:self.level_ptr[l + 1]]
+            x_buf, _, slope_buf = buffers
+
+            # Upstream nodes which spill. owner is the position in nodes of their downstream node
+            owner, ix = _segment_indexes(self.upstream_ptr[nodes], num_upstream[nodes])
+            upstream = self.upstream[ix]
+            spills = np.isfinite(spill_mm[upstream])
+            owner, upstream = owner[spills], upstream[spills]
+            s = spill_mm[upstream]
+
+            # All breakpoints of the spilling upstream nodes
+            k_owner, k = _segment_indexes(start[upstream], length[upstream])
+            above = x_buf[k] > s[k_owner]
+            # Slope of the segment where each upstream node starts to spill
+            at_spill = start[upstream] + np.bincount(k_owner, weights=~above,
+                                                     minlength=len(upstream)).astype(np.int64) - 1
+            # The first breakpoint is at 0 and never above the spill depth, so k - 1 is in the same curve
+            k = k[above]
+
+            # Slope changes (owner, x, change). Own rain from 0, spill from the spill depth, then upstream changes
+            event_owner = np.concatenate((np.arange(len(nodes)), owner, owner[k_owner[above]]))
+            event_x = np.concatenate((np.zeros((len(nodes),)), s, x_buf[k]))
+            event_change = np.concatenate((rain_to_vol[nodes], slope_buf[at_spill], slope_buf[k] - slope_buf[k - 1]))
+            sort = np.lexsort((event_x, event_owner))
+            event_owner, event_x, event_change = event_owner[sort], event_x[sort], event_change[sort]
+            first = np.ones((len(sort),), dtype=bool)
+            first[1:] = (event_owner[1:] != event_owner[:-1]) | (event_x[1:] != event_x[:-1])
+            groups = np.flatnonzero(first)
+            x_owner, x = event_owner[groups], event_x[groups]
+            change = np.add.reduceat(event_change, groups)
+            owner_first = np.ones((len(groups),), dtype=bool)
+            owner_first[1:] = x_owner[1:] != x_owner[:-1]
+            owner_start = np.flatnonzero(owner_first)
+            counts = np.diff(np.append(owner_start, len(groups)))
+
+            # Integrate within each curve from 0 inflow at 0 rain. Slopes never decrease. Guard against rounding
+            slope = np.maximum(_segment_cumsum(change, owner_start, counts), 0)
+            area = np.zeros((len(x),))
+            area[1:] = slope[:-1] * np.diff(x)
+            area[owner_start] = 0
+            y = _segment_cumsum(area, owner_start, counts)
+
+            # Rain depth where the inflow exceeds the capacity
+            last = owner_start + counts - 1
+            below = owner_start + np.bincount(x_owner, weights=y <= capacity[nodes][x_owner],
+                                              minlength=len(nodes)).astype(np.int64) - 1
+            exceeded = below < owner_start
+            below = np.maximum(below, owner_start)
+            never = (below == last) & (slope[last] <= 0)
+            level_spill = x[below] + (capacity[nodes] - y[below]) / np.where(never | exceeded, 1, slope[below])
+            level_spill[never] = np.inf
+            level_spill[exceeded] = 0
+            spill_mm[nodes] = level_spill
+
+            if size + len(x) > len(x_buf):
+                buffers = [np.concatenate((b[:size], np.zeros((max(len(x_buf), len(x)),)))) for b in buffers]
+            for b, values in zip(buffers, (x, y, slope)):
+                b[size:size + len(x)] = values
+            start[nodes] = size + owner_start
+            length[nodes] = counts
+            size += len(x)
+
+        # Curves in node order
+        ptr = np.zeros((num_nodes + 1,), dtype=np.int64)
+        np.cumsum(length, out=ptr[1:])
+        _, ix = _segment_indexes(start, length)
+        x, y, slope = (b[ix] for b in buffers)
+
+        inflow_mm = np.full((num_nodes,), np.inf)
+        has_down = self.downstream >= 0
+        np.minimum.at(inflow_mm, self.downstream[has_down], spill_mm[has_down])
+        return RainResponse(self.nodeids, capacity, self.wshed_area, ptr, x, y, slope, spill_mm, inflow_mm)
+
+    def _levels(self):
+        """Level slices of nodes in leaves-to-root order with downstream positions prepared for bincount
+
+        Built on first use.
+        """
+        if self._level_routing is None:
+            position = np.empty_like(self.order)
+            position[self.order] = np.arange(len(self.order))
+            downstream = self.downstream[self.order]
+            downstream = np.where(downstream >= 0, position[np.maximum(downstream, 0)], -1)
+            self._level_routing = []
+            for l in range(len(self.level_ptr) - 1):
+                level = slice(self.level_ptr[l], self.level_ptr[l + 1])
+                down = downstream[level]
+                has_down = np.nonzero(down >= 0)[0]
+                targets, inverse = np.unique(down[has_down], return_inverse=True)
+                self._level_routing.append((level, has_down, targets, inverse))
+        return self._level_routing
+
+    def simulate(self, hyetograph, timestep=1.0, max_outflow=None, timeseries=False):
+        """Simulate filling and spilling of the bluespots over time
+
+        In each time step the rain of the step is added to the local watershed of each node and routed through the
+        network from the leaves to the roots. A bluespot spills when it is full. If the outflow of a pour point is
+        limited, water which can not leave the bluespot is stored above its capacity until the following time steps.
+
+        Parameters
+        ----------
+        hyetograph : array_like
+            Rain in mm for each time step. Either 1D with rain evenly distributed across the entire area or 2D with
+            shape (n_nodes, n_steps) giving the rain in each local watershed
+        timestep : float, optional
+            Duration of a time step. Times in the result are in the same unit
+        max_outflow : float or array_like, optional
+            Maximum outflow rate from the pour point of each node in cubic meters per time unit. NaN or inf for
+            unlimited outflow. Default is unlimited outflow everywhere
+        timeseries : bool, optional
+            Include the stored volume and spilled volume of each node in each time step in the result
+
+        Returns
+        -------
+        result : dict of arrays
+            One value per node. nodeid, v (water vol stored at the end of the simulation), peak_v (max water vol
+            stored), peak_time (time when peak_v was first reached), first_spill_time (end time of the first time step
+            with spill. NaN if the node never spills), peak_spillv (max water vol spilled in a single time step) and
+            total_spillv (total water vol spilled). If timeseries is True also v_t and spillv_t with shape
+            (n_nodes, n_steps)
+        """
+        num_nodes = len(self)
+        hyetograph = np.asarray(hyetograph)
+        if hyetograph.ndim not in (1, 2) or (hyetograph.ndim == 2 and len(hyetograph) != num_nodes):
+            raise ValueError("Hyetograph must be 1D or have shape (n_nodes, n_steps)")
+        num_steps = hyetograph.shape[-1]
+
+        limit = None
+        if max_outflow is not None:
+            limit = np.broadcast_to(np.asarray(max_outflow, dtype=np.float64) * timestep, (num_nodes,))
+            limit = np.where(np.isnan(limit), np.inf, limit)
+
+        # Simulate with nodes in leaves-to-root order so each level is a contiguous slice. The rain volume of each step
+        # is formed in the step so memory does not grow with the number of steps
+        order = self.order
+        rain_to_vol = self.wshed_area[order] * 0.001
+        capacity = self.bspot_vol[order]
+        if limit is not None:
+            limit = limit[order]
+        storage = np.zeros((num_nodes,), dtype=np.float64)
+        spill = np.zeros((num_nodes,), dtype=np.float64)
+        peak_v = np.zeros((num_nodes,), dtype=np.float64)
+        peak_time = np.full((num_nodes,), np.nan)
+        first_spill_time = np.full((num_nodes,), np.nan)
+        peak_spillv = np.zeros((num_nodes,), dtype=np.float64)
+        total_spillv = np.zeros((num_nodes,), dtype=np.float64)
+        if timeseries:
+            v_t = np.empty((num_nodes, num_steps), dtype=np.float64)
+            spillv_t = np.empty((num_nodes, num_steps), dtype=np.float64)
+
+        levels = self._levels()
+        for step in range(num_steps):
+            if hyetograph.ndim == 1:
+                storage += hyetograph[step] * rain_to_vol
+            else:
+                storage += hyetograph[order, step] * rain_to_vol
+            for level, has_down, targets, inverse in levels:
+                out = np.maximum(storage[level] - capacity[level], 0)
+                if limit is not None:
+                    out = np.minimum(out, limit[level])
+                storage[level] -= out
+                spill[level] = out
+                if len(targets):
+                    storage[targets] += np.bincount(inverse, weights=out[has_down], minlength=len(targets))
+
+            time = (step + 1) * timestep
+            higher = storage > peak_v
+            peak_v[higher] = storage[higher]
+            peak_time[higher] = time
+            first_spill_time[(spill > 0) & np.isnan(first_spill_time)] = time
+            np.maximum(peak_spillv, spill, out=peak_spillv)
+            total_spillv += spill
+            if timeseries:
+                # Time series are written in node order directly
+                v_t[order, step] = storage
+                spillv_t[order, step] = spill
+
+        result = dict(v=storage, peak_v=peak_v, peak_time=peak_time, first_spill_time=first_spill_time,
+                      peak_spillv=peak_spillv, total_spillv=total_spillv)
+        # Back to node order
+        unordered = dict(nodeid=self.nodeids)
+        for key, values in result.items():
+            unordered[key] = np.empty_like(values)
+            unordered[key][order] = values
+        if timeseries:
+            unordered['v_t'] = v_t
+            unordered['spillv_t'] = spillv_t
+        return unordered
+
+    def tree_roots(self):
+        """Index of the root node of the stream tree of each node"""
+        roots = np.arange(len(self), dtype=np.int64)
+        # Roots to leaves so the root of the downstream node is known
+        for l in reversed(range(len(self.level_ptr) - 1)):
+            level = self.order[self.level_ptr[l]:self.level_ptr[l + 1]]
+            down = self.downstream[level]
+            roots[level] = np.where(down >= 0, roots[np.maximum(down, 0)], level)
+        return roots
+
+    def tree_chunks(self, num_chunks):
+        """Partition the independent stream trees into chunks with balanced node counts
+
+        Parameters
+        ----------
+        num_chunks : int
+            Number of chunks
+
+        Returns
+        -------
+        chunks : list of arrays
+            Sorted node indexes of each non-empty chunk. Every tree is entirely within one chunk
+        """
+        roots = self.tree_roots()
+        tree_sizes = np.bincount(roots, minlength=len(self))
+        tree_roots = np.nonzero(tree_sizes)[0]
+        # Largest trees first, each to the currently smallest chunk
+        heap = [(0, c) for c in range(max(1, min(num_chunks, len(tree_roots))))]
+        tree_chunk = np.zeros((len(self),), dtype=np.int64)
+        for root in tree_roots[np.argsort(-tree_sizes[tree_roots], kind='mergesort')]:
+            size, c = heapq.heappop(heap)
+            tree_chunk[root] = c
+            heapq.heappush(heap, (size + tree_sizes[root], c))
+        node_chunk = tree_chunk[roots]
+        node_order = np.argsort(node_chunk, kind='mergesort')
+        bounds = np.cumsum(np.bincount(node_chunk, minlength=len(heap)))[:-1]
+        return [c for c in np.split(node_order, bounds) if len(c)]
+
+    def route_parallel(self, rainv, processes=None, chunks_per_process=4):
+        """Route water through the network evaluating independent stream trees in parallel
+
+        The stream trees are partitioned into chunks with balanced node counts which are evaluated in a process
+        pool. Node arrays and results are shared between the processes in shared memory.
+
+        Parameters
+        ----------
+        rainv : array
+            Water volume from the local watershed of each node in cubic meters. Shape (n_nodes,) for a single event
+            and (n_nodes, n_events) for multiple events
+        processes : int, optional
+            Number of processes. Default is the number of CPUs
+        chunks_per_process : int, optional
+            Number of chunks for each process
+
+        Returns
+        -------
+        event : dict of arrays
+            Same as route
+        """
+        rainv = np.asarray(rainv, dtype=np.float64)
+        if len(rainv) != len(self):
+            raise ValueError("Expected one volume per node")
+        processes = processes or multiprocessing.cpu_count()
+        chunks = self.tree_chunks(processes * chunks_per_process)
+        if processes < 2 or len(chunks) < 2:
+            return self.route(rainv)
+
+        shape = rainv.shape
+        node_shape = (len(self),)
+        shared = dict(downstream=(self.downstream, node_shape), bspot_vol=(self.bspot_vol, node_shape),
+                      rainv=(rainv, shape), spillv=(None, shape), v=(None, shape))
+        buffers = {}
+        for name, (values, value_shape) in shared.items():
+            typecode = 'q' if name == 'downstream' else 'd'
+            buffers[name] = (multiprocessing.RawArray(typecode, int(np.prod(value_shape))), value_shape)
+            if values is not None:
+                _shared_array(*buffers[name])[...] = values
+
+        pool = multiprocessing.Pool(processes, _init_route_worker, (buffers,))
+        try:
+            pool.map(_route_chunk, chunks)
+        finally:
+            pool.close()
+            pool.join()
+
+        capacity = self.bspot_vol.reshape((-1,) + (1,) * (rainv.ndim - 1))
+        spillv = _shared_array(*buffers['spillv']).copy()
+        v = _shared_array(*buffers['v']).copy()
+        with np.errstate(divide='ignore', invalid='ignore'):
+            pctv = np.where(capacity > 0, 100.0 * v / capacity, np.nan)
+        return dict(nodeid=self.nodeids, rainv=rainv, spillv=spillv, v=v, pctv=pctv)
+
+    def rain_ensemble(self, mmrain, num_scenarios, rain_cv=0.0, vol_cv=0.0, batch_size=16, seed=None, **kwargs):
+        """Monte Carlo ensemble of an evenly distributed rain event
+
+        Each scenario scales the rain depth by a random factor and the capacity of each bluespot by independent
+        random factors. Factors are drawn from normal distributions with mean 1 and are truncated at 0. Scenarios
+        are evaluated in batches and only streaming statistics are kept.
+
+        Parameters
+        ----------
+        mmrain : float
+            Amount of rain in mm
+        num_scenarios : int
+            Number of scenarios
+        rain_cv : float, optional
+            Coefficient of variation of the rain depth
+        vol_cv : float, optional
+            Coefficient of variation of the bluespot capacities
+        batch_size : int, optional
+            Number of scenarios evaluated at once. Memory use is proportional to n_nodes * batch_size
+        seed : int, optional
+            Seed for the random number generator
+        kwargs
+            Passed to EnsembleStatistics. max_count defaults to num_scenarios
+
+        Returns
+        -------
+        statistics : dict of arrays
+            See EnsembleStatistics.result
+        """
+        random = np.random.RandomState(seed)
+        kwargs.setdefault('max_count', num_scenarios)
+        stats = EnsembleStatistics(len(self), **kwargs)
+        done = 0
+        while done < num_scenarios:
+            batch = min(batch_size, num_scenarios - done)
+            rain_factor = np.maximum(random.normal(1.0, rain_cv, batch), 0) if rain_cv else np.ones((batch,))
+            rainv = np.multiply.outer(self.wshed_area, rain_factor * (mmrain * 0.001))
+            bspot_vol = None
+            if vol_cv:
+                bspot_vol = self.bspot_vol[:, np.newaxis] * np.maximum(random.normal(1.0, vol_cv, rainv.shape), 0)
+            stats.add(self.route(rainv, bspot_vol))
+            done += batch
+        return stats.result()
+
+    def route(self, rainv, bspot_vol=None):
+        """Route water from the local watersheds through the network
+
+        Parameters
+        ----------
+        rainv : array
+            Water volume from the local watershed of each node in cubic meters. Shape (n_nodes,) for a single event
+            and (n_nodes, n_events) for multiple events
+        bspot_vol : array, optional
+            Bluespot capacities to use instead of the capacities of the network. Shape (n_nodes,) or the shape of
+            rainv
+
+        Returns
+        -------
+        event : dict of arrays
+            nodeid, rainv (water vol from local catchment), spillv (water vol spilled from pourpoint), v (water vol in
+            bluespot) and pctv (percent filled. NaN if bluespot has no capacity). Values have the shape of rainv
+        """
+        rainv = np.asarray(rainv, dtype=np.float64)
+        if len(rainv) != len(self):
+            raise ValueError("Expected one volume per node")
+        # Broadcast node values against the event axis if any
+        capacity = self.bspot_vol if bspot_vol is None else np.asarray(bspot_vol, dtype=np.float64)
+        if capacity.ndim < rainv.ndim:
+            capacity = capacity.reshape((-1,) + (1,) * (rainv.ndim - 1))
+        total = rainv.copy()
+        spillv = np.zeros_like(total)
+        for l in range(len(self.level_ptr) - 1):
+            level = self.order[self.level_ptr[l]:self.level_ptr[l + 1]]
+            spill = np.maximum(total[level] - capacity[level], 0)
+            spillv[level] = spill
+            down = self.downstream[level]
+            has_down = down >= 0
+            np.add.at(total, down[has_down], spill[has_down])
+        v = np.minimum(total, capacity)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            pctv = np.where(capacity > 0, 100.0 * v / capacity, np.nan)
+        return dict(nodeid=self.nodeids, rainv=rainv, spillv=spillv, v=v, pctv=pctv)
+
+
+def _shared_array(buffer, shape):
+    """NumPy view of a shared memory array"""
+    return np.ctypeslib.as_array(buffer).reshape(shape)
+
+
+_route_worker_arrays = {}
+
+
+def _init_route_worker(buffers):
+    """Attach a pool worker to the shared memory arrays"""
+    for name, (buffer, shape) in buffers.items():
+        _route_worker_arrays[name] = _shared_array(buffer, shape)
+
+
+def _route_chunk(nodes):
+    """Route a chunk of complete stream trees. nodes are sorted node indexes"""
+    arrays = _route_worker_arrays
+    down = arrays['downstream'][nodes]
+    local_down = np.where(down >= 0, np.searchsorted(nodes, down), -1)
+    bspot_vol = arrays['bspot_vol'][nodes]
+    sub_network = NetworkArrays(nodes, local_down, np.zeros_like(bspot_vol), bspot_vol)
+    event = sub_network.route(arrays['rainv'][nodes])
+    arrays['spillv'][nodes] = event['spillv']
+    arrays['v'][nodes] = event['v']
+
+
+class EnsembleStatistics(object):
+    """Streaming per node statistics of rain event scenarios
+
+    Scenario results are added in batches and are not retained. Means and standard deviations are updated with the
+    batched form of Welford's algorithm. Quantiles of the percent filled are estimated from a fixed histogram over
+    0-100%.
+
+    The histogram is the only per node storage growing with the settings. It holds num_nodes * bins counts of the
+    smallest unsigned integer type holding max_count. For instance 1e6 nodes with 20 bins and at most 65535 scenarios
+    use 40 MB.
+
+    Parameters
+    ----------
+    num_nodes : int
+        Number of nodes
+    quantiles : sequence of float, optional
+        Quantiles (between 0 and 1) of the percent filled to estimate
+    bins : int, optional
+        Number of histogram bins over 0-100% filled. Quantiles are exact to within 100 / bins percent. The command
+        line allows at most MAX_ENSEMBLE_BINS
+    max_count : int, optional
+        Largest number of scenarios which will be added. Sets the integer type of the histogram counts
+    """
+
+    def __init__(self, num_nodes, quantiles=(0.05, 0.5, 0.95), bins=20, max_count=None):
+        self.num_nodes = num_nodes
+        self.quantiles = list(quantiles)
+        self.bins = bins
+        self.max_count = max_count
+        self.count = 0
+        self._mean = {k: np.zeros((num_nodes,), dtype=np.float64) for k in ['v', 'spillv']}
+        self._m2 = {k: np.zeros((num_nodes,), dtype=np.float64) for k in ['v', 'spillv']}
+        self._spills = np.zeros((num_nodes,), dtype=np.int64)
+        # Counts are updated in place so memory stays at one count per node and bin
+        self._histogram = np.zeros((num_nodes, bins), dtype=label_dtype(max_count) if max_count else np.uint32)
+
+    def add(self, events):
+        """Add a batch of scenario results
+
+        Parameters
+        ----------
+        events : dict of arrays
+            spillv, v and pctv with shape (n_nodes, n_scenarios) as returned by NetworkArrays.route
+        """
+        batch = events['v'].shape[1]
+        if not batch:
+            return
+        total = self.count + batch
+        if self.max_count is not None and total > self.max_count:
+            raise ValueError("More than max_count={} scenarios added".format(self.max_count))
+        for k in self._mean:
+            values = events[k]
+            batch_mean = np.mean(values, axis=1)
+            batch_m2 = np.sum((values - batch_mean[:, np.newaxis]) ** 2, axis=1)
+            delta = batch_mean - self._mean[k]
+            self._mean[k] += delta * batch / total
+            self._m2[k] += batch_m2 + delta ** 2 * self.count * batch / total
+        self._spills += np.sum(events['spillv'] > 0, axis=1)
+
+        pctv = events['pctv']
+        has_capacity = ~np.isnan(pctv)
+        bin_ix = np.clip((np.where(has_capacity, pctv, 0) * (self.bins / 100.0)).astype(np.int64), 0, self.bins - 1)
+        flat_ix = (np.arange(self.num_nodes)[:, np.newaxis] * self.bins + bin_ix)[has_capacity]
+        np.add.at(self._histogram.reshape(-1), flat_ix, 1)
+        self.count = total
+
+    def result(self):
+        """Statistics of the scenarios added so far
+
+        Returns
+        -------
+        statistics : dict of arrays
+            One value per node. count (number of scenarios), v_mean, v_std, spillv_mean, spillv_std, spill_prob
+            (fraction of scenarios where the bluespot spills) and pctv_q<percent> for each quantile, for instance
+            pctv_q50 for the median. Quantiles are NaN for bluespots without capacity
+        """
+        result = dict(count=np.full((self.num_nodes,), self.count, dtype=np.int64))
+        for k in self._mean:
+            result[k + '_mean'] = self._mean[k].copy()
+            result[k + '_std'] = np.sqrt(self._m2[k] / self.count) if self.count else np.zeros((self.num_nodes,))
+        result['spill_prob'] = self._spills / float(max(self.count, 1))
+
+        counts = np.sum(self._histogram, axis=1, dtype=np.int64)
+        cumulative = np.cumsum(self._histogram, axis=1, dtype=self._histogram.dtype)
+        width = 100.0 / self.bins
+        rows = np.arange(self.num_nodes)
+        for q in self.quantiles:
+            target = q * counts
+            bin_ix = np.minimum(np.sum(cumulative < target[:, np.newaxis], axis=1), self.bins - 1)
+            below = cumulative[rows, bin_ix] - self._histogram[rows, bin_ix]
+            in_bin = self._histogram[rows, bin_ix]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                fraction = np.where(in_bin > 0, (target - below) / in_bin, 0)
+            values = (bin_ix + np.clip(fraction, 0, 1)) * width
+            result['pctv_q{:g}'.format(100 * q)] = np.where(counts > 0, values, np.nan)
+        return result
+
+
+class RainResponse(object):
+    """Piecewise-linear response of each node to an evenly distributed rain.
+
+    For rain evenly distributed across the entire area the total volume of water flowing into a bluespot is a convex,
+    piecewise-linear function of the rain depth. The curve of each node is stored as a set of breakpoints. The rain
+    depth at breakpoint j is x[j], the total inflow volume at that depth is y[j] and the inflow increases by slope[j]
+    per mm of rain from there on. The breakpoints of node i are ptr[i]:ptr[i+1].
+
+    Attributes
+    ----------
+    nodeids : 1D array
+        Id of each node
+    bspot_vol : 1D array
+        Bluespot capacity of each node in cubic meters
+    wshed_area : 1D array
+        Area of the local watershed of each node in square meters
+    ptr : 1D array
+        Breakpoints of node i are ptr[i]:ptr[i+1]
+    x : 1D array
+        Rain depth in mm at each breakpoint
+    y : 1D array
+        Total inflow volume in cubic meters at each breakpoint
+    slope : 1D array
+        Increase in total inflow volume per mm rain from each breakpoint
+    spill_mm : 1D array
+        Rain depth in mm at which each bluespot starts to spill. Inf if it never spills
+    inflow_mm : 1D array
+        Rain depth in mm at which water starts flowing into each bluespot from upstream. Inf if never
+    """
+
+    def __init__(self, nodeids, bspot_vol, wshed_area, ptr, x, y, slope, spill_mm, inflow_mm):
+        self.nodeids = nodeids
+        self.bspot_vol = bspot_vol
+        self.wshed_area = wshed_area
+        self.ptr = ptr
+        self.x = x
+        self.y = y
+        self.slope = slope
+        self.spill_mm = spill_mm
+        self.inflow_mm = inflow_mm
+
+    def total_inflow(self, mmrain):
+        """Total volume of water flowing into each bluespot
+
+        Parameters
+        ----------
+        mmrain : float or sequence of float
+            Amount of rain in mm. A sequence for multiple events
+
+        Returns
+        -------
+        volume : array
+            Total inflow volume in cubic meters. Shape (n_nodes,) for a single event and (n_nodes, n_events) for a
+            sequence of events
+        """
+        mmrain = np.asarray(mmrain, dtype=np.float64)
+        if mmrain.ndim > 1:
+            raise ValueError("Rain must be a scalar or a 1D sequence")
+        if np.any(mmrain < 0):
+            raise ValueError("Rain must not be negative")
+        r = np.broadcast_to(mmrain, (len(self.nodeids),) + mmrain.shape)
+        lo = np.broadcast_to(self.ptr[:-1].reshape((-1,) + (1,) * mmrain.ndim), r.shape).copy()
+        hi = np.broadcast_to((self.ptr[1:] - 1).reshape((-1,) + (1,) * mmrain.ndim), r.shape).copy()
+        # Binary search for the last breakpoint at or below the rain depth. x of the first breakpoint is always 0
+        while np.any(lo < hi):
+            mid = (lo + hi + 1) // 2
+            below = self.x[mid] <= r
+            lo = np.where(below, mid, lo)
+            hi = np.where(below, hi, mid - 1)
+        return self.y[lo] + self.slope[lo] * (r - self.x[lo])
+
+    def evaluate(self, mmrain):
+        """Evaluate rain events from the response curves
+
+        Gives the same results as NetworkArrays.rain_event without traversing the network.
+
+        Parameters
+        ----------
+        mmrain : float or sequence of float
+            Amount of rain in mm. A sequence for multiple events
+
+        Returns
+        -------
+        event : dict of arrays
+            nodeid, rainv (water vol from local catchment), spillv (water vol spilled from pourpoint), v (water vol in
+            bluespot) and pctv (percent filled. NaN if bluespot has no capacity). Values have shape (n_nodes,) for a
+            single event and (n_nodes, n_events) for a sequence of events
+        """
+        mmrain = np.asarray(mmrain, dtype=np.float64)
+        total = self.total_inflow(mmrain)
+        capacity = self.bspot_vol.reshape((-1,) + (1,) * mmrain.ndim)
+        rainv = np.multiply.outer(self.wshed_area, mmrain * 0.001)
+        spillv = np.maximum(total - capacity, 0)
+        v = np.minimum(total, capacity)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            pctv = np.where(capacity > 0, 100.0 * v / capacity, np.nan)
+        return dict(nodeid=self.nodeids, rainv=rainv, spillv=spillv, v=v, pctv=pctv)
+
+
+def _segment_indexes(starts, lengths):
+    """Flat indexes of the segments starts[i]:starts[i] + lengths[i] and the segment i of each index"""
+    owner = np.repeat(np.arange(len(lengths)), lengths)
+    offsets = np.cumsum(lengths) - lengths
+    return owner, np.arange(len(owner)) - offsets[owner] + starts[owner]
+
+
+def _segment_cumsum(values, starts, counts):
+    """Cumulative sum restarting at each of the contiguous segments starts[i]:starts[i] + counts[i]"""
+    total = np.cumsum(values)
+    return total - np.repeat(total[starts] - values[starts], counts)
 
 
 class Network(object):
@@ -35,7 +799,16 @@ class Network(object):
         self.nodes_index = {}
         self.root_nodes = []
         self.upstream_tree = defaultdict(list)
-        self._node_rain_values = {}
+        self._arrays = None
+        self._cached_mmrain = None
+        self._cached_events = None
+
+    @property
+    def arrays(self):
+        """NetworkArrays representation of the network. Built on first use"""
+        if self._arrays is None:
+            self._arrays = NetworkArrays.from_nodes(self.nodes)
+        return self._arrays
 
     def add_nodes(self, nodes):
         """Add a sequence of nodes to the stream network
@@ -71,59 +844,292 @@ class Network(object):
         self.upstream_tree[downstream_id].append(node_id)
         if downstream_id is None:
             self.root_nodes.append(node_id)
+        self._arrays = None
+        self._cached_mmrain = None
+        self._cached_events = None
 
-    def _calc_node(self, node_id, mmrain):
-        node = self.nodes_index[node_id]
-        area = float(node['wshed_area'])
-        wshed_water_vol = area * mmrain * 0.001
-        bspot_capacity = float(node['bspot_vol'])
-
-        # How much is coming from upstream
-        upstream_node_ids = self.upstream_tree[node_id]
-        upstream_volume = 0.0
-        if upstream_node_ids:
-            upstream_event_values = [self._node_rain_values[nid] for nid in upstream_node_ids]
-            upstream_volume = sum([un['spillv'] for un in upstream_event_values])
-
-        total_water_vol = wshed_water_vol + upstream_volume
-        bspot_filled_vol = min(total_water_vol, bspot_capacity)
-
-        spillover = max(0, total_water_vol - bspot_capacity)
-
-        event = dict(nodeid=node['nodeid'])
-        event['rainv'] = wshed_water_vol  # Water vol from local catchment
-        event['spillv'] = spillover  # Water vol spilled from pourpoint
-        event['v'] = bspot_filled_vol  # Water vol in bluespot
-        event['pctv'] = None if not bspot_capacity else 100.0 * bspot_filled_vol / bspot_capacity  # Percent filled
-        self._node_rain_values[node_id] = event
-
-    def _calc_stream_tree(self, root_node_id, mmrain):
-        tree = deque()
-        nodes = deque([root_node_id])
-        while nodes:
-            n = nodes.pop()
-            tree.append(n)
-            nodes.extend(self.upstream_tree[n])
-        # Now tree has root at the beginning and leaves at the end
-        # Process from leaves to root
-        while tree:
-            n = tree.pop()
-            self._calc_node(n, mmrain)
+    def cache_rain_events(self, mmrain):
+        """Calculate rain events and keep the results for incremental updates using update_nodes
+
+        Parameters
+        ----------
+        mmrain : sequence of float
+            Amount of rain in mm for each event
+
+        Returns
+        -------
+        events : dict of arrays
+            nodeid, rainv, spillv, v and pctv with shape (n_nodes, n_events). See NetworkArrays.rain_event. The
+            arrays are updated in place by update_nodes
+        """
+        self._cached_mmrain = np.atleast_1d(np.asarray(mmrain, dtype=np.float64))
+        self._cached_events = self.arrays.rain_event(self._cached_mmrain)
+        return self._cached_events
+
+    def update_nodes(self, updates):
+        """Update node properties and re-evaluate the cached rain events
+
+        Only the updated nodes and the nodes downstream of them are re-evaluated. The re-evaluation of a downstream
+        chain stops where the spill from a node is unchanged.
+
+        Parameters
+        ----------
+        updates : dict
+            Maps a node id to a dict of properties to update. Changes to bspot_vol and wshed_area are re-evaluated.
+            The stream network topology (dstrnodeid) can not be changed
+
+        Returns
+        -------
+        changed : list
+            Ids of nodes whose event values changed. Empty if no events are cached
+        """
+        arrays = self.arrays
+        updated = set()
+        for node_id, props in updates.items():
+            if 'dstrnodeid' in props and props['dstrnodeid'] != self.nodes_index[node_id]['dstrnodeid']:
+                raise ValueError("The stream network topology can not be updated. Node: {}".format(node_id))
+            self.nodes_index[node_id].update(props)
+            ix = int(arrays.index([node_id])[0])
+            if 'bspot_vol' in props:
+                arrays.bspot_vol[ix] = props['bspot_vol']
+            if 'wshed_area' in props:
+                arrays.wshed_area[ix] = props['wshed_area']
+            updated.add(ix)
+
+        if self._cached_events is None:
+            return []
+
+        # Updated nodes and their downstream chains in leaves-to-root order
+        affected = set()
+        for ix in updated:
+            while ix >= 0 and ix not in affected:
+                affected.add(ix)
+                ix = arrays.downstream[ix]
+        position = np.empty_like(arrays.order)
+        position[arrays.order] = np.arange(len(arrays.order))
+        affected = sorted(affected, key=lambda i: position[i])
+
+        events = self._cached_events
+        rain_to_vol = self._cached_mmrain * 0.001
+        changed_spill = set()
+        changed = []
+        for ix in affected:
+            upstream = arrays.upstream[arrays.upstream_ptr[ix]:arrays.upstream_ptr[ix + 1]]
+            if ix not in updated and not changed_spill.intersection(upstream.tolist()):
+                continue
+            capacity = arrays.bspot_vol[ix]
+            rainv = arrays.wshed_area[ix] * rain_to_vol
+            total = rainv + np.sum(events['spillv'][upstream], axis=0)
+            values = dict(rainv=rainv, spillv=np.maximum(total - capacity, 0), v=np.minimum(total, capacity))
+            values['pctv'] = 100.0 * values['v'] / capacity if capacity > 0 else np.full_like(total, np.nan)
+            if not np.array_equal(values['spillv'], events['spillv'][ix]):
+                changed_spill.add(ix)
+            if not all(np.allclose(events[k][ix], values[k], rtol=0, atol=0, equal_nan=True) for k in values):
+                changed.append(int(arrays.nodeids[ix]))
+            for k in values:
+                events[k][ix] = values[k]
+        return changed
+
+    def rain_response(self):
+        """Calculate piecewise-linear rain response curves for all nodes
+
+        Returns
+        -------
+        RainResponse
+            Evaluates any rain depth without traversing the network. Also has the rain depth at which each bluespot
+            starts to spill
+        """
+        return self.arrays.rain_response()
+
+    def simulate(self, hyetograph, timestep=1.0, max_outflow=None, timeseries=False):
+        """Simulate filling and spilling of the bluespots over time
+
+        See NetworkArrays.simulate
+        """
+        return self.arrays.simulate(hyetograph, timestep, max_outflow, timeseries)
 
     def rain_event(self, mmrain):
         """Calculate rain event
 
         Parameters
         ----------
-        mmrain : float
-            Amount of rain in mm
+        mmrain : float or sequence of float
+            Amount of rain in mm. A sequence for multiple events
 
         Returns
         -------
-        nodes : list
-            All nodes in the network with event specific information added
+        nodes : list or dict of arrays
+            For a single event all nodes in the network with event specific information added. For a sequence of
+            events the per-event columns as returned by NetworkArrays.rain_event
         """
-        self._node_rain_values = {}
-        for rn in self.root_nodes:
-            self._calc_stream_tree(rn, mmrain)
-        return list(self._node_rain_values.values())
+        if np.ndim(mmrain) > 0:
+            return self.arrays.rain_event(mmrain)
+        event = self.arrays.rain_event(mmrain)
+        pctv = [None if np.isnan(p) else p for p in event['pctv'].tolist()]
+        return [dict(nodeid=nid, rainv=rainv, spillv=spillv, v=v, pctv=p) for nid, rainv, spillv, v, p in
+                zip(event['nodeid'].tolist(), event['rainv'].tolist(), event['spillv'].tolist(), event['v'].tolist(),
+                    pctv)]
+
+
+def save_network(filepath, features, crs=None):
+    """Save nodes and their stream network to a binary .npz file
+
+    The file holds the NetworkArrays including the precomputed topological order, the node coordinates and all node
+    properties as typed columns. Loading it does not require parsing any features.
+
+    Parameters
+    ----------
+    filepath : str
+        Output file. Should end with '.npz'
+    features : list of dict
+        Geojson point features of the nodes
+    crs : str, optional
+        Well Known Text (WKT) representation of the coordinate reference system
+
+    Returns
+    -------
+    NetworkArrays
+        The saved network
+    """
+    features = list(features)
+    props = [f['properties'] for f in features]
+    network = NetworkArrays.from_nodes(props)
+    data = dict(nodeids=network.nodeids, downstream=network.downstream, wshed_area=network.wshed_area,
+                bspot_vol=network.bspot_vol, upstream_ptr=network.upstream_ptr, upstream=network.upstream,
+                order=network.order, level_ptr=network.level_ptr,
+                coords=np.array([f['geometry']['coordinates'][:2] for f in features], dtype=np.float64).reshape(-1, 2),
+                crs=np.array(crs or ''))
+
+    names = []
+    for p in props:
+        names.extend([k for k in p if k not in names])
+    data['property_names'] = np.array(names)
+    for i, name in enumerate(names):
+        values = [p.get(name) for p in props]
+        isnull = np.array([v is None for v in values], dtype=bool)
+        present = [v for v in values if v is not None]
+        if all(isinstance(v, bool) for v in present):
+            dtype, fill = bool, False
+        elif all(isinstance(v, int) and not isinstance(v, bool) for v in present):
+            dtype, fill = np.int64, 0
+        elif all(isinstance(v, (int, float)) and not isinstance(v, bool) for v in present):
+            dtype, fill = np.float64, 0.0
+        else:
+            dtype, fill = str, ''
+            values = [None if v is None else str(v) for v in values]
+        data['property_{}'.format(i)] = np.array([fill if v is None else v for v in values], dtype=dtype)
+        data['isnull_{}'.format(i)] = isnull
+    np.savez(filepath, **data)
+    return network
+
+
+def load_network(filepath):
+    """Load nodes and their stream network from a file written by save_network
+
+    Node properties are kept as columns. Feature dicts are only built when the features are accessed.
+
+    Parameters
+    ----------
+    filepath : str
+        File written by save_network
+
+    Returns
+    -------
+    network : NetworkArrays
+        Network with the precomputed topological order
+    features : NodeFeatures
+        Geojson point features of the nodes
+    crs : str or None
+        Well Known Text (WKT) representation of the coordinate reference system
+    """
+    with np.load(filepath) as data:
+        network = NetworkArrays.__new__(NetworkArrays)
+        for name in ['nodeids', 'downstream', 'wshed_area', 'bspot_vol', 'upstream_ptr', 'upstream', 'order',
+                     'level_ptr']:
+            setattr(network, name, data[name])
+        network._level_routing = None
+
+        names = data['property_names'].tolist()
+        columns = [data['property_{}'.format(i)] for i in range(len(names))]
+        isnull = [data['isnull_{}'.format(i)] for i in range(len(names))]
+        features = NodeFeatures(data['coords'], names, columns, isnull)
+        crs = data['crs'].tolist() or None
+    return network, features, crs
+
+
+class NodeFeatures(object):
+    """Geojson point features of nodes backed by property columns
+
+    Behaves like a list of features. Feature dicts are built on access, while columns are available as arrays
+    without building any features.
+
+    Parameters
+    ----------
+    coords : ndarray
+        Node coordinates of shape (n_nodes, 2)
+    names : list of str
+        Property names
+    columns : list of ndarray
+        Values of each property
+    isnull : list of ndarray
+        True where the value of each property is null
+    """
+
+    def __init__(self, coords, names, columns, isnull):
+        self.coords = coords
+        self.names = list(names)
+        self._columns = dict(zip(self.names, zip(columns, isnull)))
+
+    def __len__(self):
+        return len(self.coords)
+
+    def __getitem__(self, ix):
+        props = dict((name, None if isnull[ix] else values[ix].item()) for name, (values, isnull) in
+                     self._columns.items())
+        return self._feature(props, self.coords[ix].tolist())
+
+    def __iter__(self):
+        for props, coord in zip(self.records(), self.coords.tolist()):
+            yield self._feature(props, coord)
+
+    def column(self, name):
+        """Values of a property
+
+        Parameters
+        ----------
+        name : str
+            Property name
+
+        Returns
+        -------
+        values : ndarray or None
+            Values of the property. None if no node has the property
+        isnull : ndarray or None
+            True where the value is null
+        """
+        return self._columns.get(name, (None, None))
+
+    def records(self, names=None):
+        """Iterate the properties of each node
+
+        Parameters
+        ----------
+        names : list of str, optional
+            Only include these properties. Default is all properties
+
+        Returns
+        -------
+        Iterable of dict
+        """
+        names = [n for n in (self.names if names is None else names) if n in self._columns]
+        columns = []
+        for name in names:
+            values, isnull = self._columns[name]
+            columns.append([None if n else v for v, n in zip(values.tolist(), isnull.tolist())])
+        for ix in range(len(self)):
+            yield dict((name, column[ix]) for name, column in zip(names, columns))
+
+    @staticmethod
+    def _feature(props, coord):
+        return dict(type='Feature', id=props.get('nodeid'), properties=props,
+                    geometry=dict(type='Point', coordinates=coord))
@@ -14,8 +14,13 @@
 from __future__ import (absolute_import, division, print_function, unicode_literals)
 from builtins import *
 
-from .network import Network
+from .network import NetworkArrays
+from .bluespots import stage_storage_curves
+from .algorithms import label
+from . import flood
+import numpy as np
 import logging
+from collections import OrderedDict
 
 
 class RainTool(object):
@@ -23,26 +28,88 @@ class RainTool(object):
 
     Parameters
     ----------
-    input_nodes : list
-        Nodes
-    output_eventdata : vectorwriter
-        Writes the output event data
+    input_nodes : vectorreader or networkreader
+        Nodes. A networkreader also provides the stream network with precomputed topological order
+    output_eventdata : vectorwriter or None
+        Writes the output event data as properties of the nodes. One property for each output value and event
     events_rainmm : list of float
         Rain events (in mm) to process.
+    thresholds : bool
+        Add the rain depth at which each bluespot starts to spill (spill_mm) and the rain depth at which water starts
+        flowing into each bluespot from upstream (inflow_mm). Null if it never happens.
+    input_rain_rasters : list of rasterreader, optional
+        Rasters with rain in mm for each cell. Each raster is processed as a separate event. Output properties of
+        the first raster are suffixed '_r1', the second '_r2' and so on. Nodata cells get no rain. The rasters must
+        have the same grid and crs as input_watersheds
+    input_watersheds : rasterreader, optional
+        Watersheds raster as written by BluespotTool. Required with input_rain_rasters
+    ensemble_size : int, optional
+        Number of Monte Carlo scenarios for each rain event in events_rainmm. 0 for no ensemble
+    ensemble_rain_cv : float, optional
+        Coefficient of variation of the rain depth in the ensemble scenarios
+    ensemble_vol_cv : float, optional
+        Coefficient of variation of the bluespot capacities in the ensemble scenarios
+    ensemble_seed : int, optional
+        Seed for the ensemble random number generator
+    processes : int, optional
+        Evaluate independent stream trees in parallel using this number of processes
+    output_eventtable : eventwriter, optional
+        Writes the output event data in bulk as columns. Either one row per node and event or dense arrays
+    input_bluespots : rasterreader, optional
+        Bluespot ids raster. Required with output_event_raster
+    output_event_raster : callable, optional
+        Called as output_event_raster(prop, event) and returns a rasterwriter for the raster of output value prop
+        (for instance 'pctv') for the event (for instance '10' or 'r1'). Each bluespot cell gets the value of its
+        bluespot
+    raster_props : sequence of str, optional
+        Output values to write as rasters
+    input_depths : rasterreader, optional
+        Bluespot depths. Required with output_flood_raster
+    output_flood_raster : callable, optional
+        Called as output_flood_raster(event) and returns a rasterwriter for the water depth raster of the event. The
+        water level of each bluespot is found from its filled volume using the stage-storage curves of the nodes
+    ensemble_bins : int, optional
+        Number of percent filled histogram bins per node used for the ensemble quantiles. Memory use is proportional to
+        the number of nodes times ensemble_bins
 
     Attributes
     ----------
-    input_nodes : list
-        Nodes
+    input_nodes : vectorreader or networkreader
+        Nodes. A networkreader also provides the stream network with precomputed topological order
     output_eventdata : vectorwriter
 
 
     """
 
-    def __init__(self, input_nodes, output_eventdata, events_rainmm):
+    def __init__(self, input_nodes, output_eventdata, events_rainmm, thresholds=False, input_rain_rasters=None,
+                 input_watersheds=None, ensemble_size=0, ensemble_rain_cv=0.0, ensemble_vol_cv=0.0,
+                 ensemble_seed=None, processes=None, output_eventtable=None, input_bluespots=None,
+                 output_event_raster=None, raster_props=('pctv',), input_depths=None, output_flood_raster=None,
+                 ensemble_bins=20):
         self.input_nodes = input_nodes
         self.output_eventdata = output_eventdata
         self.events_rainmm = list(events_rainmm)
+        self.thresholds = thresholds
+        self.input_rain_rasters = list(input_rain_rasters or [])
+        self.input_watersheds = input_watersheds
+        if self.input_rain_rasters and self.input_watersheds is None:
+            raise ValueError("Watersheds are required for rain rasters")
+        self.ensemble_size = ensemble_size
+        self.ensemble_rain_cv = ensemble_rain_cv
+        self.ensemble_vol_cv = ensemble_vol_cv
+        self.ensemble_seed = ensemble_seed
+        self.ensemble_bins = ensemble_bins
+        self.processes = processes
+        self.output_eventtable = output_eventtable
+        self.input_bluespots = input_bluespots
+        self.output_event_raster = output_event_raster
+        self.raster_props = list(raster_props)
+        self.input_depths = input_depths
+        self.output_flood_raster = output_flood_raster
+        if (self.output_event_raster or self.output_flood_raster) and self.input_bluespots is None:
+            raise ValueError("Bluespots are required for event rasters")
+        if self.output_flood_raster and self.input_depths is None:
+            raise ValueError("Depths are required for flood rasters")
         self.logger = logging.getLogger(__name__)
 
     def process(self):
@@ -54,34 +121,184 @@ class RainTool(object):
         """
 
         self.logger.info("Reading input nodes")
-        geojsonnodes_index = {gjn['properties']['nodeid']: gjn for gjn in self.input_nodes.read_geojson_features()}
-
-        # Only use 'properties'
-        nodes = [gjn['properties'] for gjn in geojsonnodes_index.values()]
-
-        self.logger.info("Creating stream network")
-        network = Network()
-        network.add_nodes(nodes)
-
-        # event properties to copy to geojson output
-        copy_props = ['rainv', 'spillv', 'v', 'pctv']
-
-        self.logger.info("Calculating rain events")
-        for mmrain in self.events_rainmm:
-            self.logger.info("  {}mm".format(mmrain))
-            eventvalues = network.rain_event(mmrain)
-            to_props = [self._output_property(s, mmrain) for s in copy_props]
-            from_to_props = list(zip(copy_props, to_props))
-            for e in eventvalues:
-                node_id = e['nodeid']
-                gjn = geojsonnodes_index[node_id]
-                for fromprop, toprop in from_to_props:
-                    gjn['properties'][toprop] = e[fromprop]
+        # A network reader returns lazy features with property columns. Feature dicts are only built for vector output
+        geojsonnodes = self.input_nodes.read_geojson_features()
+        if hasattr(self.input_nodes, 'read_network'):
+            network = self.input_nodes.read_network()
+        else:
+            geojsonnodes = list(geojsonnodes)
+            self.logger.info("Creating stream network")
+            network = NetworkArrays.from_nodes([gjn['properties'] for gjn in geojsonnodes])
+
+        # Water volume from the local watershed of each node. One column per event
+        rainv = [np.multiply.outer(network.wshed_area, np.asarray(self.events_rainmm, dtype=np.float64) * 0.001)]
+        suffixes = ["{:g}".format(mmrain) for mmrain in self.events_rainmm]
+        if self.input_rain_rasters:
+            rainv.append(self._raster_rain_volumes(_bspot_ids(geojsonnodes)))
+            suffixes += ["r{}".format(i + 1) for i in range(len(self.input_rain_rasters))]
+
+        self.logger.info("Calculating rain events: {}".format(", ".join(suffixes)))
+        if self.processes and self.processes > 1:
+            events = network.route_parallel(np.column_stack(rainv), self.processes)
+        else:
+            events = network.route(np.column_stack(rainv))
+
+        # Output columns. Event columns hold a value per node and event, node columns a value per node. NaN is null
+        event_columns = OrderedDict((prop, events[prop]) for prop in ['rainv', 'spillv', 'v', 'pctv'])
+        node_columns = OrderedDict()
+
+        # Ensemble statistics are only calculated for the evenly distributed rain events
+        ensemble_props = [('spill_prob', 'spprob'), ('v_mean', 'vmean'), ('v_std', 'vstd'),
+                          ('spillv_mean', 'spmean'), ('pctv_q5', 'pq5'), ('pctv_q50', 'pq50'), ('pctv_q95', 'pq95')]
+        if self.ensemble_size:
+            for _, prop in ensemble_props:
+                event_columns[prop] = np.full(events['v'].shape, np.nan)
+            for j, mmrain in enumerate(self.events_rainmm):
+                self.logger.info("Calculating ensemble of {} scenarios for {}mm".format(self.ensemble_size, mmrain))
+                stats = network.rain_ensemble(mmrain, self.ensemble_size, self.ensemble_rain_cv,
+                                              self.ensemble_vol_cv, seed=self.ensemble_seed, bins=self.ensemble_bins)
+                for fromprop, prop in ensemble_props:
+                    event_columns[prop][:, j] = stats[fromprop]
+
+        if self.thresholds:
+            self.logger.info("Calculating rain thresholds")
+            response = network.rain_response()
+            for prop, values in [('spill_mm', response.spill_mm), ('inflow_mm', response.inflow_mm)]:
+                node_columns[prop] = np.where(np.isinf(values), np.nan, values)
 
         self.logger.info("Writing output")
-        self.output_eventdata.write_geojson_features(geojsonnodes_index.values())
+        if self.output_eventdata:
+            uniform_only = set(prop for _, prop in ensemble_props)
+            columns = OrderedDict()
+            for prop, values in event_columns.items():
+                for j, suffix in enumerate(suffixes):
+                    if prop in uniform_only and j >= len(self.events_rainmm):
+                        continue
+                    columns["{}_{}".format(prop, suffix)] = values[:, j]
+            columns.update(node_columns)
+            self.output_eventdata.write_geojson_features(_with_properties(geojsonnodes, columns))
+        if self.output_eventtable:
+            self.output_eventtable.write_events(network.nodeids, suffixes, event_columns, node_columns)
+        if self.output_event_raster or self.output_flood_raster:
+            self._write_event_rasters(geojsonnodes, suffixes, event_columns)
 
         self.logger.info("Done")
 
-    def _output_property(self, string, mmrain):
-        return "{}_{:g}".format(string, mmrain)
+    def _write_event_rasters(self, geojsonnodes, suffixes, event_columns):
+        """Write rasters of bluespot values using lookup tables from bluespot id to value"""
+        bspot_ids = _bspot_ids(geojsonnodes)
+        has_bspot = bspot_ids > 0
+        # Last entry is for labels without a node
+        lut_size = max(int(np.max(bspot_ids)) if len(bspot_ids) else 0, 0) + 2
+
+        writers = []
+        for prop in self.raster_props if self.output_event_raster else []:
+            for j, suffix in enumerate(suffixes):
+                values = event_columns[prop][:, j]
+                if np.all(np.isnan(values)):
+                    continue
+                writer = self.output_event_raster(prop, suffix)
+                nodata = -1 if writer.nodata is None else writer.nodata
+                lut = np.full((lut_size,), nodata, dtype=np.float32)
+                lut[bspot_ids[has_bspot]] = np.where(np.isnan(values[has_bspot]), nodata, values[has_bspot])
+                writer.create(self.input_bluespots.shape, np.float32)
+                writers.append((writer, lut))
+
+        flood_writers = []
+        if self.output_flood_raster:
+            stage, volume, area, has_curve = flood.stage_storage_table(stage_storage_curves(_records(geojsonnodes, ['bspot_id', 'stage_h', 'stage_v', 'stage_a'])), lut_size)
+            if not np.any(has_curve):
+                raise ValueError("Nodes have no stage-storage curves. Recalculate pour points and nodes")
+            has_curve[0] = False
+            maxdepth = stage[:, -1]
+            if self.input_depths.shape != self.input_bluespots.shape:
+                raise ValueError("Depths raster and bluespots raster must have the same shape")
+            for j, suffix in enumerate(suffixes):
+                v = np.zeros((lut_size,), dtype=np.float64)
+                v[bspot_ids[has_bspot]] = event_columns['v'][has_bspot, j]
+                writer = self.output_flood_raster(suffix)
+                writer.create(self.input_bluespots.shape, np.float32)
+                flood_writers.append((writer, flood.water_levels(stage, volume, area, v)))
+            depth_blocks = self.input_depths.iter_blocks()
+
+        self.logger.info("Writing {} event rasters".format(len(writers) + len(flood_writers)))
+        for row_off, labels in self.input_bluespots.iter_blocks():
+            labels = np.minimum(labels, lut_size - 1)
+            for writer, lut in writers:
+                writer.write_block(lut[labels], row_off)
+            if flood_writers:
+                _, depths = next(depth_blocks)
+                for writer, levels in flood_writers:
+                    nodata = -1 if writer.nodata is None else writer.nodata
+                    writer.write_block(flood.flood_depths(labels, depths, levels, maxdepth, has_curve, nodata), row_off)
+        for writer, _ in writers + flood_writers:
+            writer.close()
+
+    def _raster_rain_volumes(self, bspot_ids):
+        """Water volume from the local watershed of each node for each rain raster"""
+        self.logger.info("Reading watersheds")
+        watersheds = self.input_watersheds.read()
+        transform = self.input_watersheds.transform
+        cell_area = abs(transform[1] * transform[5])
+        nlabels = max(int(np.max(bspot_ids)) + 1, 0) if len(bspot_ids) else 0
+
+        volumes = np.zeros((len(bspot_ids), len(self.input_rain_rasters)), dtype=np.float64)
+        for i, reader in enumerate(self.input_rain_rasters):
+            self.logger.info("Summing rain from {} over watersheds".format(reader.filepath))
+            if not np.allclose(reader.transform, transform) or not _same_crs(reader.crs, self.input_watersheds.crs):
+                raise ValueError("Rain raster {} must have the same geotransform and crs as the watersheds raster"
+                                 .format(reader.filepath))
+            rain = reader.read()
+            if rain.shape != watersheds.shape:
+                raise ValueError("Rain raster and watersheds raster must have the same shape")
+            rain = rain.astype(np.float64)
+            nodata = np.isnan(rain)
+            if reader.nodata is not None and reader.nodatasubst is None:
+                nodata |= rain == reader.nodata
+            if np.any(nodata):
+                self.logger.warning("Rain raster {} has {} nodata cells. They get no rain"
+                                    .format(reader.filepath, np.count_nonzero(nodata)))
+                rain[nodata] = 0
+            # mm rain summed over the cells of each watershed in one pass
+            wshed_rain = label.label_sum(rain, watersheds, nlabels)
+            has_wshed = bspot_ids >= 0
+            volumes[has_wshed, i] = wshed_rain[bspot_ids[has_wshed]] * cell_area * 0.001
+        return volumes
+
+
+def _records(geojsonnodes, names):
+    """Properties of the nodes. Only the given properties are read from property columns"""
+    if hasattr(geojsonnodes, 'records'):
+        return geojsonnodes.records(names)
+    return [gjn['properties'] for gjn in geojsonnodes]
+
+
+def _bspot_ids(geojsonnodes):
+    """Bluespot id of each node. -1 where the node has no bluespot"""
+    if hasattr(geojsonnodes, 'column'):
+        values, isnull = geojsonnodes.column('bspot_id')
+        if values is None:
+            return np.full((len(geojsonnodes),), -1, dtype=np.int64)
+        return np.where(isnull, -1, values).astype(np.int64)
+    return np.array([-1 if gjn['properties'].get('bspot_id') is None else gjn['properties']['bspot_id']
+                     for gjn in geojsonnodes], dtype=np.int64)
+
+
+def _with_properties(geojsonnodes, columns):
+    """Features with the columns added as properties. NaN is written as null"""
+    columns = [(prop, np.where(np.isnan(values), None, values).tolist()) for prop, values in columns.items()]
+    features = list(geojsonnodes)
+    for ix, feature in enumerate(features):
+        feature['properties'].update((prop, values[ix]) for prop, values in columns)
+    return features
+
+
+def _same_crs(wkt, other_wkt):
+    """False if both crs are given and differ"""
+    if not wkt or not other_wkt or wkt == other_wkt:
+        return True
+    from osgeo import osr
+    srs, other_srs = osr.SpatialReference(), osr.SpatialReference()
+    srs.ImportFromWkt(wkt)
+    other_srs.ImportFromWkt(other_wkt)
+    return bool(srs.IsSame(other_srs))
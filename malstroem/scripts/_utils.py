@@ -13,28 +13,174 @@
 # -------------------------------------------------------------------------------------------------
 
 
-def check_filter(filter):
-    # TODO: Stupid check mechanism. Could be done better
-    allowed_words = ['area', 'maxdepth', 'volume', 'and', 'or']
-    allowedchars = '<>=!0123456789.()'
-    for w in allowed_words:
-        filter = filter.replace(w, '')
-    for c in allowedchars:
-        filter = filter.replace(c, '')
-    filter = filter.strip()
-    if filter:
-        raise Exception('Unsupported filter statement. Illegal parts: {}'.format(filter))
+import ast
+import operator
+
+import numpy as np
+
+# Names usable in filter expressions and the bluespot statistic they refer to
+FILTER_NAMES = {'area': 'area', 'maxdepth': 'max', 'volume': 'volume'}
+
+_COMPARE_OPS = {
+    ast.Lt: np.less,
+    ast.LtE: np.less_equal,
+    ast.Gt: np.greater,
+    ast.GtE: np.greater_equal,
+    ast.Eq: np.equal,
+    ast.NotEq: np.not_equal,
+}
+
+_BINARY_OPS = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.truediv,
+}
+
+# Division of stats gives inf or nan instead of raising
+_RUNTIME_OPS = {
+    operator.truediv: np.true_divide,
+}
+
+_UNARY_OPS = {
+    ast.Not: np.logical_not,
+    ast.USub: operator.neg,
+    ast.UAdd: operator.pos,
+}
+
+
+class BluespotFilter(object):
+    """Bluespot filter expression compiled to vectorized numpy operations
+
+    Expressions use the names area, maxdepth and volume, numbers, comparisons, arithmetic and the boolean operators
+    and, or and not. For example "maxdepth > 0.05 and (area > 5 or volume > 2.5)".
+
+    Calling the filter with a dict like object of stats returns the result of the expression. When the stats are arrays
+    with one element per bluespot the result is an array of bools. Arithmetic on numbers only is evaluated when the
+    filter is compiled, so errors like division by zero are reported like other unsupported statements. Arithmetic on
+    the stats may give inf or nan, for instance "volume / area" of a label without cells. Comparisons involving those
+    are False.
+
+    Parameters
+    ----------
+    expression : str
+        Filter expression
+    """
+    vectorized = True
+
+    def __init__(self, expression):
+        self.expression = expression
+        try:
+            tree = ast.parse(expression.strip(), mode='eval')
+        except SyntaxError as e:
+            raise Exception('Unsupported filter statement. {}'.format(e))
+        self._evaluate = self._compile(tree.body)
+
+    def __call__(self, stats):
+        with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+            return self._evaluate(stats)
+
+    def __repr__(self):
+        return 'BluespotFilter({!r})'.format(self.expression)
+
+    def _compile(self, node):
+        value = self._fold(node)
+        if value is not None:
+            return lambda stats: value
+        if isinstance(node, ast.BoolOp):
+            combine = np.logical_and if isinstance(node.op, ast.And) else np.logical_or
+            operands = [self._compile(v) for v in node.values]
+            return lambda stats: _reduce_operands(combine, [f(stats) for f in operands])
+        if isinstance(node, ast.Compare):
+            operands = [self._compile(node.left)] + [self._compile(c) for c in node.comparators]
+            ops = [self._lookup(_COMPARE_OPS, op) for op in node.ops]
+
+            def compare(stats):
+                values = [f(stats) for f in operands]
+                # Chained comparisons like "1 < area < 10". Comparisons with inf or nan are False
+                return _reduce_operands(np.logical_and, [op(a, b) & np.isfinite(a) & np.isfinite(b)
+                                                         for op, a, b in zip(ops, values[:-1], values[1:])])
+            return compare
+        if isinstance(node, ast.BinOp):
+            op = self._lookup(_BINARY_OPS, node.op)
+            if op is operator.truediv and self._fold(node.right) == 0:
+                raise Exception('Unsupported filter statement. Division by zero')
+            op = _RUNTIME_OPS.get(op, op)
+            left, right = self._compile(node.left), self._compile(node.right)
+            return lambda stats: op(left(stats), right(stats))
+        if isinstance(node, ast.UnaryOp):
+            op = self._lookup(_UNARY_OPS, node.op)
+            operand = self._compile(node.operand)
+            return lambda stats: op(operand(stats))
+        if isinstance(node, ast.Name):
+            if node.id in FILTER_NAMES:
+                key = FILTER_NAMES[node.id]
+                return lambda stats: stats[key]
+            if node.id in ('True', 'False'):
+                # Python 2 parses booleans as names
+                value = node.id == 'True'
+                return lambda stats: value
+            raise Exception('Unsupported filter statement. Unknown name: {}'.format(node.id))
+        value = _constant_value(node)
+        return lambda stats: value
+
+    def _fold(self, node):
+        """Value of arithmetic on numbers only. None if the node depends on the stats"""
+        if isinstance(node, ast.BinOp):
+            left, right = self._fold(node.left), self._fold(node.right)
+            if left is None or right is None:
+                return None
+            return _arithmetic(self._lookup(_BINARY_OPS, node.op), left, right)
+        if isinstance(node, ast.UnaryOp):
+            operand = self._fold(node.operand)
+            if operand is None:
+                return None
+            return _arithmetic(self._lookup(_UNARY_OPS, node.op), operand)
+        if isinstance(node, (ast.BoolOp, ast.Compare, ast.Name)):
+            return None
+        return _constant_value(node)
+
+    def _lookup(self, ops, op):
+        try:
+            return ops[type(op)]
+        except KeyError:
+            raise Exception('Unsupported filter statement. Illegal operator: {}'.format(type(op).__name__))
+
+
+def _constant_value(node):
+    """Value of a number or boolean constant node"""
+    for node_type, field in (('Constant', 'value'), ('Num', 'n'), ('NameConstant', 'value')):
+        if hasattr(ast, node_type) and isinstance(node, getattr(ast, node_type)):
+            value = getattr(node, field)
+            if isinstance(value, (bool, int, float)):
+                return value
+    raise Exception('Unsupported filter statement. Illegal part: {}'.format(type(node).__name__))
+
+
+def _arithmetic(op, *values):
+    try:
+        return op(*values)
+    except ArithmeticError as e:
+        raise Exception('Unsupported filter statement. Arithmetic error: {}'.format(e))
+
+
+def _reduce_operands(combine, values):
+    result = values[0]
+    for v in values[1:]:
+        result = combine(result, v)
+    return result
 
 
 def parse_filter(filter):
-    if not filter:
-        filter_function = lambda stats: True
-    else:
-        check_filter(filter)
-        # filter_function = lambda stats: stats['max'] > 0.05  # and stats['area'] > 5 and stats['volume'] > 1
-        filter = filter.replace('area', 'stats["area"]')
-        filter = filter.replace('maxdepth', 'stats["max"]')
-        filter = filter.replace('volume', 'stats["volume"]')
-        filter = 'lambda stats: {}'.format(filter)
-        filter_function = eval(filter)
-    return filter_function
+    """Compile a bluespot filter expression
+
+    Parameters
+    ----------
+    filter : str
+        Filter expression like "volume > 2.5". An empty filter keeps all bluespots
+
+    Returns
+    -------
+    BluespotFilter
+    """
+    return BluespotFilter(filter or 'True')
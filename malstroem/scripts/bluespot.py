@@ -22,7 +22,7 @@ import click
 import click_log
 
 from malstroem import io
-from malstroem.bluespots import filterbluespots, assemble_pourpoints
+from malstroem.bluespots import filterbluespots, assemble_pourpoints, MAX_STAGE_BINS
 from ._utils import parse_filter
 from malstroem.algorithms import label, flow, fill
 from osgeo import ogr
@@ -38,6 +38,8 @@ def process_bspots(depths, out, filter):
 
     Assign unique bluespot ID to all cells belonging to a bluespot. Optionally disregarding some bluespots based on a
     filter expression. ID 0 (zero) is used for cells not belonging to a bluespot.
+
+    The depths are labelled in strips of rows so the rasters do not need to fit in memory.
     """
 
     depths_reader = io.RasterReader(depths)
@@ -49,20 +51,27 @@ def process_bspots(depths, out, filter):
     cell_height = abs(transform[5])
     cell_area = cell_width * cell_height
 
-    depths_data = depths_reader.read()
-    raw_labeled, raw_nlabels = label.connected_components(depths_data)
-    if not filter:
-        # This is the end  my friend
-        labeled_writer.write(raw_labeled)
-        return
+    cols = depths_reader.shape[1]
+
+    def read_strip(row_off, strip_rows):
+        return depths_reader.read_block(row_off, 0, strip_rows, cols)
+
+    statistics, keep_function = None, None
+    if filter:
+        statistics = ('min', 'max', 'sum', 'count')
+
+        def keep_function(raw_bluespot_stats):
+            return filterbluespots(filter_function, cell_area, raw_bluespot_stats)
 
-    del depths
+    def write_strip(strip, row_off):
+        # Label datatype is known when the first strip is written
+        if row_off == 0:
+            labeled_writer.create(depths_reader.shape, strip.dtype)
+        labeled_writer.write_block(strip, row_off)
 
-    raw_bluespot_stats = label.label_stats(depths_data, raw_labeled)
-    keepers = filterbluespots(filter_function, cell_area, raw_bluespot_stats)
-    new_components = label.keep_labels(raw_labeled, keepers)
-    labeled, nlabels = label.connected_components(new_components)
-    labeled_writer.write(labeled)
+    label.connected_components_tiled(read_strip, depths_reader.shape, write_strip, statistics=statistics,
+                                     keep_function=keep_function)
+    labeled_writer.close()
 
 
 @click.command('wsheds')
@@ -95,7 +104,13 @@ def process_wsheds(bluespots, flowdir, out):
 @click.option('-layername', type=str, default='pourpoints', show_default=True, help='Output layer name')
 @click.option('-dsco', multiple=True, type=str, nargs=0, help='OGR datasource creation options. See OGR documentation')
 @click.option('-lco', multiple=True, type=str, nargs=0, help='OGR layer creation options. See OGR documentation')
-def process_pourpoints(bluespots, depths, watersheds, dem, accum, out, format, layername, dsco, lco):
+@click.option('-stage_bins', type=click.IntRange(0, MAX_STAGE_BINS), default=0, show_default=True,
+              help='Number of water level steps in the stage-storage curves. 0 disables. '
+                   'At most {}'.format(MAX_STAGE_BINS))
+@click.option('-threads', type=click.IntRange(1, None), default=1, show_default=True,
+              help='Number of threads calculating bluespot stats')
+def process_pourpoints(bluespots, depths, watersheds, dem, accum, out, format, layername, dsco, lco, stage_bins,
+                       threads):
     """Determine pour points.
 
     \b
@@ -105,6 +120,9 @@ def process_pourpoints(bluespots, depths, watersheds, dem, accum, out, format, l
     The output of the two methods only differ when there are more than one pour point candidate (ie multiple threshold
     cells with identical Z) for a given bluespot.
 
+    Each pour point gets the stage-storage curve of its bluespot as the space separated lists stage_h (water level
+    above bluespot bottom), stage_v (stored volume) and stage_a (flooded area).
+
     For documentation of OGR features (format, dsco and lco) see http://www.gdal.org/ogr_formats.html
     """
     bspot_reader = io.RasterReader(bluespots)
@@ -121,23 +139,28 @@ def process_pourpoints(bluespots, depths, watersheds, dem, accum, out, format, l
 
     pourpnt_writer = io.VectorWriter(format, out, layername, [], ogr.wkbPoint, depths_reader.crs, dsco, lco)
 
-    # Recalculate stats on filtered bluespots
+    # Recalculate stats on filtered bluespots and find pour points in the same pass
     labeled_data = bspot_reader.read()
     depths_data = depths_reader.read()
-    bluespot_stats = label.label_stats(depths_data, labeled_data)
-    del depths_data
-
     if accum:
-        pp_pix = label.label_max_index(data_reader.read(), labeled_data)
-    elif dem:
+        pour_data, pour_stat = data_reader.read(), 'argmax'
+    else:
         dem_data = data_reader.read()
         short, diag = fill.minimum_safe_short_and_diag(dem_data)
-        filled_no_flats = fill.fill_terrain_no_flats(dem_data, short, diag)
-        pp_pix = label.label_min_index(filled_no_flats, labeled_data)
+        pour_data, pour_stat = fill.fill_terrain_no_flats(dem_data, short, diag), 'argmin'
         del dem_data
+    bluespot_stats, pour_stats = label.label_aggregate(
+        labeled_data, [(depths_data, ('min', 'max', 'sum', 'count')), (pour_data, (pour_stat,))], threads=threads)
+    pp_pix = label.index_records(pour_data, pour_stats[pour_stat])
+    del pour_data
+    stage_storage = None
+    if stage_bins:
+        stage_storage = label.label_stage_storage(depths_data, labeled_data, bluespot_stats['max'], stage_bins)
+    del depths_data
 
     watershed_stats = label.label_count(wsheds_reader.read())
-    pour_points = assemble_pourpoints(depths_reader.transform, pp_pix, bluespot_stats, watershed_stats)
+    pour_points = assemble_pourpoints(depths_reader.transform, pp_pix, bluespot_stats, watershed_stats,
+                                      stage_storage)
 
     feature_collection = dict(type="FeatureCollection", features=pour_points)
     pourpnt_writer.write_geojson_features(feature_collection)
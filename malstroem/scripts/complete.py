@@ -31,30 +31,48 @@ logger = logging.getLogger(__name__)
 @click.option('--rain', '-r', required=True, multiple=True, type=float, help='Rain incident in mm')
 @click.option('-accum', is_flag=True, help='Calculate accumulated flow')
 @click.option('-vector', is_flag=True, help='Vectorize bluespots and watersheds')
-@click.option('-filter', help='Filter bluespots by area, maximum depth and volume. Format: '
-                               '"area > 20.5 and (maxdepth > 0.05 or volume > 2.5)"')
+@click.option('-filter', multiple=True, help='Filter bluespots by area, maximum depth and volume. Format: '
+                                               '"area > 20.5 and (maxdepth > 0.05 or volume > 2.5)". May be given '
+                                               'multiple times to write one set of outputs per filter')
+@click.option('-simplify', type=float, help='Simplify vector output. Tolerance in cells. Example: 0.75')
+@click.option('-stage_bins', type=click.IntRange(0, bluespots.MAX_STAGE_BINS), default=0, show_default=True,
+              help='Number of water level steps in the bluespot stage-storage curves. 0 disables. '
+                   'At most {}'.format(bluespots.MAX_STAGE_BINS))
+@click.option('-threads', type=click.IntRange(1, None), default=1, show_default=True,
+              help='Number of threads calculating pour point stats')
 @click_log.simple_verbosity_option()
-def process_all(dem, outdir, accum, filter, rain, vector):
+def process_all(dem, outdir, accum, filter, rain, vector, simplify, stage_bins, threads):
     """Quick option to run all processes.
 
     \b
     Example:
     malstroem complete -r 10 -r 30 -filter "volume > 2.5" -dem dem.tif -outdir ./outdir/
+
+    When more than one filter is given, the DEM is processed and the bluespots are labelled once. Bluespots, watersheds,
+    pour points, network and rain events for the i'th filter are written to the subdirectory filter_i of outdir.
     """
     # Check that outdir exists and is empty
     if not os.path.isdir(outdir) or not os.path.exists(outdir) or os.listdir(outdir):
         logger.error("outdir isn't an empty directory")
         return 1
 
-    #outvector = os.path.join(outdir, 'malstroem.gpkg')
-    outvector = os.path.join(outdir, 'vector')
     #ogr_drv = 'gpkg'
     ogr_dsco = []
     ogr_drv = 'ESRI shapefile'
     nodatasubst = -999
 
 
-    filter_function = parse_filter(filter)
+    filters = list(filter) or [None]
+    filter_functions = [parse_filter(f) for f in filters]
+    if len(filters) > 1:
+        setdirs = [os.path.join(outdir, 'filter_{}'.format(i + 1)) for i in range(len(filters))]
+        for d in setdirs:
+            os.mkdir(d)
+    else:
+        setdirs = [outdir]
+    #outvectors = [os.path.join(d, 'malstroem.gpkg') for d in setdirs]
+    outvectors = [os.path.join(d, 'vector') for d in setdirs]
+
     dem_reader = io.RasterReader(dem, nodatasubst=nodatasubst)
     tr = dem_reader.transform
     crs = dem_reader.crs
@@ -64,7 +82,9 @@ def process_all(dem, outdir, accum, filter, rain, vector):
     logger.info('   outdir: {}'.format(outdir))
     logger.info('   rain: {}'.format(', '.join(['{}mm'.format(r) for r in rain])))
     logger.info('   accum: {}'.format(accum))
-    logger.info('   filter: {}'.format(filter))
+    for f, d in zip(filters, setdirs):
+        logger.info('   filter: {} -> {}'.format(f, d))
+    logger.info('   simplify: {}'.format(simplify))
 
     # Process DEM
     filled_writer = io.RasterWriter(os.path.join(outdir, 'filled.tif'), tr, crs, nodatasubst)
@@ -79,40 +99,47 @@ def process_all(dem, outdir, accum, filter, rain, vector):
     depths_reader = io.RasterReader(depths_writer.filepath)
     flowdir_reader = io.RasterReader(flowdir_writer.filepath)
     accum_reader = io.RasterReader(accum_writer.filepath) if accum_writer else None
-    pourpoint_writer = io.VectorWriter(ogr_drv, outvector, 'pourpoints', None, ogr.wkbPoint, crs, dsco=ogr_dsco)
-    watershed_writer = io.RasterWriter(os.path.join(outdir, 'watersheds.tif'), tr, crs, 0)
-    watershed_vector_writer = io.VectorWriter(ogr_drv, outvector, 'watersheds', None, ogr.wkbMultiPolygon, crs, dsco=ogr_dsco) if vector else None
-    labeled_writer = io.RasterWriter(os.path.join(outdir, 'bluespots.tif'), tr, crs, 0)
-    labeled_vector_writer = io.VectorWriter(ogr_drv, outvector, 'bluespots', None, ogr.wkbMultiPolygon, crs, dsco=ogr_dsco) if vector else None
+    pourpoint_writers = [io.VectorWriter(ogr_drv, v, 'pourpoints', None, ogr.wkbPoint, crs, dsco=ogr_dsco)
+                         for v in outvectors]
+    watershed_writers = [io.RasterWriter(os.path.join(d, 'watersheds.tif'), tr, crs, 0) for d in setdirs]
+    watershed_vector_writers = [io.VectorWriter(ogr_drv, v, 'watersheds', None, ogr.wkbMultiPolygon, crs, dsco=ogr_dsco)
+                                for v in outvectors] if vector else None
+    labeled_writers = [io.RasterWriter(os.path.join(d, 'bluespots.tif'), tr, crs, 0) for d in setdirs]
+    labeled_vector_writers = [io.VectorWriter(ogr_drv, v, 'bluespots', None, ogr.wkbMultiPolygon, crs, dsco=ogr_dsco)
+                              for v in outvectors] if vector else None
 
     bluespot_tool = bluespots.BluespotTool(
         input_depths=depths_reader,
         input_flowdir=flowdir_reader,
-        input_bluespot_filter_function=filter_function,
+        input_bluespot_filter_function=filter_functions,
         input_accum=accum_reader,
         input_dem=dem_reader,
-        output_labeled_raster=labeled_writer,
-        output_labeled_vector=labeled_vector_writer,
-        output_pourpoints=pourpoint_writer,
-        output_watersheds_raster=watershed_writer,
-        output_watersheds_vector=watershed_vector_writer
+        output_labeled_raster=labeled_writers,
+        output_labeled_vector=labeled_vector_writers,
+        output_pourpoints=pourpoint_writers,
+        output_watersheds_raster=watershed_writers,
+        output_watersheds_vector=watershed_vector_writers,
+        simplify_tolerance=simplify,
+        stage_storage_bins=stage_bins,
+        threads=threads
     )
     bluespot_tool.process()
 
-    # Process pourpoints
-    pourpoints_reader = io.VectorReader(outvector, pourpoint_writer.layername)
-    bluespot_reader = io.RasterReader(labeled_writer.filepath)
-    flowdir_reader = io.RasterReader(flowdir_writer.filepath)
-    nodes_writer = io.VectorWriter(ogr_drv, outvector, 'nodes', None, ogr.wkbPoint, crs, dsco=ogr_dsco)
-    streams_writer = io.VectorWriter(ogr_drv, outvector, 'streams', None, ogr.wkbLineString, crs, dsco=ogr_dsco)
-
-    stream_tool = streams.StreamTool(pourpoints_reader, bluespot_reader, flowdir_reader, nodes_writer, streams_writer)
-    stream_tool.process()
+    for outvector, pourpoint_writer, labeled_writer in zip(outvectors, pourpoint_writers, labeled_writers):
+        # Process pourpoints
+        pourpoints_reader = io.VectorReader(outvector, pourpoint_writer.layername)
+        bluespot_reader = io.RasterReader(labeled_writer.filepath)
+        flowdir_reader = io.RasterReader(flowdir_writer.filepath)
+        nodes_writer = io.VectorWriter(ogr_drv, outvector, 'nodes', None, ogr.wkbPoint, crs, dsco=ogr_dsco)
+        streams_writer = io.VectorWriter(ogr_drv, outvector, 'streams', None, ogr.wkbLineString, crs, dsco=ogr_dsco)
 
-    # Process rain events
-    nodes_reader = io.VectorReader(outvector, nodes_writer.layername)
-    events_writer = io.VectorWriter(ogr_drv, outvector, 'events', None, ogr.wkbPoint, crs, dsco=ogr_dsco)
+        stream_tool = streams.StreamTool(pourpoints_reader, bluespot_reader, flowdir_reader, nodes_writer,
+                                         streams_writer, simplify_tolerance=simplify)
+        stream_tool.process()
 
-    rain_tool = raintool.RainTool(nodes_reader, events_writer, rain)
-    rain_tool.process()
+        # Process rain events
+        nodes_reader = io.VectorReader(outvector, nodes_writer.layername)
+        events_writer = io.VectorWriter(ogr_drv, outvector, 'events', None, ogr.wkbPoint, crs, dsco=ogr_dsco)
 
+        rain_tool = raintool.RainTool(nodes_reader, events_writer, rain)
+        rain_tool.process()
@@ -17,43 +17,139 @@ from builtins import (ascii, bytes, chr, dict, filter, hex, input,
                       int, map, next, oct, open, pow, range, round,
                       super, zip)  # str
 
+import os
+
 import click
 import click_log
 
 from osgeo import ogr
 from malstroem import io, rain as raintool
+from malstroem.network import MAX_ENSEMBLE_BINS
 
 
 @click.command('rain')
-@click.option('-nodes', required=True, help='OGR datasource containing nodes layer')
+@click.option('-nodes', help='OGR datasource containing nodes layer')
 @click.option('-nodes_layer', default='nodes', show_default=True, help='Nodes layer name ')
-@click.option('--rain', '-r', required=True, multiple=True, type=float, help='Rain event in mm')
-@click.option('-out', required=True, help='Output OGR datasource')
+@click.option('-network', type=click.Path(exists=True),
+              help='Binary network file as written by network. Can be used instead of -nodes')
+@click.option('--rain', '-r', multiple=True, type=float, help='Rain event in mm')
+@click.option('-rain_raster', multiple=True, type=click.Path(exists=True),
+              help='Raster with rain in mm for each cell. Requires -watersheds')
+@click.option('-watersheds', type=click.Path(exists=True), help='Watersheds raster as created by wsheds')
+@click.option('-thresholds', is_flag=True,
+              help='Add the rain depths at which each bluespot starts to spill (spill_mm) and receive water from '
+                   'upstream (inflow_mm)')
+@click.option('-ensemble', type=int, default=0, help='Number of Monte Carlo scenarios for each rain event')
+@click.option('-rain_cv', type=float, default=0.0, show_default=True,
+              help='Coefficient of variation of rain depth in ensemble scenarios')
+@click.option('-vol_cv', type=float, default=0.0, show_default=True,
+              help='Coefficient of variation of bluespot capacities in ensemble scenarios')
+@click.option('-seed', type=int, help='Seed for ensemble random numbers')
+@click.option('-ensemble_bins', type=click.IntRange(1, MAX_ENSEMBLE_BINS), default=20, show_default=True,
+              help='Number of percent filled histogram bins per node for the ensemble quantiles. Quantiles are exact to '
+                   'within 100 / ensemble_bins percent. Memory use is nodes * ensemble_bins counts')
+@click.option('-processes', type=int, default=1, show_default=True,
+              help='Number of processes used to evaluate independent stream trees in parallel')
+@click.option('-out', help='Output OGR datasource')
 @click.option('-out_layer', default='events', show_default=True, help='Layer name of output events layer')
 @click.option('-format', type=str, default='ESRI shapefile', help='OGR driver. See OGR documentation')
 @click.option('-dsco', multiple=True, type=str, nargs=0, help='OGR datasource creation options. See OGR documentation')
 @click.option('-lco', multiple=True, type=str, nargs=0, help='OGR layer creation options. See OGR documentation')
+@click.option('-out_table', type=click.Path(exists=False),
+              help='Output event table. CSV file with one row per node and event or .npz file with dense arrays')
+@click.option('-bluespots', type=click.Path(exists=True), help='Bluespots file. Required with -out_rasters')
+@click.option('-out_rasters', type=click.Path(exists=True, file_okay=False),
+              help='Output directory for event rasters of bluespot values')
+@click.option('-raster_values', multiple=True, default=['pctv'], show_default=True,
+              type=click.Choice(['rainv', 'spillv', 'v', 'pctv']), help='Values to write as event rasters')
+@click.option('-depths', type=click.Path(exists=True), help='Bluespot depths file. Required with -out_flood')
+@click.option('-out_flood', type=click.Path(exists=True, file_okay=False),
+              help='Output directory for event water depth rasters. Requires -bluespots and -depths')
 @click_log.simple_verbosity_option()
-def process_rain(nodes, nodes_layer, rain, out, out_layer, format, dsco, lco):
+def process_rain(nodes, nodes_layer, network, rain, rain_raster, watersheds, thresholds, ensemble, rain_cv, vol_cv,
+                 seed, ensemble_bins, processes, out, out_layer, format, dsco, lco, out_table, bluespots, out_rasters,
+                 raster_values, depths, out_flood):
     """Calculate bluespot fill and spill volumes for specific rain event.
 
     The rain event is evenly distributed across the entire area.
 
     Note that multiple rain events can be calculated at once by repeating the '-r' option.
 
+    Nodes are read from either the nodes layer or a binary network file ('-network') which loads much faster.
+
+    Rain varying across the area is given as a raster with rain in mm for each cell using '-rain_raster' together with
+    the watersheds raster from 'wsheds'. Output properties of the first rain raster are suffixed '_r1', the second
+    '_r2' and so on.
+
+    Use '-thresholds' to also output the rain depth at which each bluespot starts to spill and the rain depth at which
+    water starts flowing into it from upstream.
+
+    Use '-ensemble' to evaluate a number of Monte Carlo scenarios for each '-r' event where the rain depth and the
+    bluespot capacities vary randomly ('-rain_cv' and '-vol_cv'). The output gets the spill probability (spprob), mean
+    and standard deviation of the filled volume (vmean, vstd), mean spilled volume (spmean) and the 5%, 50% and 95%
+    quantiles of the percent filled (pq5, pq50, pq95).
+
     \b
     Example:
     malstroem rain -r 10 -r 30 -nodes results.gpkg -out results.gpkg -format gpkg
 
+    With '-out_table' the event data is written in bulk as a table instead of as properties of the nodes. A '.npz' file
+    gets a dense array for each value. Other files are written as CSV with one row per node and event.
+
+    With '-out_rasters' a raster is written for each event and value in '-raster_values' where each bluespot cell
+    holds the value of its bluespot. For instance 'pctv_10.tif' holds the percent filled for the 10mm event.
+
+    With '-out_flood' a water depth raster is written for each event. For instance 'flood_10.tif' for the 10mm event.
+    The water level of each bluespot is found from its filled volume using the stage-storage curves which 'pourpts'
+    adds to the pour points and 'network' copies to the nodes.
+
     For documentation of OGR features (format, dsco and lco) see http://www.gdal.org/ogr_formats.html
     """
     nodes_layer = str(nodes_layer)
     format = str(format)
     out_layer = str(out_layer)
 
+    if not out and not out_table:
+        raise click.UsageError("At least one of -out and -out_table must be given")
+    if bool(nodes) == bool(network):
+        raise click.UsageError("Exactly one of -nodes and -network must be given")
+    if not rain and not rain_raster:
+        raise click.UsageError("At least one rain event must be given using -r or -rain_raster")
+    if rain_raster and not watersheds:
+        raise click.UsageError("-watersheds is required with -rain_raster")
+    if out_rasters and not bluespots:
+        raise click.UsageError("-bluespots is required with -out_rasters")
+    if out_flood and not (bluespots and depths):
+        raise click.UsageError("-bluespots and -depths are required with -out_flood")
+    if ensemble and not rain:
+        raise click.UsageError("-ensemble requires at least one '-r' rain event")
+
+    nodes_reader = io.NetworkReader(network) if network else io.VectorReader(nodes, nodes_layer)
+    events_writer = io.VectorWriter(format, out, out_layer, None, ogr.wkbPoint, nodes_reader.crs, dsco, lco) \
+        if out else None
+    table_writer = None
+    if out_table:
+        table_writer = io.EventArrayWriter(out_table) if out_table.lower().endswith('.npz') else \
+            io.EventTableWriter(out_table)
+
+    rain_readers = [io.RasterReader(r) for r in rain_raster]
+    watersheds_reader = io.RasterReader(watersheds) if watersheds else None
 
-    nodes_reader = io.VectorReader(nodes, nodes_layer)
-    events_writer = io.VectorWriter(format, out, out_layer, None, ogr.wkbPoint, nodes_reader.crs, dsco, lco)
+    bluespots_reader = io.RasterReader(bluespots) if bluespots else None
+    event_raster_writer = None
+    if out_rasters:
+        def event_raster_writer(prop, event):
+            filepath = os.path.join(out_rasters, '{}_{}.tif'.format(prop, event))
+            return io.RasterWriter(filepath, bluespots_reader.transform, bluespots_reader.crs, -1)
+    depths_reader = io.RasterReader(depths) if depths else None
+    flood_raster_writer = None
+    if out_flood:
+        def flood_raster_writer(event):
+            filepath = os.path.join(out_flood, 'flood_{}.tif'.format(event))
+            return io.RasterWriter(filepath, bluespots_reader.transform, bluespots_reader.crs, -1)
 
-    rain_tool = raintool.RainTool(nodes_reader, events_writer, rain)
+    rain_tool = raintool.RainTool(nodes_reader, events_writer, rain, thresholds, rain_readers, watersheds_reader,
+                                  ensemble, rain_cv, vol_cv, seed, processes, table_writer, bluespots_reader,
+                                  event_raster_writer, raster_values, depths_reader, flood_raster_writer,
+                                  ensemble_bins=ensemble_bins)
     rain_tool.process()
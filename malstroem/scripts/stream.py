@@ -37,10 +37,22 @@ from malstroem import io, streams
 @click.option('-format', type=str, default='ESRI shapefile', help='OGR driver. See OGR documentation')
 @click.option('-dsco', multiple=True, type=str, nargs=0, help='OGR datasource creation options. See OGR documentation')
 @click.option('-lco', multiple=True, type=str, nargs=0, help='OGR layer creation options. See OGR documentation')
+@click.option('-simplify', type=float, help='Simplify streams. Tolerance in cells. Example: 0.75')
+@click.option('-out_streams_raster', type=click.Path(exists=False), help='Output file (raster of stream segment ids)')
+@click.option('-no_streams', is_flag=True, help='Do not write streams layer. Streams raster then holds pour point ids')
+@click.option('-out_network', type=click.Path(exists=False),
+              help='Output binary network file (.npz) for fast loading in rain')
 @click_log.simple_verbosity_option()
-def process_network(bluespots, flowdir, pourpoints, pourpoints_layer, out, out_nodes_layer, out_streams_layer, format, dsco, lco):
+def process_network(bluespots, flowdir, pourpoints, pourpoints_layer, out, out_nodes_layer, out_streams_layer, format, dsco, lco, simplify,
+                    out_streams_raster, no_streams, out_network):
     """Calculate stream network between bluespots.
 
+    Optionally writes a raster where each cell on a stream holds the node id of the stream segment. With '-no_streams'
+    the vector streams are not calculated and each stream cell holds the id of the pour point where the stream starts.
+
+    Optionally writes the nodes and stream network to a binary network file which can be used instead of the nodes
+    layer in 'rain'.
+
     For documentation of OGR features (format, dsco and lco) see http://www.gdal.org/ogr_formats.html
     """
     pourpoints_reader = io.VectorReader(pourpoints, str(pourpoints_layer))
@@ -52,7 +64,13 @@ def process_network(bluespots, flowdir, pourpoints, pourpoints_layer, out, out_n
     out_streams_layer = str(out_streams_layer)
 
     nodes_writer = io.VectorWriter(format, out, out_nodes_layer, None, ogr.wkbPoint, flowdir_reader.crs, dsco, lco)
-    streams_writer = io.VectorWriter(format, out, out_streams_layer, None, ogr.wkbLineString, flowdir_reader.crs, dsco, lco)
+    streams_writer = None if no_streams else \
+        io.VectorWriter(format, out, out_streams_layer, None, ogr.wkbLineString, flowdir_reader.crs, dsco, lco)
+    streams_raster_writer = io.RasterWriter(out_streams_raster, flowdir_reader.transform, flowdir_reader.crs, -1) \
+        if out_streams_raster else None
+    network_writer = io.NetworkWriter(out_network, flowdir_reader.crs) if out_network else None
 
-    stream_tool = streams.StreamTool(pourpoints_reader, bluespot_reader, flowdir_reader, nodes_writer, streams_writer)
+    stream_tool = streams.StreamTool(pourpoints_reader, bluespot_reader, flowdir_reader, nodes_writer, streams_writer,
+                                     simplify_tolerance=simplify, output_streams_raster=streams_raster_writer,
+                                     output_network=network_writer)
     stream_tool.process()
@@ -14,7 +14,7 @@
 from __future__ import (absolute_import, division, print_function, unicode_literals)
 from builtins import *
 
-from malstroem.vector import transform_cell_to_world
+from malstroem.vector import transform_cells_to_world, simplify_geojson_features
 from malstroem.algorithms import net
 
 import logging
@@ -35,16 +35,28 @@ class StreamTool(object):
         Writes resulting nodes
     output_streams : vectorwriter, optional
         Writes streams
+    simplify_tolerance : float, optional
+        Simplify streams using this tolerance (in cells). Stream end points are never moved
+    output_streams_raster : rasterwriter, optional
+        Writes raster where each cell on a stream holds the id of the stream. If output_streams is present the id is
+        the node id of the stream segment. Otherwise it is the id of the pour point where the stream starts.
+    output_network : networkwriter, optional
+        Writes nodes and stream network to a binary network file for fast loading in RainTool
     """
 
     def __init__(self, input_pourpoints, input_bluespots, input_flowdir,
-                 output_nodes, output_streams=None):
+                 output_nodes, output_streams=None, simplify_tolerance=None, output_streams_raster=None,
+                 output_network=None):
         self.input_pourpoints = input_pourpoints
         self.input_bluespots = input_bluespots
         self.input_flowdir = input_flowdir
 
         self.output_nodes = output_nodes
         self.output_streams = output_streams
+        self.output_streams_raster = output_streams_raster
+        self.output_network = output_network
+
+        self.simplify_tolerance = simplify_tolerance
 
         self.logger = logging.getLogger(__name__)
 
@@ -77,8 +89,9 @@ class StreamTool(object):
         pp_index = {pp['properties']['bspot_id']: pp for pp in pourpoints}
 
         # Create geojson point nodes and copy info from pourpoints where node is a pourpoint
+        node_coords = transform_cells_to_world([n['pix'] for n in nodes], transform)
         geojson_nodes = []
-        for n in nodes:
+        for n, coord in zip(nodes, node_coords.tolist()):
             props = dict()
             props['nodeid'] = n['id']
             props['dstrnodeid'] = n['downstream_id']
@@ -98,26 +111,51 @@ class StreamTool(object):
                 props['bspot_area'] = ppoint['properties']['bspot_area']
                 props['bspot_vol'] = ppoint['properties']['bspot_vol']
                 props['wshed_area'] = ppoint['properties']['wshed_area']
+                # Stage-storage curves are optional
+                for key in ('stage_h', 'stage_v', 'stage_a'):
+                    if key in ppoint['properties']:
+                        props[key] = ppoint['properties'][key]
 
             # Geometry
-            coord = transform_cell_to_world(n['pix'], transform)
-            geom = dict(type='Point', coordinates=list(coord))
+            geom = dict(type='Point', coordinates=coord)
             geojson = dict(id=n['id'], geometry=geom, properties=props)
             geojson_nodes.append(geojson)
 
         self.output_nodes.write_geojson_features(geojson_nodes)
+        if self.output_network:
+            self.logger.info("Writing network file")
+            self.output_network.write_geojson_features(geojson_nodes)
+
+        if self.output_streams_raster:
+            self.logger.info("Writing streams raster")
+            nodata = -1 if self.output_streams_raster.nodata is None else self.output_streams_raster.nodata
+            if self.output_streams is not None:
+                streams_raster = net.burn_stream_segments(nodes, flowdir.shape, nodata)
+            else:
+                streams_raster = net.burn_pourpoint_streams(flowdir, labeled_bluespots, pourpoints_pix, 0, nodata)
+            self.output_streams_raster.write(streams_raster)
+            del streams_raster
 
         if self.output_streams:
+            stream_nodes = [n for n in nodes if n['geometry']]
             geojson_streams = []
-            for n in nodes:
-                if n['geometry']:
-                    props = dict()
-                    props['nodeid'] = n['id']
-                    props['dstrnodeid'] = n['downstream_id']
-
-                    # Transform coords
-                    world_coords = [transform_cell_to_world(c, transform) for c in n['geometry']]
-                    geom = dict(type='LineString', coordinates=list(world_coords))
-                    geojson = dict(id=n['id'], geometry=geom, properties=props)
-                    geojson_streams.append(geojson)
+            if stream_nodes:
+                # All paths live in the same tree. Transform all cells of all paths in one go
+                tree = stream_nodes[0]['geometry'].tree
+                cells, offsets = tree.path_cells([n['geometry'].start for n in stream_nodes],
+                                                 [len(n['geometry']) for n in stream_nodes])
+                world_coords = transform_cells_to_world(cells, transform)
+                geojson_streams = self._geojson_streams(stream_nodes, world_coords, offsets)
+            if self.simplify_tolerance is not None:
+                self.logger.info("Simplifying streams")
+                geojson_streams = simplify_geojson_features(geojson_streams, self.simplify_tolerance * cell_width)
             self.output_streams.write_geojson_features(geojson_streams)
+
+    def _geojson_streams(self, stream_nodes, world_coords, offsets):
+        for i, n in enumerate(stream_nodes):
+            props = dict()
+            props['nodeid'] = n['id']
+            props['dstrnodeid'] = n['downstream_id']
+
+            geom = dict(type='LineString', coordinates=world_coords[offsets[i]:offsets[i + 1]].tolist())
+            yield dict(id=n['id'], geometry=geom, properties=props)
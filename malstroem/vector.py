@@ -14,7 +14,9 @@
 from __future__ import (absolute_import, division, print_function) #, unicode_literals)
 from builtins import *
 
+import bisect
 import json
+import numpy as np
 from osgeo import gdal, ogr
 
 
@@ -39,6 +41,309 @@ def transform_cell_to_world(cell, geotransform):
     return (x, y)
 
 
+def transform_cells_to_world(cells, geotransform):
+    """Transform a number of cell coordinates to world coordinates.
+
+    Parameters
+    ----------
+    cells : array_like
+        (N, 2) array of (row, col) pairs.
+
+    geotransform : list of 6 numbers
+        GDAL style of affine transformation parameters.
+
+    Returns
+    -------
+        (N, 2) array of world coordinates (Xworld, Yworld)
+
+    """
+    cells = np.asarray(cells).reshape((-1, 2))
+    row = cells[:, 0] + 0.5
+    col = cells[:, 1] + 0.5
+    x = geotransform[0] + col * geotransform[1] + row * geotransform[2]
+    y = geotransform[3] + col * geotransform[4] + row * geotransform[5]
+    return np.column_stack((x, y))
+
+
+def simplify_coords(coords, tolerance):
+    """Simplify a line following cell centres or cell edges.
+
+    Vertices in the middle of straight runs are always removed. Staircases from D8 flow and pixel edges are collapsed
+    using the Douglas-Peucker algorithm. First and last vertex are always kept, so lines meeting at their end points
+    (like streams meeting at nodes) stay connected.
+
+    Parameters
+    ----------
+    coords : array_like
+        (N, 2) array of coordinates
+    tolerance : float
+        Maximum distance between the original line and the simplified line. A tolerance of 0 only removes vertices
+        on straight runs.
+
+    Returns
+    -------
+    (M, 2) array of coordinates. M <= N
+
+    """
+    coords = np.asarray(coords, dtype=np.float64)
+    if len(coords) < 3:
+        return coords
+    keep = np.zeros((len(coords),), dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(coords) - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        start = coords[first]
+        segment = coords[last] - start
+        offsets = coords[first + 1:last] - start
+        length = np.hypot(segment[0], segment[1])
+        if length > 0:
+            distances = np.abs(segment[0] * offsets[:, 1] - segment[1] * offsets[:, 0]) / length
+        else:
+            # Closed ring. Distance to start point
+            distances = np.hypot(offsets[:, 0], offsets[:, 1])
+        ix = int(np.argmax(distances))
+        # Allow for round off when coordinates are not integers
+        if distances[ix] > tolerance + 1e-9 * length or (length == 0 and distances[ix] > 0):
+            ix += first + 1
+            keep[ix] = True
+            stack.append((first, ix))
+            stack.append((ix, last))
+    return coords[keep]
+
+
+def simplify_geojson_features(features, tolerance):
+    """Simplify the geometries of a stream of geojson features.
+
+    LineString geometries are simplified one at a time using `simplify_coords`. Polygon and MultiPolygon geometries
+    are simplified together preserving their topology:
+
+    - Rings are split into arcs at the vertices where the neighbouring polygons change. A border shared by two
+      polygons is one arc which is simplified once and reused by both, so neighbours never get gaps or overlaps.
+    - Arc end points are never moved.
+    - Arcs of a ring which would collapse and arcs which would cross another arc after simplification only have
+      vertices on straight runs removed.
+
+    The arcs of a polygon depend on all of its neighbours, which may come anywhere in the stream. Polygon features are
+    therefore collected before any of them are yielded. Only their vertices are held while collecting. Other geometries
+    are passed through unchanged.
+
+    Parameters
+    ----------
+    features : iterable
+        Geojson formatted features
+    tolerance : float
+        Maximum distance between the original and the simplified geometry in geometry coordinate units.
+
+    Yields
+    -------
+    feature : dict
+        Geojson formatted feature with simplified geometry
+
+    """
+    polygons = []
+    rings = []
+    for f in features:
+        geom = f.get('geometry')
+        if geom and geom['type'] == 'LineString':
+            geom['coordinates'] = simplify_coords(geom['coordinates'], tolerance).tolist()
+        elif geom and geom['type'] in ('Polygon', 'MultiPolygon'):
+            parts = [geom['coordinates']] if geom['type'] == 'Polygon' else geom['coordinates']
+            rings.extend([tuple(tuple(v) for v in r) for r in p] for p in parts)
+            # The coordinates are replaced when the polygons are simplified
+            geom['coordinates'] = None
+            polygons.append((f, len(parts)))
+            continue
+        yield f
+
+    simplified = iter(_simplify_polygons(rings, tolerance))
+    del rings
+    for f, nparts in polygons:
+        geom = f['geometry']
+        if geom['type'] == 'Polygon':
+            geom['coordinates'] = next(simplified)
+        else:
+            geom['coordinates'] = [next(simplified) for _ in range(nparts)]
+        yield f
+
+
+def _simplify_polygons(polygons, tolerance):
+    """Simplify polygons sharing borders. Each polygon is a list of closed rings of vertex tuples"""
+    rings = _split_segments_at_vertices([r for p in polygons for r in p])
+    arcs, ring_arcs = _ring_arcs(rings)
+    keys = list(arcs)
+    simplified = dict((k, simplify_coords(arcs[k], tolerance)) for k in keys)
+    exact = set()
+    while True:
+        # Arcs which make a ring collapse or cross another arc keep the original shape
+        demote = set()
+        for ring in ring_arcs:
+            if sum(len(simplified[k]) - 1 for k, _ in ring) < 3:
+                demote.update(k for k, _ in ring)
+        demote.update(_crossing_arcs(keys, simplified))
+        demote -= exact
+        if not demote:
+            break
+        for k in demote:
+            simplified[k] = simplify_coords(arcs[k], 0)
+        exact |= demote
+
+    result = []
+    ring_ix = 0
+    for p in polygons:
+        polygon = []
+        for _ in p:
+            coords = [simplified[k][::-1] if reverse else simplified[k] for k, reverse in ring_arcs[ring_ix]]
+            ring = np.concatenate([coords[0]] + [c[1:] for c in coords[1:]])
+            polygon.append(ring.tolist())
+            ring_ix += 1
+        result.append(polygon)
+    return result
+
+
+def _split_segments_at_vertices(rings):
+    """Insert vertices of all rings which lie inside an axis parallel segment of another ring
+
+    Polygonized rasters only have vertices where the boundary turns. A straight border of one polygon may be shared
+    with several neighbours which each have vertices along it.
+    """
+    by_x, by_y = {}, {}
+    for ring in rings:
+        for x, y in ring:
+            by_x.setdefault(x, set()).add(y)
+            by_y.setdefault(y, set()).add(x)
+    by_x = dict((k, sorted(v)) for k, v in by_x.items())
+    by_y = dict((k, sorted(v)) for k, v in by_y.items())
+    result = []
+    for ring in rings:
+        split = [ring[0]]
+        for a, b in zip(ring[:-1], ring[1:]):
+            if a[0] == b[0]:
+                between = _values_between(by_x[a[0]], a[1], b[1])
+                split.extend((a[0], y) for y in between)
+            elif a[1] == b[1]:
+                between = _values_between(by_y[a[1]], a[0], b[0])
+                split.extend((x, a[1]) for x in between)
+            split.append(b)
+        result.append(split)
+    return result
+
+
+def _values_between(values, start, stop):
+    """Values strictly between start and stop ordered from start to stop"""
+    lo, hi = min(start, stop), max(start, stop)
+    between = values[bisect.bisect_right(values, lo):bisect.bisect_left(values, hi)]
+    return between if start < stop else between[::-1]
+
+
+def _ring_arcs(rings):
+    """Split rings into arcs at the vertices where the polygons on the other side change
+
+    Returns
+    -------
+    arcs : dict
+        Arc coordinates (N, 2) by arc key. An arc shared by several rings appears once
+    ring_arcs : list
+        For each ring a list of (arc key, reversed) making up the ring
+    """
+    owners = {}
+    neighbours = {}
+    for ix, ring in enumerate(rings):
+        for a, b in zip(ring[:-1], ring[1:]):
+            owners.setdefault((min(a, b), max(a, b)), set()).add(ix)
+            neighbours.setdefault(a, set()).add(b)
+            neighbours.setdefault(b, set()).add(a)
+
+    arcs = {}
+    ring_arcs = []
+    for ix, ring in enumerate(rings):
+        vertices = ring[:-1]
+        n = len(vertices)
+        edge_owners = [owners[(min(a, b), max(a, b))] for a, b in zip(ring[:-1], ring[1:])]
+        nodes = [i for i in range(n)
+                 if edge_owners[i - 1] != edge_owners[i] or len(neighbours[vertices[i]]) > 2]
+        if not nodes:
+            # Ring without junctions. Start at the smallest vertex so rings on both sides get the same arc
+            start = vertices.index(min(vertices))
+            forward = tuple(vertices[start:] + vertices[:start + 1])
+            backward = forward[::-1]
+            key = min(forward, backward)
+            arcs.setdefault(key, np.array(key, dtype=np.float64))
+            ring_arcs.append([(key, key != forward)])
+            continue
+        pieces = []
+        for first, last in zip(nodes, nodes[1:] + [nodes[0] + n]):
+            forward = tuple(vertices[i % n] for i in range(first, last + 1))
+            backward = forward[::-1]
+            key = min(forward, backward)
+            arcs.setdefault(key, np.array(key, dtype=np.float64))
+            pieces.append((key, key != forward))
+        ring_arcs.append(pieces)
+    return arcs, ring_arcs
+
+
+def _crossing_arcs(keys, simplified):
+    """Keys of arcs with a segment crossing a segment of another arc or a non adjacent segment of the same arc"""
+    starts = np.concatenate([simplified[k][:-1] for k in keys]) if keys else np.zeros((0, 2))
+    stops = np.concatenate([simplified[k][1:] for k in keys]) if keys else np.zeros((0, 2))
+    arc_of = np.repeat(np.arange(len(keys)), [len(simplified[k]) - 1 for k in keys])
+    if len(starts) < 2:
+        return set()
+
+    # Index segments in a grid of cells to only test segments near each other. Each segment is entered in all cells
+    # its bounding box covers
+    lower = np.minimum(starts, stops)
+    upper = np.maximum(starts, stops)
+    size = max(float(np.median(np.max(upper - lower, axis=1))), 1e-9)
+    cell_lower = np.floor(lower / size).astype(np.int64)
+    cell_span = np.floor(upper / size).astype(np.int64) - cell_lower + 1
+    ncells = cell_span[:, 0] * cell_span[:, 1]
+    segment = np.repeat(np.arange(len(starts)), ncells)
+    local = np.arange(len(segment)) - np.repeat(np.cumsum(ncells) - ncells, ncells)
+    cx = cell_lower[segment, 0] + local // cell_span[segment, 1]
+    cy = cell_lower[segment, 1] + local % cell_span[segment, 1]
+
+    # Sort entries by cell and pair each entry with the following entries in the same cell
+    order = np.lexsort((segment, cy, cx))
+    segment, cx, cy = segment[order], cx[order], cy[order]
+    new_cell = np.concatenate(([True], (cx[1:] != cx[:-1]) | (cy[1:] != cy[:-1])))
+    cell_start = np.flatnonzero(new_cell)
+    cell_count = np.diff(np.append(cell_start, len(segment)))
+    position = np.arange(len(segment)) - np.repeat(cell_start, cell_count)
+    partners = np.repeat(cell_count, cell_count) - position - 1
+    first = np.repeat(np.arange(len(segment)), partners)
+    second = first + 1 + np.arange(len(first)) - np.repeat(np.cumsum(partners) - partners, partners)
+    i, j = segment[first], segment[second]
+
+    # Segments sharing several cells are only tested once
+    pair = np.unique(i * len(starts) + j)
+    i, j = pair // len(starts), pair % len(starts)
+    hit = _segments_cross(starts[i], stops[i], starts[j], stops[j])
+    crossing = np.unique(np.concatenate((arc_of[i[hit]], arc_of[j[hit]])))
+    return set(keys[ix] for ix in crossing.tolist())
+
+
+def _segments_cross(a, b, c, d):
+    """True where segment a-b properly crosses segment c-d or an end point of one lies inside the other"""
+    def orientation(p, q, r):
+        return np.sign((q[:, 0] - p[:, 0]) * (r[:, 1] - p[:, 1]) - (q[:, 1] - p[:, 1]) * (r[:, 0] - p[:, 0]))
+
+    def inside(p, q, r):
+        # r is on the line through p and q. Is it strictly between them
+        lo, hi = np.minimum(p, q), np.maximum(p, q)
+        within = np.all((r >= lo) & (r <= hi), axis=1)
+        return within & np.any(r != p, axis=1) & np.any(r != q, axis=1)
+
+    o1, o2 = orientation(a, b, c), orientation(a, b, d)
+    o3, o4 = orientation(c, d, a), orientation(c, d, b)
+    proper = (o1 * o2 < 0) & (o3 * o4 < 0)
+    touching = (((o1 == 0) & inside(a, b, c)) | ((o2 == 0) & inside(a, b, d)) |
+                ((o3 == 0) & inside(c, d, a)) | ((o4 == 0) & inside(c, d, b)))
+    return proper | touching
+
+
 def vectorize_labels_file(labeled_file, id_attribute='bspot_id'):
     """Vectorize bluespot id raster
 
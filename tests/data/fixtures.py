@@ -62,3 +62,9 @@ def wshedsdatadata():
 def pourpointsdata():
     reader = io.VectorReader(pourpointsfile)
     return reader.read_geojson_features()
+
+
+@pytest.fixture
+def nodesdata():
+    reader = io.VectorReader(nodesfile)
+    return reader.read_geojson_features()
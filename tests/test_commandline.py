@@ -2,6 +2,8 @@ from click.testing import CliRunner
 
 from malstroem.scripts.cli import cli
 from malstroem import io
+from malstroem.bluespots import stage_storage_curves
+from malstroem.algorithms import label
 from data.fixtures import dtmfile, filledfile, flowdirnoflatsfile, depthsfile, labeledfile, wshedsfile, pourpointsfile, nodesfile
 import numpy as np
 import os
@@ -47,6 +49,27 @@ def test_complete_nofilter(tmpdir):
     assert len(data) == 587, result.output
 
 
+def test_complete_multiple_filters(tmpdir):
+    runner = CliRunner()
+    result = runner.invoke(cli, ['complete',
+                                 '-r', 10,
+                                 '-filter', 'area > 20.5 and maxdepth > 0.5 or volume > 2.5',
+                                 '-filter', '',
+                                 '-dem', dtmfile,
+                                 '-outdir', str(tmpdir)])
+    assert result.exit_code == 0, result.output
+    assert os.path.isfile(str(tmpdir.join('filled.tif')))
+    assert not os.path.isfile(str(tmpdir.join('bluespots.tif')))
+
+    # Same results as separate runs with each filter
+    for setdir, expected, events in [('filter_1', 486, 544), ('filter_2', 523, 587)]:
+        r = io.RasterReader(str(tmpdir.join(setdir, 'bluespots.tif')))
+        assert np.max(r.read()) == expected, result.output
+        assert os.path.isfile(str(tmpdir.join(setdir, 'watersheds.tif')))
+        v = io.VectorReader(str(tmpdir.join(setdir, 'vector')), 'events')
+        assert len(v.read_geojson_features()) == events, result.output
+
+
 def test_filled(tmpdir):
     ff = str(tmpdir.join('filled.tif'))
     runner = CliRunner()
@@ -103,6 +126,15 @@ def test_bspot(tmpdir):
     assert os.path.isfile(f)
 
 
+def test_bspot_strips(tmpdir):
+    f = str(tmpdir.join('bspots.tif'))
+    runner = CliRunner()
+    result = runner.invoke(cli, ['bspots',
+                                 '-depths', depthsfile,
+                                 '-out', f])
+    assert result.exit_code == 0, result.output
+    expected, _ = label.connected_components(io.RasterReader(depthsfile).read())
+    assert np.all(io.RasterReader(f).read() == expected)
 
 
 def test_filtered_bspot(tmpdir):
@@ -142,6 +174,55 @@ def test_pourpoints(tmpdir):
     assert os.path.isfile(str(tmpdir.join('pourpoints.shp')))
 
 
+def test_pourpoints_stage_storage(tmpdir):
+    runner = CliRunner()
+    result = runner.invoke(cli, ['pourpts',
+                                 '-bluespots', labeledfile,
+                                 '-depths', depthsfile,
+                                 '-watersheds', wshedsfile,
+                                 '-dem', dtmfile,
+                                 '-stage_bins', 5,
+                                 '-out', str(tmpdir)])
+    assert result.exit_code == 0, result.output
+    pourpoints = io.VectorReader(str(tmpdir), 'pourpoints').read_geojson_features()
+    curves = stage_storage_curves([p['properties'] for p in pourpoints])
+    assert len(curves) == len(pourpoints)
+    for p in pourpoints:
+        stage, volume, area = curves[p['properties']['bspot_id']]
+        assert len(stage) == len(volume) == len(area) == 6
+        assert np.isclose(volume[-1], p['properties']['bspot_vol'], rtol=1e-4)
+        assert np.isclose(area[-1], p['properties']['bspot_area'], rtol=1e-4)
+
+
+def test_pourpoints_threads(tmpdir):
+    runner = CliRunner()
+    features = []
+    for threads, out in [(1, tmpdir.mkdir('serial')), (3, tmpdir.mkdir('threaded'))]:
+        result = runner.invoke(cli, ['pourpts',
+                                     '-bluespots', labeledfile,
+                                     '-depths', depthsfile,
+                                     '-watersheds', wshedsfile,
+                                     '-dem', dtmfile,
+                                     '-threads', threads,
+                                     '-out', str(out)])
+        assert result.exit_code == 0, result.output
+        features.append([p['properties'] for p in io.VectorReader(str(out), 'pourpoints').read_geojson_features()])
+    assert features[0] == features[1]
+
+
+def test_pourpoints_stage_storage_too_many_bins(tmpdir):
+    runner = CliRunner()
+    result = runner.invoke(cli, ['pourpts',
+                                 '-bluespots', labeledfile,
+                                 '-depths', depthsfile,
+                                 '-watersheds', wshedsfile,
+                                 '-dem', dtmfile,
+                                 '-stage_bins', 100,
+                                 '-out', str(tmpdir)])
+    assert result.exit_code != 0
+    assert not os.path.isfile(str(tmpdir.join('pourpoints.shp')))
+
+
 def test_network(tmpdir):
     runner = CliRunner()
     result = runner.invoke(cli, ['network',
@@ -157,6 +238,45 @@ def test_network(tmpdir):
     assert os.path.isfile(str(tmpdir.join('streams.shp')))
 
 
+def test_network_streams_raster(tmpdir):
+    runner = CliRunner()
+    for args in [[], ['-no_streams']]:
+        outdir = tmpdir.mkdir('streams{}'.format(len(args)))
+        f = str(outdir.join('streams.tif'))
+        result = runner.invoke(cli, ['network',
+                                     '-bluespots', labeledfile,
+                                     '-flowdir', flowdirnoflatsfile,
+                                     '-pourpoints', pourpointsfile,
+                                     '-pourpoints_layer', 'OGRGeoJSON',
+                                     '-out', str(outdir),
+                                     '-out_streams_raster', f,
+                                     ] + args)
+        assert result.exit_code == 0, 'Output: {}'.format(result.output)
+        assert os.path.isfile(f)
+        assert os.path.isfile(str(outdir.join('streams.shp'))) == (not args)
+        data = io.RasterReader(f).read()
+        assert np.sum(data >= 0) == 994
+
+
+def test_network_simplify(tmpdir):
+    runner = CliRunner()
+    vertex_counts = []
+    for simplify in [[], ['-simplify', 0.75]]:
+        outdir = tmpdir.mkdir('simplify{}'.format(len(simplify)))
+        result = runner.invoke(cli, ['network',
+                                     '-bluespots', labeledfile,
+                                     '-flowdir', flowdirnoflatsfile,
+                                     '-pourpoints', pourpointsfile,
+                                     '-pourpoints_layer', 'OGRGeoJSON',
+                                     '-out', str(outdir),
+                                     ] + simplify)
+        assert result.exit_code == 0, 'Output: {}'.format(result.output)
+        streams = io.VectorReader(str(outdir), 'streams').read_geojson_features()
+        assert len(streams) == 117
+        vertex_counts.append(sum([len(s['geometry']['coordinates']) for s in streams]))
+    assert vertex_counts[1] < vertex_counts[0]
+
+
 def test_rain(tmpdir):
     runner = CliRunner()
     result = runner.invoke(cli, ['rain',
@@ -170,6 +290,196 @@ def test_rain(tmpdir):
     assert os.path.isfile(str(tmpdir.join('events.shp')))
 
 
+def test_rain_thresholds(tmpdir):
+    runner = CliRunner()
+    result = runner.invoke(cli, ['rain',
+                                 '-nodes', nodesfile,
+                                 '-nodes_layer', 'OGRGeoJSON',
+                                 '-r', 10,
+                                 '-thresholds',
+                                 '-out', str(tmpdir)])
+    assert result.exit_code == 0, 'Output: {}'.format(result.output)
+    events = io.VectorReader(str(tmpdir), 'events').read_geojson_features()
+    for e in events:
+        props = e['properties']
+        assert 'spill_mm' in props
+        assert 'inflow_mm' in props
+        if props['spill_mm'] is not None and props['spill_mm'] < 10:
+            assert props['spillv_10'] > 0
+
+
+def test_rain_raster(tmpdir):
+    runner = CliRunner()
+    result = runner.invoke(cli, ['rain',
+                                 '-nodes', nodesfile,
+                                 '-nodes_layer', 'OGRGeoJSON',
+                                 '-r', 10,
+                                 '-rain_raster', depthsfile,
+                                 '-watersheds', wshedsfile,
+                                 '-out', str(tmpdir)])
+    assert result.exit_code == 0, 'Output: {}'.format(result.output)
+    events = io.VectorReader(str(tmpdir), 'events').read_geojson_features()
+    for e in events:
+        assert 'rainv_10' in e['properties']
+        assert 'rainv_r1' in e['properties']
+
+    # Rain raster requires watersheds
+    result = runner.invoke(cli, ['rain',
+                                 '-nodes', nodesfile,
+                                 '-nodes_layer', 'OGRGeoJSON',
+                                 '-rain_raster', depthsfile,
+                                 '-out', str(tmpdir.join('other'))])
+    assert result.exit_code != 0
+
+
+def test_rain_raster_nodata(tmpdir):
+    watersheds = io.RasterReader(wshedsfile)
+    rain = np.full(watersheds.shape, 10, dtype=np.float32)
+    nodata_rain = np.copy(rain)
+    nodata_rain[::3] = -9999
+    rain[::3] = 0
+    for name, data in [('rain.tif', rain), ('nodata.tif', nodata_rain)]:
+        io.RasterWriter(str(tmpdir.join(name)), watersheds.transform, watersheds.crs, -9999).write(data)
+    volumes = []
+    for name in ('rain.tif', 'nodata.tif'):
+        out = tmpdir.join(name + '_out')
+        result = CliRunner().invoke(cli, ['rain',
+                                          '-nodes', nodesfile,
+                                          '-nodes_layer', 'OGRGeoJSON',
+                                          '-rain_raster', str(tmpdir.join(name)),
+                                          '-watersheds', wshedsfile,
+                                          '-out', str(out)])
+        assert result.exit_code == 0, 'Output: {}'.format(result.output)
+        events = io.VectorReader(str(out), 'events').read_geojson_features()
+        volumes.append([e['properties']['rainv_r1'] for e in events])
+    # Nodata cells get no rain
+    assert volumes[0] == volumes[1]
+
+    # Rain raster on another grid is rejected
+    shifted = list(watersheds.transform)
+    shifted[0] += 100
+    io.RasterWriter(str(tmpdir.join('shifted.tif')), shifted, watersheds.crs, -9999).write(rain)
+    result = CliRunner().invoke(cli, ['rain',
+                                      '-nodes', nodesfile,
+                                      '-nodes_layer', 'OGRGeoJSON',
+                                      '-rain_raster', str(tmpdir.join('shifted.tif')),
+                                      '-watersheds', wshedsfile,
+                                      '-out', str(tmpdir.join('shifted_out'))])
+    assert result.exit_code != 0
+
+
+def test_rain_ensemble(tmpdir):
+    runner = CliRunner()
+    result = runner.invoke(cli, ['rain',
+                                 '-nodes', nodesfile,
+                                 '-nodes_layer', 'OGRGeoJSON',
+                                 '-r', 10,
+                                 '-ensemble', 20,
+                                 '-rain_cv', 0.2,
+                                 '-vol_cv', 0.1,
+                                 '-seed', 1,
+                                 '-out', str(tmpdir)])
+    assert result.exit_code == 0, 'Output: {}'.format(result.output)
+    events = io.VectorReader(str(tmpdir), 'events').read_geojson_features()
+    for e in events:
+        assert 0 <= e['properties']['spprob_10'] <= 1
+
+
+def test_network_file(tmpdir):
+    network = str(tmpdir.join('network.npz'))
+    runner = CliRunner()
+    result = runner.invoke(cli, ['network',
+                                 '-bluespots', labeledfile,
+                                 '-flowdir', flowdirnoflatsfile,
+                                 '-pourpoints', pourpointsfile,
+                                 '-pourpoints_layer', 'OGRGeoJSON',
+                                 '-out', str(tmpdir.join('vector')),
+                                 '-out_network', network])
+    assert result.exit_code == 0, 'Output: {}'.format(result.output)
+    assert os.path.isfile(network)
+
+    result = runner.invoke(cli, ['rain',
+                                 '-network', network,
+                                 '-r', 10,
+                                 '-out', str(tmpdir.join('events'))])
+    assert result.exit_code == 0, 'Output: {}'.format(result.output)
+    events = io.VectorReader(str(tmpdir.join('events')), 'events').read_geojson_features()
+    nodes = io.VectorReader(str(tmpdir.join('vector')), 'nodes').read_geojson_features()
+    assert len(events) == len(nodes)
+    assert all(['spillv_10' in e['properties'] for e in events])
+
+
+def test_rain_table(tmpdir):
+    runner = CliRunner()
+    for outfile in ['events.csv', 'events.npz']:
+        result = runner.invoke(cli, ['rain',
+                                     '-nodes', nodesfile,
+                                     '-nodes_layer', 'OGRGeoJSON',
+                                     '-r', 10,
+                                     '-r', 20,
+                                     '-out_table', str(tmpdir.join(outfile))])
+        assert result.exit_code == 0, 'Output: {}'.format(result.output)
+        assert os.path.isfile(str(tmpdir.join(outfile)))
+    with open(str(tmpdir.join('events.csv'))) as f:
+        lines = f.read().splitlines()
+    data = np.load(str(tmpdir.join('events.npz')))
+    assert len(lines) == 1 + 2 * len(data['nodeid'])
+    assert data['spillv'].shape == (len(data['nodeid']), 2)
+
+
+def test_rain_rasters(tmpdir):
+    runner = CliRunner()
+    result = runner.invoke(cli, ['rain',
+                                 '-nodes', nodesfile,
+                                 '-nodes_layer', 'OGRGeoJSON',
+                                 '-r', 10,
+                                 '-bluespots', labeledfile,
+                                 '-out_rasters', str(tmpdir),
+                                 '-raster_values', 'pctv',
+                                 '-raster_values', 'spillv',
+                                 '-out_table', str(tmpdir.join('events.npz'))])
+    assert result.exit_code == 0, 'Output: {}'.format(result.output)
+    pctv = io.RasterReader(str(tmpdir.join('pctv_10.tif'))).read()
+    assert os.path.isfile(str(tmpdir.join('spillv_10.tif')))
+    labels = io.RasterReader(labeledfile).read()
+    assert np.all(pctv[labels == 0] == -1)
+    assert np.all((pctv[labels > 0] >= 0) & (pctv[labels > 0] <= 100))
+
+
+def test_rain_flood(tmpdir):
+    runner = CliRunner()
+    result = runner.invoke(cli, ['pourpts',
+                                 '-bluespots', labeledfile,
+                                 '-depths', depthsfile,
+                                 '-watersheds', wshedsfile,
+                                 '-dem', dtmfile,
+                                 '-out', str(tmpdir)])
+    assert result.exit_code == 0, result.output
+    result = runner.invoke(cli, ['network',
+                                 '-bluespots', labeledfile,
+                                 '-flowdir', flowdirnoflatsfile,
+                                 '-pourpoints', str(tmpdir),
+                                 '-out', str(tmpdir)])
+    assert result.exit_code == 0, result.output
+    result = runner.invoke(cli, ['rain',
+                                 '-nodes', str(tmpdir),
+                                 '-r', 10,
+                                 '-r', 10000,
+                                 '-bluespots', labeledfile,
+                                 '-depths', depthsfile,
+                                 '-out_flood', str(tmpdir),
+                                 '-out_table', str(tmpdir.join('events.csv'))])
+    assert result.exit_code == 0, result.output
+    labels = io.RasterReader(labeledfile).read()
+    depths = io.RasterReader(depthsfile).read()
+    flood = io.RasterReader(str(tmpdir.join('flood_10.tif'))).read()
+    assert np.all(flood[labels == 0] == -1)
+    assert np.all((flood[labels > 0] >= 0) & (flood[labels > 0] <= depths[labels > 0] + 1e-4))
+    # All bluespots are full
+    flood = io.RasterReader(str(tmpdir.join('flood_10000.tif'))).read()
+    np.testing.assert_allclose(flood[labels > 0], depths[labels > 0], atol=1e-4)
+
+
 def test_chained(tmpdir):
     filled = str(tmpdir.join('filled.tif'))
     depths = str(tmpdir.join('depths.tif'))
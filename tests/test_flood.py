@@ -0,0 +1,57 @@
+import numpy as np
+import pytest
+
+from malstroem import flood
+from malstroem.algorithms import label
+from data.fixtures import depthsdata, bspotdata
+
+
+def test_water_levels():
+    # Bluespot 1 is a box with area 4. Bluespot 2 is a cone like shape
+    stage = np.array([[0, 1, 2], [0, 1, 2]], dtype=np.float64)
+    volume = np.array([[0, 4, 8], [0, 1, 5]], dtype=np.float64)
+    area = np.array([[4, 4, 4], [0, 2, 4]], dtype=np.float64)
+    levels = flood.water_levels(stage, volume, area, [2, 1])
+    np.testing.assert_allclose(levels, [0.5, 1])
+    levels = flood.water_levels(stage, volume, area, [0, 100])
+    np.testing.assert_allclose(levels, [0, 2])
+    # Volume is quadratic in level when area grows linearly
+    levels = flood.water_levels(stage, volume, area, [6, 0.25])
+    np.testing.assert_allclose(levels, [1.5, 0.5])
+
+
+def test_flood_depths(depthsdata, bspotdata):
+    depthsdata = depthsdata.astype(np.float64)
+    stats = label.label_stats(depthsdata, bspotdata)
+    stage, count, volume = label.label_stage_storage(depthsdata, bspotdata, stats['max'], 20)
+    valid = np.ones(len(stats), dtype=bool)
+    valid[0] = False
+
+    # Stored volume equals the volume of the flood depths
+    v = 0.3 * stats['sum']
+    levels = flood.water_levels(stage, volume, count.astype(np.float64), v)
+    water = flood.flood_depths(bspotdata, depthsdata, levels, stats['max'], valid, -1)
+    assert np.all(water[bspotdata == 0] == -1)
+    assert np.all(water[bspotdata > 0] <= depthsdata[bspotdata > 0] + 1e-6)
+    flooded = label.label_sum(np.where(bspotdata > 0, water, 0).astype(np.float64), bspotdata)
+    np.testing.assert_allclose(flooded[1:], v[1:], rtol=0.05, atol=1e-3)
+
+    # Full bluespots
+    levels = flood.water_levels(stage, volume, count.astype(np.float64), stats['sum'])
+    water = flood.flood_depths(bspotdata, depthsdata, levels, stats['max'], valid, -1)
+    np.testing.assert_allclose(water[bspotdata > 0], depthsdata[bspotdata > 0], atol=1e-5)
+
+
+def test_stage_storage_table():
+    curves = {2: (np.array([0, 1.0]), np.array([0, 3.0]), np.array([0, 6.0])),
+              3: (np.array([0, 1.0, 2.0]), np.array([0, 1.0, 4.0]), np.array([0, 2.0, 4.0]))}
+    stage, volume, area, has_curve = flood.stage_storage_table(curves, 5)
+    assert stage.shape == volume.shape == area.shape == (5, 3)
+    assert has_curve.tolist() == [False, False, True, True, False]
+    assert stage[2].tolist() == [0, 1, 1]
+    assert volume[3].tolist() == [0, 1, 4]
+
+    # Curves with mismatched lengths are rejected rather than padded
+    curves[4] = (np.array([0, 1.0, 2.0]), np.array([0, 1.0]), np.array([0, 2.0, 4.0]))
+    with pytest.raises(ValueError):
+        flood.stage_storage_table(curves, 5)
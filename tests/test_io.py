@@ -55,3 +55,53 @@ def test_write_vector(tmpdir):
         f = fdefn.GetFieldDefn(ix)
         assert f.GetName() == f_exp.GetName()
 
+
+
+def create_event_data():
+    nodeids = [3, 1, 2]
+    events = ['10', 'r1']
+    event_columns = dict(v=[[1.0, 2.0], [3.0, float('nan')], [5.5, 6.0]])
+    node_columns = dict(spill_mm=[12.5, float('nan'), 1.0])
+    return nodeids, events, event_columns, node_columns
+
+
+@pytest.mark.parametrize('block_nodes', [1, 2, 10000])
+def test_write_event_table(tmpdir, block_nodes):
+    outfile = str(tmpdir.join('events.csv'))
+    writer = io.EventTableWriter(outfile, block_nodes=block_nodes)
+    writer.write_events(*create_event_data())
+    with open(outfile) as f:
+        lines = f.read().splitlines()
+    assert lines[0] == 'nodeid,event,v,spill_mm'
+    assert lines[1:] == ['3,10,1,12.5', '3,r1,2,12.5', '1,10,3,', '1,r1,,', '2,10,5.5,1', '2,r1,6,1']
+
+
+def test_write_event_array(tmpdir):
+    import numpy as np
+    outfile = str(tmpdir.join('events.npz'))
+    writer = io.EventArrayWriter(outfile)
+    writer.write_events(*create_event_data())
+    data = np.load(outfile)
+    assert data['nodeid'].tolist() == [3, 1, 2]
+    assert data['event'].tolist() == ['10', 'r1']
+    assert data['v'].shape == (3, 2)
+    assert data['spill_mm'].shape == (3,)
+
+
+def test_raster_blocks(tmpdir):
+    import numpy as np
+    data = np.arange(30 * 20, dtype=np.float32).reshape(30, 20)
+    outfile = str(tmpdir.join('blocks.tif'))
+    writer = io.RasterWriter(outfile, (0, 1, 0, 30, 0, -1), create_utm32_crs(), -1)
+    writer.create(data.shape, data.dtype)
+    for row_off in range(0, 30, 7):
+        writer.write_block(data[row_off:row_off + 7], row_off)
+    writer.close()
+
+    reader = io.RasterReader(outfile)
+    assert reader.shape == (30, 20)
+    assert np.array_equal(reader.read(), data)
+    blocks = list(reader.iter_blocks(block_rows=8))
+    assert [row_off for row_off, _ in blocks] == [0, 8, 16, 24]
+    assert np.array_equal(np.vstack([b for _, b in blocks]), data)
+    assert np.array_equal(reader.read_block(3, 4, 5, 6), data[3:8, 4:10])
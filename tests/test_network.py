@@ -0,0 +1,297 @@
+import numpy as np
+import pytest
+from malstroem.network import Network, NetworkArrays, EnsembleStatistics, save_network, load_network
+from data.fixtures import nodesdata
+
+
+def reference_rain_event(nodes, mmrain):
+    # Straightforward per node implementation
+    nodes_index = {n['nodeid']: n for n in nodes}
+    values = {}
+
+    def calc(nodeid):
+        if nodeid not in values:
+            n = nodes_index[nodeid]
+            upstream = sum([calc(u['nodeid'])['spillv'] for u in nodes if u['dstrnodeid'] == nodeid])
+            rainv = n['wshed_area'] * mmrain * 0.001
+            total = rainv + upstream
+            v = min(total, n['bspot_vol'])
+            pctv = 100.0 * v / n['bspot_vol'] if n['bspot_vol'] else None
+            values[nodeid] = dict(rainv=rainv, spillv=max(0, total - n['bspot_vol']), v=v, pctv=pctv)
+        return values[nodeid]
+
+    for n in nodes:
+        calc(n['nodeid'])
+    return values
+
+
+def test_network_order(nodesdata):
+    nodes = [n['properties'] for n in nodesdata]
+    arrays = NetworkArrays.from_nodes(nodes)
+    assert sorted(arrays.order.tolist()) == list(range(len(nodes)))
+    # Every node comes after all its upstream nodes
+    position = np.empty_like(arrays.order)
+    position[arrays.order] = np.arange(len(arrays.order))
+    has_down = arrays.downstream >= 0
+    assert np.all(position[has_down] < position[arrays.downstream[has_down]])
+    # Upstream index is consistent with downstream index
+    for i in range(len(nodes)):
+        upstream = arrays.upstream[arrays.upstream_ptr[i]:arrays.upstream_ptr[i + 1]]
+        assert np.all(arrays.downstream[upstream] == i)
+    assert len(arrays.upstream) == np.sum(has_down)
+
+
+@pytest.mark.parametrize("mmrain", [0, 10, 50, 200])
+def test_network_rain_event(nodesdata, mmrain):
+    nodes = [n['properties'] for n in nodesdata]
+    expected = reference_rain_event(nodes, mmrain)
+
+    network = Network()
+    network.add_nodes(nodes)
+    event = network.arrays.rain_event(mmrain)
+    assert event['nodeid'].tolist() == [n['nodeid'] for n in nodes]
+    for prop in ['rainv', 'spillv', 'v']:
+        assert np.allclose(event[prop], [expected[n['nodeid']][prop] for n in nodes])
+
+    for e in network.rain_event(mmrain):
+        exp = expected[e['nodeid']]
+        if exp['pctv'] is None:
+            assert e['pctv'] is None
+        else:
+            assert e['pctv'] == pytest.approx(exp['pctv'])
+
+
+def test_network_rain_event_list(nodesdata):
+    nodes = [n['properties'] for n in nodesdata]
+    network = Network()
+    network.add_nodes(nodes)
+    mmrains = [1, 2]
+    events = network.rain_event(mmrains)
+    assert events['nodeid'].tolist() == [n['nodeid'] for n in nodes]
+    for j, mmrain in enumerate(mmrains):
+        single = network.rain_event(mmrain)
+        for prop in ['rainv', 'spillv', 'v']:
+            assert events[prop].shape == (len(nodes), len(mmrains))
+            assert np.allclose(events[prop][:, j], [e[prop] for e in single])
+        pctv = [np.nan if e['pctv'] is None else e['pctv'] for e in single]
+        assert np.allclose(events['pctv'][:, j], pctv, equal_nan=True)
+
+
+def test_network_cycle():
+    nodes = [dict(nodeid=1, dstrnodeid=2, wshed_area=1.0, bspot_vol=1.0),
+             dict(nodeid=2, dstrnodeid=1, wshed_area=1.0, bspot_vol=1.0)]
+    with pytest.raises(Exception):
+        NetworkArrays.from_nodes(nodes)
+
+
+def test_network_rain_events(nodesdata):
+    nodes = [n['properties'] for n in nodesdata]
+    arrays = NetworkArrays.from_nodes(nodes)
+    mmrains = [0, 5, 10, 50, 200]
+    events = arrays.rain_event(mmrains)
+    for prop in ['rainv', 'spillv', 'v', 'pctv']:
+        assert events[prop].shape == (len(nodes), len(mmrains))
+        for j, mmrain in enumerate(mmrains):
+            single = arrays.rain_event(mmrain)[prop]
+            assert np.allclose(events[prop][:, j], single, equal_nan=True)
+
+
+def test_network_rain_response(nodesdata):
+    nodes = [n['properties'] for n in nodesdata]
+    network = Network()
+    network.add_nodes(nodes)
+    response = network.rain_response()
+    mmrains = np.linspace(0, 300, 61)
+    expected = network.arrays.rain_event(mmrains)
+    actual = response.evaluate(mmrains)
+    for prop in ['rainv', 'spillv', 'v', 'pctv']:
+        assert np.allclose(actual[prop], expected[prop], equal_nan=True)
+
+    # Bluespots spill just above and not below their threshold
+    spills = np.isfinite(response.spill_mm)
+    ix = np.nonzero(spills)[0]
+    above = network.arrays.rain_event(response.spill_mm[ix] + 1e-6)['spillv'][ix, np.arange(len(ix))]
+    below = network.arrays.rain_event(np.maximum(response.spill_mm[ix] - 1e-6, 0))['spillv'][ix, np.arange(len(ix))]
+    assert np.all(above > 0)
+    assert np.all(below == 0)
+    # Nodes which never spill
+    assert np.all(network.arrays.rain_event(1e4)['spillv'][~spills] == 0)
+
+
+def test_network_rain_response_deep():
+    # A long chain joined by a wide tree. Levels hold several nodes with upstream curves of different lengths
+    random = np.random.RandomState(0)
+    num_nodes = 300
+    tree = [random.randint(0, i) for i in range(100, num_nodes)]
+    downstream = np.concatenate((np.arange(1, 100), [-1], tree))
+    arrays = NetworkArrays(np.arange(num_nodes), downstream, random.uniform(10, 1000, num_nodes),
+                           random.uniform(0, 2, num_nodes) * (random.uniform(size=num_nodes) > 0.1))
+    response = arrays.rain_response()
+    mmrains = np.linspace(0, 100, 41)
+    expected = arrays.rain_event(mmrains)
+    actual = response.evaluate(mmrains)
+    for prop in ['rainv', 'spillv', 'v']:
+        assert np.allclose(actual[prop], expected[prop])
+
+
+def test_network_simulate(nodesdata):
+    nodes = [n['properties'] for n in nodesdata]
+    arrays = NetworkArrays.from_nodes(nodes)
+    hyetograph = np.array([0, 1, 5, 10, 20, 10, 5, 2, 0, 0], dtype=np.float64)
+
+    # Without outflow limits the end state equals the static rain event
+    result = arrays.simulate(hyetograph, timestep=10, timeseries=True)
+    event = arrays.rain_event(np.sum(hyetograph))
+    assert np.allclose(result['v'], event['v'])
+    assert np.allclose(result['total_spillv'], event['spillv'])
+    assert np.allclose(result['v_t'][:, -1], result['v'])
+    assert np.allclose(result['peak_v'], np.max(result['v_t'], axis=1))
+    spills = event['spillv'] > 0
+    assert np.all(np.isfinite(result['first_spill_time'][spills]))
+    assert np.all(np.isnan(result['first_spill_time'][~spills]))
+
+    # Bluespots spill when the accumulated rain passes their threshold
+    response = arrays.rain_response()
+    first_step = np.searchsorted(np.cumsum(hyetograph), response.spill_mm[spills], side='right')
+    assert np.allclose(result['first_spill_time'][spills], (first_step + 1) * 10)
+
+    # Limited outflow
+    limited = arrays.simulate(hyetograph, timestep=10, max_outflow=1.0, timeseries=True)
+    assert np.all(limited['spillv_t'] <= 10.0 + 1e-9)
+    assert np.any(limited['peak_v'] > arrays.bspot_vol + 1)
+    # Water is conserved
+    roots = arrays.downstream < 0
+    total_rain = np.sum(arrays.wshed_area) * np.sum(hyetograph) * 0.001
+    assert np.isclose(np.sum(limited['v']) + np.sum(limited['total_spillv'][roots]), total_rain)
+
+    # Rain per local watershed. The same rain everywhere equals the evenly distributed rain
+    local = arrays.simulate(np.tile(hyetograph, (len(arrays), 1)), timestep=10, timeseries=True)
+    for key in ['v', 'v_t', 'spillv_t', 'peak_v', 'total_spillv']:
+        assert np.allclose(local[key], result[key])
+    local = arrays.simulate(np.outer(arrays.nodeids % 2, hyetograph), timestep=10)
+    assert np.isclose(np.sum(local['v']) + np.sum(local['total_spillv'][roots]),
+                      np.sum(arrays.wshed_area[arrays.nodeids % 2 == 1]) * np.sum(hyetograph) * 0.001)
+
+
+def test_network_update_nodes(nodesdata):
+    nodes = [n['properties'] for n in nodesdata]
+    network = Network()
+    network.add_nodes(nodes)
+    mmrains = [5, 10, 50, 100]
+    events = network.cache_rain_events(mmrains)
+
+    # Resize a bluespot with a downstream node
+    node = [n for n in nodes if n['dstrnodeid'] is not None and n['bspot_vol'] > 0][0]
+    changed = network.update_nodes({node['nodeid']: {'bspot_vol': node['bspot_vol'] * 0.1}})
+    assert node['nodeid'] in changed
+    assert node['bspot_vol'] > 0  # Node dict is updated in place
+
+    expected = NetworkArrays.from_nodes(nodes).rain_event(mmrains)
+    for prop in ['rainv', 'spillv', 'v', 'pctv']:
+        assert np.allclose(events[prop], expected[prop], equal_nan=True)
+
+    # Only the node and nodes downstream of it may change
+    downstream = set()
+    nodes_index = {n['nodeid']: n for n in nodes}
+    nodeid = node['nodeid']
+    while nodeid is not None:
+        downstream.add(nodeid)
+        nodeid = nodes_index[nodeid]['dstrnodeid']
+    assert set(changed) <= downstream
+
+    # Topology can not be changed
+    with pytest.raises(ValueError):
+        network.update_nodes({node['nodeid']: {'dstrnodeid': None}})
+
+
+def test_ensemble_statistics():
+    random = np.random.RandomState(0)
+    v = random.uniform(0, 10, (5, 2000))
+    spillv = np.maximum(random.normal(0, 1, (5, 2000)), 0)
+    pctv = random.uniform(0, 100, (5, 2000))
+    pctv[4] = np.nan
+    stats = EnsembleStatistics(5, quantiles=[0.1, 0.5, 0.9], bins=1000)
+    for start in range(0, 2000, 300):
+        batch = slice(start, start + 300)
+        stats.add(dict(v=v[:, batch], spillv=spillv[:, batch], pctv=pctv[:, batch]))
+    result = stats.result()
+    assert np.all(result['count'] == 2000)
+    assert np.allclose(result['v_mean'], np.mean(v, axis=1))
+    assert np.allclose(result['v_std'], np.std(v, axis=1))
+    assert np.allclose(result['spillv_mean'], np.mean(spillv, axis=1))
+    assert np.allclose(result['spill_prob'], np.mean(spillv > 0, axis=1))
+    for q in [10, 50, 90]:
+        assert np.allclose(result['pctv_q{}'.format(q)][:4], np.percentile(pctv[:4], q, axis=1), atol=0.5)
+    assert np.all(np.isnan(result['pctv_q50'][4]))
+
+    # Counts use the smallest type holding the number of scenarios
+    stats = EnsembleStatistics(5, bins=20, max_count=300)
+    assert stats._histogram.dtype == np.uint16
+    stats.add(dict(v=v[:, :300], spillv=spillv[:, :300], pctv=pctv[:, :300]))
+    with pytest.raises(ValueError):
+        stats.add(dict(v=v[:, :1], spillv=spillv[:, :1], pctv=pctv[:, :1]))
+
+
+def test_network_rain_ensemble(nodesdata):
+    nodes = [n['properties'] for n in nodesdata]
+    arrays = NetworkArrays.from_nodes(nodes)
+    # Without variation all scenarios equal the deterministic event
+    event = arrays.rain_event(20)
+    stats = arrays.rain_ensemble(20, 10, batch_size=3)
+    assert np.allclose(stats['v_mean'], event['v'])
+    assert np.allclose(stats['v_std'], 0)
+    assert np.allclose(stats['spill_prob'], event['spillv'] > 0)
+
+    stats = arrays.rain_ensemble(20, 200, rain_cv=0.3, vol_cv=0.2, batch_size=64, seed=1)
+    assert np.all((stats['spill_prob'] >= 0) & (stats['spill_prob'] <= 1))
+    has_capacity = arrays.bspot_vol > 0
+    assert np.all(stats['pctv_q5'][has_capacity] <= stats['pctv_q95'][has_capacity])
+    # Same seed gives same result
+    again = arrays.rain_ensemble(20, 200, rain_cv=0.3, vol_cv=0.2, batch_size=64, seed=1)
+    assert np.allclose(stats['v_mean'], again['v_mean'])
+
+
+def test_network_tree_chunks(nodesdata):
+    nodes = [n['properties'] for n in nodesdata]
+    arrays = NetworkArrays.from_nodes(nodes)
+    roots = arrays.tree_roots()
+    assert np.all(arrays.downstream[roots] == -1)
+    chunks = arrays.tree_chunks(4)
+    assert len(chunks) == 4
+    assert sorted(np.concatenate(chunks).tolist()) == list(range(len(nodes)))
+    for chunk in chunks:
+        # Trees are not split between chunks
+        assert set(roots[chunk].tolist()).isdisjoint(set(roots[np.setdiff1d(np.arange(len(nodes)), chunk)].tolist()))
+    sizes = [len(c) for c in chunks]
+    assert max(sizes) - min(sizes) <= np.max(np.bincount(roots))
+
+
+def test_network_route_parallel(nodesdata):
+    nodes = [n['properties'] for n in nodesdata]
+    arrays = NetworkArrays.from_nodes(nodes)
+    rainv = np.multiply.outer(arrays.wshed_area, [0.005, 0.02, 0.1])
+    expected = arrays.route(rainv)
+    actual = arrays.route_parallel(rainv, processes=2)
+    assert actual['nodeid'].tolist() == expected['nodeid'].tolist()
+    for prop in ['rainv', 'spillv', 'v', 'pctv']:
+        assert np.allclose(actual[prop], expected[prop], equal_nan=True)
+
+
+def test_network_save_load(nodesdata, tmpdir):
+    filepath = str(tmpdir.join('network.npz'))
+    saved = save_network(filepath, nodesdata, 'crs')
+    network, features, crs = load_network(filepath)
+    assert crs == 'crs'
+    assert len(features) == len(nodesdata)
+    for f, expected in zip(features, nodesdata):
+        assert f['properties'] == expected['properties']
+        assert f['geometry']['coordinates'] == pytest.approx(expected['geometry']['coordinates'][:2])
+    assert features[1]['properties'] == nodesdata[1]['properties']
+    values, isnull = features.column('bspot_id')
+    assert np.where(isnull, None, values).tolist() == [n['properties'].get('bspot_id') for n in nodesdata]
+    assert features.column('no_such_property') == (None, None)
+    assert list(features.records(['nodeid', 'no_such_property'])) == [
+        dict(nodeid=n['properties']['nodeid']) for n in nodesdata]
+    for name in ['nodeids', 'downstream', 'order', 'level_ptr', 'upstream', 'upstream_ptr']:
+        assert np.array_equal(getattr(network, name), getattr(saved, name))
+    assert np.allclose(network.rain_event([10, 50])['v'], saved.rain_event([10, 50])['v'])
@@ -1,7 +1,9 @@
 import numpy as np
+import pytest
 
 from malstroem import bluespots, io
 from malstroem.algorithms import label
+from malstroem.scripts._utils import parse_filter
 from osgeo import ogr
 import os
 from data.fixtures import flowdirnoflatsfile, dtmfile, filledfile, bspotdata, depthsdata
@@ -66,4 +68,44 @@ def test_nofilter(bspotdata, depthsdata):
     filter_function = lambda r: True
     keepers = bluespots.filterbluespots(filter_function, 1.0, raw_bluespot_stats)
     assert len(keepers) == len(raw_bluespot_stats)
-    assert sum(keepers) == len(raw_bluespot_stats)
\ No newline at end of file
+    assert sum(keepers) == len(raw_bluespot_stats)
+
+def test_compiled_filter(bspotdata, depthsdata):
+    raw_bluespot_stats = label.label_stats(depthsdata, bspotdata)
+    compiled = parse_filter("maxdepth > 2 and area > 5 and volume > 1")
+    keepers = bluespots.filterbluespots(compiled, 1.0, raw_bluespot_stats)
+    assert keepers.dtype == bool
+    assert len(keepers) == len(raw_bluespot_stats)
+    assert sum(keepers) == 19
+
+    keepers = bluespots.filterbluespots(parse_filter(""), 1.0, raw_bluespot_stats)
+    assert sum(keepers) == len(raw_bluespot_stats)
+
+
+@pytest.mark.parametrize('expression', ['__import__("os")', 'area.real > 1', 'depth > 1', 'area ** 2 > 1', 'volume >',
+                                        'area > 1/0', 'area / (2 - 2) > 1'])
+def test_compiled_filter_rejects(expression):
+    with pytest.raises(Exception, match='Unsupported filter statement'):
+        parse_filter(expression)
+
+
+def test_compiled_filter_arithmetic():
+    stats = dict(area=np.array([0.0, 1.0, 2.0]), max=np.array([0.0, 0.5, 1.0]), volume=np.array([0.0, 0.5, 2.0]))
+    # Labels without cells give nan or inf which never pass a comparison
+    assert parse_filter('volume / area > 0.6')(stats).tolist() == [False, False, True]
+    assert parse_filter('volume / (maxdepth - maxdepth) > 1')(stats).tolist() == [False, False, False]
+    assert not parse_filter('volume / area > 0.6')(dict(area=0.0, max=0.0, volume=1.0))
+    assert parse_filter('area > 4 / 2 - -1')(stats).tolist() == [False, False, False]
+    assert parse_filter('area > 1 / 2')(stats).tolist() == [False, True, True]
+
+
+def test_stage_bins_fit_field():
+    # The widest values at the largest allowed number of bins still fit the field
+    widest = [1.23457e-05] * (bluespots.MAX_STAGE_BINS + 1)
+    assert len(bluespots.format_curve(widest)) <= bluespots.CURVE_FIELD_WIDTH
+    with pytest.raises(ValueError):
+        bluespots.format_curve(widest + [1.23457e-05])
+    bluespots.check_stage_bins(0)
+    bluespots.check_stage_bins(bluespots.MAX_STAGE_BINS)
+    with pytest.raises(ValueError):
+        bluespots.check_stage_bins(bluespots.MAX_STAGE_BINS + 1)
@@ -121,6 +121,17 @@ def test_watersheds_optimized64(flowdirdata, bspotdata):
         labeled, nlabels = label.connected_components(watersheds == lbl)
         assert nlabels == 1, "Watershed {} is not a connected component".format(lbl)
 
+def test_watersheds_optimized16(flowdirdata, bspotdata):
+    speedups.enable()
+    assert speedups.enabled
+    watersheds = bspotdata.astype(np.uint16)
+    flow.watersheds_from_labels(flowdirdata, watersheds, unassigned=0)
+
+    labelled_indexes = bspotdata > 0
+    assert np.all(watersheds[labelled_indexes] == bspotdata[labelled_indexes])
+    assert np.max(watersheds) == np.max(bspotdata)
+    assert np.sum(watersheds, dtype=np.int64) == 2337891
+
 def test_watersheds_optimizedfallback(flowdirdata, bspotdata):
     speedups.enable()
     assert speedups.enabled
@@ -2,7 +2,8 @@ import numpy as np
 import pytest
 
 from malstroem.algorithms import label, speedups
-from data.fixtures import filleddata, fillednoflatsdata, bspotdata
+from malstroem.algorithms.dtypes import label_dtype
+from data.fixtures import filleddata, fillednoflatsdata, bspotdata, depthsdata
 
 
 def test_connected_components(filleddata, fillednoflatsdata):
@@ -86,4 +87,170 @@ def test_compare_label_min_index(fillednoflatsdata, bspotdata):
     assert len(min_ix) == len(min_ix_opt)
     for m, mopt in zip(min_ix, min_ix_opt):
         for v, vopt in zip(m, mopt):
-            assert np.isclose(v, vopt)
\ No newline at end of file
+            assert np.isclose(v, vopt)
+
+def test_label_sum(filleddata, bspotdata):
+    sums = label.label_sum(filleddata, bspotdata)
+    assert len(sums) == np.max(bspotdata) + 1
+    for lbl in [0, 1, np.max(bspotdata)]:
+        assert np.isclose(sums[lbl], np.sum(filleddata[bspotdata == lbl], dtype=np.float64))
+    assert len(label.label_sum(filleddata, bspotdata, np.max(bspotdata) + 10)) == np.max(bspotdata) + 10
+
+
+def test_label_stage_storage(depthsdata, bspotdata):
+    stats = label.label_stats(depthsdata, bspotdata)
+    stage, count, volume = label.label_stage_storage(depthsdata, bspotdata, stats['max'], 10)
+    assert stage.shape == count.shape == volume.shape == (len(stats), 11)
+    # Full bluespot at max depth
+    np.testing.assert_allclose(stage[:, -1], stats['max'])
+    np.testing.assert_allclose(volume[:, -1], stats['sum'], rtol=1e-6)
+    assert np.all(count[:, -1] == stats['count'])
+    assert np.all(volume[:, 0] == 0)
+    assert np.all(np.diff(volume, axis=1) >= 0)
+    assert np.all(np.diff(count, axis=1) >= 0)
+
+    # Compare with brute force for the largest bluespot
+    lbl = np.argmax(stats[1:]['count']) + 1
+    bottom = stats['max'][lbl] - depthsdata[bspotdata == lbl].astype(np.float64)
+    for k in [3, 7]:
+        np.testing.assert_almost_equal(volume[lbl, k], np.sum(np.maximum(stage[lbl, k] - bottom, 0)), decimal=4)
+
+
+@pytest.mark.parametrize('optimized', [False, True])
+@pytest.mark.parametrize('threads', [None, 3])
+def test_label_aggregate(filleddata, fillednoflatsdata, bspotdata, optimized, threads):
+    if optimized:
+        speedups.enable()
+    else:
+        speedups.disable()
+    stats = label.label_stats(filleddata, bspotdata)
+    min_ix = label.label_min_index(fillednoflatsdata, bspotdata)
+    agg_stats, agg_ix = label.label_aggregate(bspotdata, [(filleddata, ('min', 'max', 'sum', 'count')),
+                                                          (fillednoflatsdata, ('argmin', 'argmax'))],
+                                              threads=threads, block_rows=17)
+    assert agg_stats.dtype.names == ('min', 'max', 'sum', 'count')
+    assert agg_ix.dtype.names == ('argmin', 'argmax')
+    for name in ['min', 'max', 'count']:
+        assert np.all(agg_stats[name] == stats[name])
+    np.testing.assert_allclose(agg_stats['sum'], stats['sum'])
+    records = label.index_records(fillednoflatsdata, agg_ix['argmin'])
+    assert np.all(records['row'] == min_ix['row'])
+    assert np.all(records['col'] == min_ix['col'])
+    assert np.all(records['value'] == min_ix['value'])
+
+    # First cell holding the max value
+    lbl = np.argmax(stats['count'])
+    values = np.where(bspotdata == lbl, fillednoflatsdata, -np.inf)
+    assert agg_ix['argmax'][lbl] == np.argmax(values)
+    speedups.enable()
+
+
+@pytest.mark.parametrize('optimized', [True, False])
+def test_label_aggregate_label_range(filleddata, bspotdata, optimized):
+    if optimized:
+        speedups.enable()
+    else:
+        speedups.disable()
+    try:
+        nlabels = int(np.max(bspotdata))
+        with pytest.raises(ValueError):
+            label.label_aggregate(bspotdata, [(filleddata, ('min', 'count'))], nlabels - 1)
+        negative = bspotdata.astype(np.int64)
+        negative[0, 0] = -1
+        with pytest.raises(ValueError):
+            label.label_aggregate(negative, [(filleddata, ('min', 'count'))], nlabels)
+    finally:
+        speedups.enable()
+
+
+def test_label_max_index(fillednoflatsdata, bspotdata):
+    max_ix = label.label_max_index(fillednoflatsdata, bspotdata)
+    assert len(max_ix) == np.max(bspotdata) + 1
+    for lbl in [0, 1, np.max(bspotdata)]:
+        values = np.where(bspotdata == lbl, fillednoflatsdata, -np.inf)
+        row, col = np.unravel_index(np.argmax(values), values.shape)
+        assert (max_ix[lbl]['row'], max_ix[lbl]['col']) == (row, col)
+        assert max_ix[lbl]['value'] == fillednoflatsdata[row, col]
+
+
+def test_compact_labels(filleddata, fillednoflatsdata):
+    labeled, nlabels = label.connected_components(fillednoflatsdata - filleddata)
+    keep = np.arange(nlabels + 1) % 3 == 1
+    expected, expected_nlabels = label.connected_components(label.keep_labels(labeled, keep.copy()))
+    compacted, compacted_nlabels = label.compact_labels(labeled, keep)
+    assert compacted.dtype == label_dtype(compacted_nlabels)
+    assert compacted_nlabels == expected_nlabels
+    assert np.all(compacted == expected)
+
+    # Aggregates of the compacted labels derived from the original aggregates
+    statistics = ('min', 'max', 'sum', 'count', 'argmin', 'argmax')
+    raw, = label.label_aggregate(labeled, [(filleddata, statistics)])
+    derived = label.compact_aggregates(raw, keep)
+    direct, = label.label_aggregate(compacted, [(filleddata, statistics)])
+    for name in statistics:
+        np.testing.assert_allclose(derived[name], direct[name], err_msg=name)
+
+
+@pytest.mark.parametrize('strip_rows', [1, 10, 1024])
+def test_connected_components_tiled(depthsdata, strip_rows):
+    expected, expected_nlabels = label.connected_components(depthsdata)
+    statistics = ('min', 'max', 'sum', 'count', 'argmin', 'argmax')
+    expected_stats, = label.label_aggregate(expected, [(depthsdata, statistics)])
+
+    reads = []
+
+    def read_strip(row_off, rows):
+        reads.append(row_off)
+        return depthsdata[row_off:row_off + rows]
+
+    labelled, nlabels, stats = label.connected_components_tiled(read_strip, depthsdata.shape, strip_rows=strip_rows,
+                                                                statistics=statistics)
+    # Each strip is read once
+    assert reads == list(range(0, depthsdata.shape[0], strip_rows))
+    assert nlabels == expected_nlabels
+    assert labelled.dtype == label_dtype(nlabels)
+    assert np.all(labelled == expected)
+    for name in statistics:
+        np.testing.assert_allclose(stats[name], expected_stats[name], err_msg=name)
+
+    # Filter while labelling and write strip by strip
+    written = np.zeros(depthsdata.shape, dtype=np.int32)
+
+    def write_strip(strip, row_off):
+        written[row_off:row_off + len(strip)] = strip
+
+    def keep_function(stats):
+        return stats['sum'] > 2.5
+
+    result = label.connected_components_tiled(read_strip, depthsdata.shape, write_strip, strip_rows, statistics,
+                                              keep_function)
+    compacted, compacted_nlabels = label.compact_labels(expected, keep_function(expected_stats))
+    assert result[0] is None
+    assert result[1] == compacted_nlabels
+    assert np.all(written == compacted)
+
+
+def test_label_dtype():
+    assert label_dtype(0) == np.uint8
+    assert label_dtype(255) == np.uint8
+    assert label_dtype(256) == np.uint16
+    assert label_dtype(2**16) == np.uint32
+    assert label_dtype(2**32) == np.int64
+    with pytest.raises(ValueError):
+        label_dtype(2**63)
+
+
+def test_label_quantiles(bspotdata, fillednoflatsdata):
+    quantiles = (0, 0.5, 0.9, 1)
+    data = np.copy(fillednoflatsdata)
+    data[::7, ::5] = -999
+    result = label.label_quantiles(data, bspotdata, quantiles, nodata=-999)
+    nlabels = np.max(bspotdata)
+    assert result.shape == (nlabels + 1, len(quantiles))
+    for lbl in [0, 1, 17, nlabels]:
+        values = data[(bspotdata == lbl) & (data != -999)]
+        np.testing.assert_allclose(result[lbl], np.percentile(values, [100 * q for q in quantiles]))
+
+    # Labels without cells
+    result = label.label_quantiles(data, bspotdata, quantiles, nlabels + 2)
+    assert np.all(np.isnan(result[nlabels + 1:]))
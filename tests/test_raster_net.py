@@ -1,5 +1,6 @@
 import json
 
+import numpy as np
 import pytest
 from malstroem.algorithms import net
 from data.fixtures import flowdirdata, bspotdata, pourpointsdata
@@ -43,3 +44,38 @@ def test_geometric_pourpoint_network(bspotdata, flowdirdata, pourpointsdata):
             if downstream_node['nodetype'] == 'junction':
                 # Last coord must match next node coord if next node is junction
                 assert n['geometry'][-1] == downstream_node['pix'], "Node flow mismatch {} to {}".format(n, downstream_node)
+
+
+def test_path_tree(bspotdata, flowdirdata, pourpointsdata):
+    tree = net.PathTree(flowdirdata.shape)
+    total_length = 0
+    for pid, pp in net._pourpoint_enumerator(pourpointsdata):
+        lbl, path = net._trace_path(flowdirdata, bspotdata, pp, tree, background_label=0)
+        expected_lbl, expected_geom = net.next_downstream_label(flowdirdata, bspotdata, pp, background_label=0,
+                                                                geometry=True)
+        assert lbl == expected_lbl
+        assert list(path) == expected_geom
+        total_length += len(path)
+    # Common downstream cells are only stored once
+    assert tree.size < total_length
+
+    nodes = net.geometric_pourpoint_network(flowdirdata, bspotdata, pourpointsdata, background_label=0)
+    tree = nodes[0]['geometry'].tree
+    cells, offsets = tree.path_cells([n['geometry'].start for n in nodes], [len(n['geometry']) for n in nodes])
+    assert offsets[-1] == len(cells)
+    for i, n in enumerate(nodes):
+        assert [tuple(c) for c in cells[offsets[i]:offsets[i + 1]]] == list(n['geometry'])
+
+
+def test_stream_rasters(bspotdata, flowdirdata, pourpointsdata):
+    pp_streams = net.burn_pourpoint_streams(flowdirdata, bspotdata, pourpointsdata, background_label=0, nodata=-1)
+    nodes = net.geometric_pourpoint_network(flowdirdata, bspotdata, pourpointsdata, background_label=0)
+    segment_streams = net.burn_stream_segments(nodes, flowdirdata.shape, nodata=-1)
+
+    assert pp_streams.dtype == segment_streams.dtype == np.int32
+    # Same cells carry flow no matter how they are identified
+    assert np.all((pp_streams >= 0) == (segment_streams >= 0))
+    assert set(np.unique(segment_streams)) - {-1} <= set([n['id'] for n in nodes])
+    for pid, pp in net._pourpoint_enumerator(pourpointsdata):
+        if pid:
+            assert pp_streams[pp[0], pp[1]] == pid
@@ -1,3 +1,4 @@
+import numpy as np
 import pytest
 from malstroem import vector
 
@@ -15,7 +16,93 @@ def test_transform(cell_coord, geotransform, expected_world_coord):
     assert wld == expected_world_coord
 
 
+@pytest.mark.parametrize("cell_coord, geotransform, expected_world_coord", cell_to_world)
+def test_transform_array(cell_coord, geotransform, expected_world_coord):
+    wld = vector.transform_cells_to_world([cell_coord], geotransform)
+    assert wld.shape == (1, 2)
+    assert tuple(wld[0]) == expected_world_coord
+
+
+def test_transform_array_matches_single():
+    geotransform = (720000.0, 0.4, 0.0, 6193000.0, 0.0, -0.4)
+    cells = [(r, c) for r in range(0, 200, 7) for c in range(0, 300, 11)]
+    wld = vector.transform_cells_to_world(cells, geotransform)
+    assert len(wld) == len(cells)
+    for cell, w in zip(cells, wld):
+        assert tuple(w) == vector.transform_cell_to_world(cell, geotransform)
+
+
 def test_vectorize():
     result = list(vector.vectorize_labels_file(labeledfile, 'bspot_id'))
     assert len(result) == 113
 
+
+
+def test_simplify_straight_run():
+    coords = [(0, 0), (1, 0), (2, 0), (3, 0), (3, 1), (3, 2)]
+    simplified = vector.simplify_coords(coords, 0)
+    assert simplified.tolist() == [[0, 0], [3, 0], [3, 2]]
+
+
+def test_simplify_staircase():
+    # D8 staircase
+    coords = [(0, 0), (1, 0), (2, 1), (3, 1), (4, 2), (5, 2), (6, 3)]
+    assert len(vector.simplify_coords(coords, 0)) == len(coords)
+    simplified = vector.simplify_coords(coords, 0.75)
+    assert simplified.tolist() == [[0, 0], [6, 3]]
+
+
+def test_simplify_polygon():
+    ring = [(0, 0), (0, 1), (0, 2), (1, 2), (2, 2), (2, 1), (2, 0), (1, 0), (0, 0)]
+    features = [dict(type='Feature', properties={}, geometry=dict(type='Polygon', coordinates=[ring]))]
+    result = list(vector.simplify_geojson_features(features, 0))
+    simplified = result[0]['geometry']['coordinates'][0]
+    assert simplified[0] == simplified[-1]
+    assert len(simplified) == 5
+
+
+def _ring_area(ring):
+    x, y = np.array(ring).T
+    return 0.5 * abs(np.dot(x[:-1], y[1:]) - np.dot(x[1:], y[:-1]))
+
+
+def test_simplify_polygons_shared_border():
+    # Two polygons sharing a staircase border
+    a = [(0, 0), (1, 0), (1, 1), (2, 1), (2, 2), (3, 2), (3, 3), (4, 3), (4, 4), (0, 4), (0, 0)]
+    b = [(1, 0), (4, 0), (4, 3), (3, 3), (3, 2), (2, 2), (2, 1), (1, 1), (1, 0)]
+    features = [dict(type='Feature', properties={}, geometry=dict(type='Polygon', coordinates=[r])) for r in (a, b)]
+    result = list(vector.simplify_geojson_features(features, 0.75))
+    simple_a = result[0]['geometry']['coordinates'][0]
+    simple_b = result[1]['geometry']['coordinates'][0]
+    # The staircase is collapsed the same way in both polygons
+    assert len(simple_a) < len(a) and len(simple_b) < len(b)
+    assert [1, 0] in simple_a and [4, 3] in simple_a
+    assert [1, 0] in simple_b and [4, 3] in simple_b
+    # No gaps or overlaps
+    assert _ring_area(simple_a) + _ring_area(simple_b) == 16
+
+
+def test_simplify_polygons_no_crossing():
+    # A thin spike next to a square. Simplifying the spike alone would cut through the square
+    spike = [(0, 0), (1, 0), (1, 2), (2, 2), (2, 3), (0, 3), (0, 0)]
+    square = [(1.05, 1.7), (1.25, 1.7), (1.25, 1.95), (1.05, 1.95), (1.05, 1.7)]
+    features = [dict(type='Feature', properties={}, geometry=dict(type='Polygon', coordinates=[r]))
+                for r in (spike, square)]
+    result = list(vector.simplify_geojson_features(features, 1.5))
+    simple_spike = result[0]['geometry']['coordinates'][0]
+    assert _ring_area(simple_spike) == _ring_area(spike)
+
+
+def test_simplify_multipolygon():
+    ring = [(0, 0), (0, 1), (0, 2), (1, 2), (2, 2), (2, 1), (2, 0), (1, 0), (0, 0)]
+    other = [(x + 5, y) for x, y in ring]
+    line = [(0, 0), (1, 0), (2, 0)]
+    features = [dict(type='Feature', properties={}, geometry=dict(type='MultiPolygon', coordinates=[[ring], [other]])),
+                dict(type='Feature', properties={}, geometry=dict(type='LineString', coordinates=line))]
+    result = list(vector.simplify_geojson_features(features, 0))
+    # Polygons are yielded after the other geometries
+    assert result[0]['geometry']['coordinates'] == [[0, 0], [2, 0]]
+    parts = result[1]['geometry']['coordinates']
+    assert len(parts) == 2
+    assert [len(p[0]) for p in parts] == [5, 5]
+    assert _ring_area(parts[1][0]) == 4